@@ -0,0 +1,90 @@
+import hashlib
+import json
+import os
+import shutil
+import threading
+"""
+Local content-addressed cache of the downloaded zips, so a re-run never fetches the same archive twice.
+The archives are stored once under objects/{sha256[:2]}/{sha256}.zip, and index.jsonl maps every zip url
+to the sha256, size and ETag of its archive. New entries are appended to the index, the last entry of a url wins.
+"""
+
+
+def file_sha256(file_path, chunk_size=1024 * 1024):
+    """
+    Return the sha256 hex digest of a local file, read in chunks
+    """
+    sha256 = hashlib.sha256()
+    with open(file_path, 'rb') as file:
+        for chunk in iter(lambda: file.read(chunk_size), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def _link_or_copy(src, dst):
+    """
+    Hard link src to dst when they are on the same file system, copy it otherwise
+    """
+    if os.path.exists(dst):
+        os.remove(dst)
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
+
+
+class ArchiveCache:
+    def __init__(self, cache_dir):
+        """
+        :param cache_dir: local folder of the cache, created if it does not exist
+        """
+        self.cache_dir = cache_dir
+        self.index_path = os.path.join(cache_dir, 'index.jsonl')
+        self.index = {}
+        self._lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+        if os.path.exists(self.index_path):
+            with open(self.index_path, 'r') as file:
+                for line in file:
+                    if line.strip():
+                        record = json.loads(line)
+                        self.index[record['url']] = record
+            print(f'{len(self.index)} archives indexed in the archive cache {cache_dir}')
+
+    def object_path(self, sha256):
+        return os.path.join(self.cache_dir, 'objects', sha256[:2], sha256 + '.zip')
+
+    def get(self, url, dest_path, etag=None):
+        """
+        Place the cached archive of url at dest_path
+        :param etag: current ETag of the url, a cached archive with another ETag is out of date
+        :return the cache record {'url', 'sha256', 'size', 'etag'}, None if the url is not cached
+        """
+        with self._lock:
+            record = self.index.get(url)
+        if record is None:
+            return None
+        if etag and record['etag'] and record['etag'] != etag:
+            return None
+        object_path = self.object_path(record['sha256'])
+        if not os.path.exists(object_path) or os.path.getsize(object_path) != record['size']:
+            return None
+        _link_or_copy(object_path, dest_path)
+        return record
+
+    def add(self, url, file_path, etag=None):
+        """
+        Store the downloaded archive of url in the cache, an archive with the same content is only stored once
+        :return the cache record {'url', 'sha256', 'size', 'etag'}
+        """
+        sha256 = file_sha256(file_path)
+        object_path = self.object_path(sha256)
+        if not os.path.exists(object_path):
+            os.makedirs(os.path.dirname(object_path), exist_ok=True)
+            _link_or_copy(file_path, object_path)
+        record = {'url': url, 'sha256': sha256, 'size': os.path.getsize(file_path), 'etag': etag}
+        with self._lock:
+            self.index[url] = record
+            with open(self.index_path, 'a') as file:
+                file.write(json.dumps(record) + '\n')
+        return record
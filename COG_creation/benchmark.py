@@ -0,0 +1,499 @@
+import argparse
+import hashlib
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+"""
+Benchmarks of the COG creation steps on the sample Geotiffs in Test/tiff.
+fused: compare reproject_raster + geotiff_to_cog with warp_to_cog, wall time, peak disk and identical output, and the
+       cost of the exact warp of tiled_reproject
+profiles: run warp_to_cog with every GDAL profile, throughput and output size
+upload: compare one client per file uploads with the shared client and parallel multipart uploads, against a local S3
+suite: time the crawl, downloads, GDAL steps and uploads one at a time and end to end through main.main(), against
+       the local EGS server of local_http_server.py and a local S3, and store the results of the commit
+compare: compare two stored results of the suite
+imports: time the start of main.py and of its subcommands in new interpreters, against an import-time budget
+"""
+script_dir = os.path.dirname(os.path.abspath(__file__))
+sample_dir = os.path.join(script_dir, 'Test', 'tiff')
+results_dir = os.path.join(script_dir, 'benchmark_results')
+MB = 1024 * 1024
+# Modules main.py must not import before a subcommand needs them
+HEAVY_MODULES = ('osgeo', 'boto3', 'botocore', 'rio_cogeo', 'requests', 'bs4')
+# Run in a new interpreter: time the import of main.py, or main.py with the arguments of sys.argv, and list the heavy modules
+_START_SCRIPT = '''
+import json, runpy, sys, time
+start = time.perf_counter()
+try:
+    if len(sys.argv) > 1:
+        runpy.run_path('main.py', run_name='__main__')
+    else:
+        import main
+except SystemExit:
+    pass
+print(json.dumps({'seconds': time.perf_counter() - start, 'heavy': [name for name in %r if name in sys.modules]}))
+''' % (HEAVY_MODULES,)
+
+
+def folder_size(folder):
+    """
+    Return the total size in bytes of the files under folder
+    """
+    total = 0
+    for root, _, files in os.walk(folder):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                # The file was removed while walking the folder
+                pass
+    return total
+
+
+class PeakDisk:
+    """
+    Context manager sampling the size of a folder in a background thread, peak is the largest size seen in bytes
+    """
+    def __init__(self, folder, interval=0.01):
+        self.folder = folder
+        self.interval = interval
+        self.peak = 0
+        self._stop = threading.Event()
+
+    def _sample(self):
+        while not self._stop.is_set():
+            self.peak = max(self.peak, folder_size(self.folder))
+            self._stop.wait(self.interval)
+
+    def __enter__(self):
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, folder_size(self.folder))
+
+
+def md5sum(file_path):
+    md5 = hashlib.md5()
+    with open(file_path, 'rb') as file:
+        for chunk in iter(lambda: file.read(1024 * 1024), b''):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+def sample_inputs(inputs=None):
+    """
+    Return the Geotiffs to benchmark, all the .tif in Test/tiff by default
+    """
+    if inputs:
+        return inputs
+    return sorted(os.path.join(sample_dir, name) for name in os.listdir(sample_dir) if name.endswith('.tif'))
+
+
+def measure(fn, work_dir):
+    """
+    Run fn() and return (wall time in seconds, peak size of work_dir in bytes)
+    """
+    with PeakDisk(work_dir) as disk:
+        start = time.perf_counter()
+        fn()
+        elapsed = time.perf_counter() - start
+    return elapsed, disk.peak
+
+
+def bench_fused(inputs, dstSRS, xRes, yRes, repeat):
+    """
+    Time the two-step and the fused path on every input, check both produce the same COG bytes.
+    Also time the fused path with exact=True, the warp without the approximation of the transformer used by the tiles
+    of tiled_reproject, to show what it would cost on every link
+    """
+    from geotiff_to_cog import reproject_raster, geotiff_to_cog, warp_to_cog
+    datetime_value = '2016:05:03 23:29:50'
+    print(f'{"input":<50} {"path":<10} {"seconds":>8} {"peak MB":>8}')
+    for input_path in inputs:
+        name = os.path.basename(input_path)
+        digests, best = {}, {}
+        for path_name in ('two-step', 'fused', 'exact'):
+            times, peaks = [], []
+            for _ in range(repeat):
+                work_dir = tempfile.mkdtemp(prefix='bench_')
+                local_input = os.path.join(work_dir, name)
+                shutil.copyfile(input_path, local_input)
+                output_path = local_input.replace('.tif', '_out_cog.tif')
+                input_size = os.path.getsize(local_input)
+                if path_name == 'two-step':
+                    def run():
+                        proj_path = reproject_raster(local_input, dstSRS, xRes, yRes)
+                        geotiff_to_cog(proj_path, output_path, datetime_value)
+                else:
+                    def run():
+                        warp_to_cog(local_input, output_path, dstSRS, xRes, yRes, datetime_value, exact=path_name == 'exact')
+                elapsed, peak = measure(run, work_dir)
+                times.append(elapsed)
+                peaks.append(peak - input_size)
+                digests[path_name] = md5sum(output_path)
+                shutil.rmtree(work_dir)
+            best[path_name] = min(times)
+            print(f'{name[:50]:<50} {path_name:<10} {min(times):>8.2f} {max(peaks) / 1e6:>8.1f}')
+        same = 'identical' if digests['two-step'] == digests['fused'] else 'DIFFERENT'
+        print(f'{name[:50]:<50} outputs are {same}, the exact warp takes {100 * (best["exact"] / best["fused"] - 1):+.0f}% time')
+
+
+def bench_profiles(inputs, dstSRS, xRes, yRes, repeat, profile_names, workers=1):
+    """
+    Time warp_to_cog with every profile on every input, report the throughput in input MB/s and output Mpixel/s,
+    and the COG size
+    """
+    from osgeo import gdal
+    from gdal_profile import get_profile
+    from geotiff_to_cog import warp_to_cog
+    datetime_value = '2016:05:03 23:29:50'
+    print(f'{"input":<50} {"profile":<10} {"seconds":>8} {"in MB/s":>8} {"Mpix/s":>8} {"out MB":>8}')
+    for input_path in inputs:
+        name = os.path.basename(input_path)
+        input_mb = os.path.getsize(input_path) / 1e6
+        for profile_name in profile_names:
+            profile = get_profile(profile_name, workers=workers)
+            times = []
+            for _ in range(repeat):
+                work_dir = tempfile.mkdtemp(prefix='bench_')
+                output_path = os.path.join(work_dir, name.replace('.tif', '_cog.tif'))
+                elapsed, _ = measure(lambda: warp_to_cog(input_path, output_path, dstSRS, xRes, yRes, datetime_value, profile=profile),
+                                     work_dir)
+                times.append(elapsed)
+                ds = gdal.Open(output_path)
+                mpixels = ds.RasterXSize * ds.RasterYSize / 1e6
+                ds = None
+                output_mb = os.path.getsize(output_path) / 1e6
+                shutil.rmtree(work_dir)
+            best = min(times)
+            print(f'{name[:50]:<50} {profile_name:<10} {best:>8.2f} {input_mb / best:>8.1f} {mpixels / best:>8.1f} {output_mb:>8.2f}')
+
+
+def start_s3(endpoint_url=None):
+    """
+    Return (endpoint_url, server) of the local S3 the benchmarks upload to, moto's server is started if endpoint_url
+    is None, and the shared S3 client of s3_operations is pointed to it. Call server.stop() when done.
+    """
+    from s3_operations import configure_s3
+    server = None
+    if endpoint_url is None:
+        import logging
+        from moto.server import ThreadedMotoServer
+        # Keep the request log of the server out of the results
+        logging.getLogger('werkzeug').setLevel(logging.ERROR)
+        server = ThreadedMotoServer(port=0)
+        server.start()
+        endpoint_url = f'http://{server._server.server_address[0]}:{server._server.server_address[1]}'
+    os.environ.setdefault('AWS_ACCESS_KEY_ID', 'testing')
+    os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'testing')
+    os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+    configure_s3(endpoint_url=endpoint_url)
+    return endpoint_url, server
+
+
+def bench_upload(inputs, endpoint_url, repeat, files, workers):
+    """
+    Time the upload of files copies of the inputs with a new client and a default upload per file, as before the
+    shared client, and with upload_files_to_s3. Without endpoint_url, moto's server runs locally as the S3 stand-in.
+    """
+    import boto3
+    from s3_operations import configure_s3, upload_files_to_s3
+    endpoint_url, server = start_s3(endpoint_url)
+    configure_s3(max_pool_connections=max(32, workers * 8))
+    bucket_name = 'egs-benchmark'
+    boto3.client('s3', endpoint_url=endpoint_url).create_bucket(Bucket=bucket_name)
+    pairs = [(inputs[i % len(inputs)], f'bench/{i}/{os.path.basename(inputs[i % len(inputs)])}') for i in range(files)]
+    total_mb = sum(os.path.getsize(path) for path, _ in pairs) / 1e6
+
+    def per_file_clients():
+        for local_file_path, s3_key in pairs:
+            boto3.client('s3', endpoint_url=endpoint_url).upload_file(local_file_path, bucket_name, s3_key)
+
+    print(f'{files} files, {total_mb:.1f} MB to {endpoint_url}')
+    print(f'{"uploads":<20} {"seconds":>8} {"MB/s":>8}')
+    try:
+        for name, run in (('client per file', per_file_clients),
+                          ('shared, parallel', lambda: upload_files_to_s3(bucket_name, pairs, max_workers=workers, extra_args={}))):
+            best = min(measure(run, sample_dir)[0] for _ in range(repeat))
+            print(f'{name:<20} {best:>8.2f} {total_mb / best:>8.1f}')
+    finally:
+        if server is not None:
+            server.stop()
+
+
+def git_revision():
+    """
+    Return the short hash of the checked out commit, with -dirty if the tree has changes, 'unknown' outside git
+    """
+    try:
+        revision = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=script_dir, stderr=subprocess.DEVNULL)
+        status = subprocess.check_output(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=script_dir, stderr=subprocess.DEVNULL)
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+    return revision.decode().strip() + ('-dirty' if status.strip() else '')
+
+
+def timeit(run, repeat, scratch_dir, megabytes=None):
+    """
+    Time run(work_dir) repeat times, each run with a new empty work_dir removed afterwards
+    :param megabytes: optional MB processed by one run, for the throughput
+    :return: {'best', 'median', 'runs', 'mb_per_s'} in seconds
+    """
+    runs = []
+    for _ in range(repeat):
+        work_dir = tempfile.mkdtemp(dir=scratch_dir)
+        start = time.perf_counter()
+        run(work_dir)
+        runs.append(round(time.perf_counter() - start, 4))
+        shutil.rmtree(work_dir, ignore_errors=True)
+    result = {'best': min(runs), 'median': statistics.median(runs), 'runs': runs}
+    if megabytes:
+        result['mb_per_s'] = round(megabytes / min(runs), 2)
+    return result
+
+
+def bench_suite(repeat, sizes_mb, links, workers, io_workers, endpoint_url=None, output_dir=results_dir):
+    """
+    Time every step of the pipeline on synthetic EGS zips, the sample Geotiff padded to sizes_mb, served by the
+    local EGS server, and uploaded to a local S3. The GDAL steps and main.main() are skipped if osgeo is missing.
+    The results are written to output_dir/{date}_{commit}.json, compare them with the compare command.
+    :param sizes_mb: sizes of the padding of the zips, one year of links per size
+    :param links: number of zips of every size
+    """
+    import boto3
+    from local_http_server import build_fake_egs_tree, serve_directory
+    from get_zip_links import crawl_zip_links, get_zip_links
+    from download_and_unzip import download_and_unzip
+    from s3_operations import upload_file_to_s3, upload_files_to_s3, upload_url_to_s3
+
+    sample_path = sample_inputs()[0]
+    scratch_dir = tempfile.mkdtemp(prefix='bench_suite_')
+    root_dir = os.path.join(scratch_dir, 'egs')
+    years = [2016 + i for i in range(len(sizes_mb))]
+    zip_paths = {}
+    for year, size in zip(years, sizes_mb):
+        zip_paths[size] = build_fake_egs_tree(root_dir, [year], ['RiverIce'], provinces=('ON',), links_per_dir=links,
+                                              member_path=sample_path, padding_bytes=size * MB)
+    server, root_url = serve_directory(root_dir)
+    endpoint_url, s3_server = start_s3(endpoint_url)
+    bucket_name = 'egs-benchmark'
+    boto3.client('s3', endpoint_url=endpoint_url).create_bucket(Bucket=bucket_name)
+    results = {}
+    skipped = {}
+
+    def bench(name, run, megabytes=None):
+        result = results[name] = timeit(run, repeat, scratch_dir, megabytes)
+        print(f'{name}: best {result["best"]:.3f} s, median {result["median"]:.3f} s'
+              + (f', {result["mb_per_s"]} MB/s' if megabytes else ''))
+
+    try:
+        bench('get_zip_links', lambda work_dir: get_zip_links(root_url, years[0], 'RiverIce'))
+        bench('crawl_zip_links', lambda work_dir: list(crawl_zip_links(root_url, years, ['RiverIce'])))
+        for size in sizes_mb:
+            zip_path = os.path.join(root_dir, zip_paths[size][0])
+            zip_mb = os.path.getsize(zip_path) / 1e6
+            bench(f'download_and_unzip[{size}MB]', lambda work_dir: download_and_unzip(f'{root_url}/{zip_paths[size][0]}', work_dir,
+                                                                                   keyword='RiverIce', format='.tif'), zip_mb)
+            bench(f'upload_file_to_s3[{size}MB]', lambda work_dir: upload_file_to_s3(bucket_name, 'bench/', zip_path, 'upload.zip', extra_args={}),
+                  zip_mb)
+            bench(f'upload_url_to_s3[{size}MB]', lambda work_dir: upload_url_to_s3(f'{root_url}/{zip_paths[size][0]}', bucket_name, 'bench/stream.zip',
+                                                                                 extra_args={}), zip_mb)
+        all_zips = [os.path.join(root_dir, path) for paths in zip_paths.values() for path in paths]
+        bench('upload_files_to_s3', lambda work_dir: upload_files_to_s3(bucket_name, [(path, 'bench/batch/' + os.path.basename(path)) for path in all_zips],
+                                                                        max_workers=io_workers, extra_args={}),
+              sum(os.path.getsize(path) for path in all_zips) / 1e6)
+
+        try:
+            from geotiff_to_cog import reproject_raster, geotiff_to_cog, warp_to_cog
+        except ImportError as e:
+            skipped['gdal'] = repr(e)
+            print(f'The GDAL steps and main.main() are skipped: {e!r}')
+        else:
+            sample_mb = os.path.getsize(sample_path) / 1e6
+            datetime_value = '2016:05:03 23:29:50'
+            reprj_path = os.path.join(scratch_dir, 'reprj.tif')
+            reproject_raster(sample_path, 'EPSG:3978', 5, 5, output_path=reprj_path)
+            bench('reproject_raster', lambda work_dir: reproject_raster(sample_path, 'EPSG:3978', 5, 5, output_path=os.path.join(work_dir, 'reprj.tif')),
+                  sample_mb)
+            bench('geotiff_to_cog', lambda work_dir: geotiff_to_cog(reprj_path, os.path.join(work_dir, 'cog.tif'), datetime_value), sample_mb)
+            bench('warp_to_cog', lambda work_dir: warp_to_cog(sample_path, os.path.join(work_dir, 'cog.tif'), 'EPSG:3978', 5, 5, datetime_value),
+                  sample_mb)
+
+            import main as pipeline
+            runs = []
+
+            def end_to_end(work_dir, **job_options):
+                # A new S3 folder and manifest for every run, so every link is processed
+                runs.append(work_dir)
+                pipeline.main(root_url, years, 'RiverIce', bucket_name, f'bench/run{len(runs)}/', os.path.join(work_dir, 'zip'),
+                              'EPSG:3978', 5, 5, workers=workers, io_workers=io_workers,
+                              manifest_path=os.path.join(work_dir, 'manifest.jsonl'), metrics_path=os.path.join(work_dir, 'metrics.jsonl'),
+                              **job_options)
+            bench('main.main', end_to_end, sum(os.path.getsize(path) for path in all_zips) / 1e6)
+            # Zips read from the local EGS server by GDAL and streamed to the local S3, COGs written to /vsimem/
+            bench('main.main[stream]', lambda work_dir: end_to_end(work_dir, read_mode='stream'), sum(os.path.getsize(path) for path in all_zips) / 1e6)
+    finally:
+        server.shutdown()
+        if s3_server is not None:
+            s3_server.stop()
+        shutil.rmtree(scratch_dir, ignore_errors=True)
+
+    revision = git_revision()
+    record = {
+        'revision': revision,
+        'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': sys.version.split()[0],
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'params': {'repeat': repeat, 'sizes_mb': sizes_mb, 'links': links, 'workers': workers, 'io_workers': io_workers},
+        'skipped': skipped,
+        'results': results,
+    }
+    os.makedirs(output_dir, exist_ok=True)
+    result_path = os.path.join(output_dir, f'{time.strftime("%Y%m%d_%H%M%S")}_{revision}.json')
+    with open(result_path, 'w') as file:
+        json.dump(record, file, indent=2)
+    print(f'Results written to {result_path}')
+    return result_path
+
+
+def compare_results(old_path=None, new_path=None, threshold=10, output_dir=results_dir):
+    """
+    Compare the best times of two results of the suite, the two latest in output_dir by default
+    :param threshold: percent slower reported as a regression
+    :return: list of the names of the regressions
+    """
+    if old_path is None or new_path is None:
+        paths = sorted(os.path.join(output_dir, name) for name in os.listdir(output_dir) if name.endswith('.json'))
+        if len(paths) < 2:
+            raise ValueError(f'Two results are needed in {output_dir} to compare, run the suite first')
+        old_path, new_path = paths[-2:]
+    with open(old_path, 'r') as file:
+        old = json.load(file)
+    with open(new_path, 'r') as file:
+        new = json.load(file)
+    print(f'{old["revision"]} ({old["date"]}) -> {new["revision"]} ({new["date"]})')
+    if old['params'] != new['params']:
+        print(f'The parameters differ: {old["params"]} -> {new["params"]}')
+    print(f'{"benchmark":<34} {"old s":>9} {"new s":>9} {"change":>8}')
+    regressions = []
+    for name, result in new['results'].items():
+        if name not in old['results']:
+            print(f'{name:<34} {"":>9} {result["best"]:>9.3f} {"new":>8}')
+            continue
+        old_best = old['results'][name]['best']
+        change = (result['best'] - old_best) / old_best * 100 if old_best else 0
+        flag = ''
+        if change > threshold:
+            flag = '  REGRESSION'
+            regressions.append(name)
+        print(f'{name:<34} {old_best:>9.3f} {result["best"]:>9.3f} {change:>+7.1f}%{flag}')
+    print(f'{len(regressions)} regressions slower than {threshold}%')
+    return regressions
+
+
+def bench_imports(budget, repeat):
+    """
+    Time 'import main' and the --help of every subcommand of main.py in new interpreters, the best of repeat runs
+    :param budget: seconds allowed to each of them
+    :return: the list of the ones over the budget or importing a heavy module
+    """
+    from main import COMMANDS
+    failures = []
+    print(f'{"start":<24} {"seconds":>8}  heavy modules')
+    for name, argv in [('import main', [])] + [(f'main.py {command} --help', [command, '--help']) for command in COMMANDS]:
+        runs = []
+        for _ in range(repeat):
+            output = subprocess.run([sys.executable, '-c', _START_SCRIPT] + argv, cwd=script_dir, stdout=subprocess.PIPE,
+                                    stderr=subprocess.DEVNULL, universal_newlines=True, check=True).stdout
+            runs.append(json.loads(output.strip().splitlines()[-1]))
+        seconds = min(run['seconds'] for run in runs)
+        heavy = runs[0]['heavy']
+        flag = ''
+        if seconds > budget or heavy:
+            flag = '  OVER BUDGET' if seconds > budget else '  HEAVY IMPORTS'
+            failures.append(name)
+        print(f'{name:<24} {seconds:>8.3f}  {", ".join(heavy) or "-"}{flag}')
+    print(f'{len(failures)} starts over the budget of {budget} seconds or importing {", ".join(HEAVY_MODULES)}')
+    return failures
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the COG creation steps.')
+    subparsers = parser.add_subparsers(dest='command')
+    fused = subparsers.add_parser('fused', help='Compare reproject_raster + geotiff_to_cog with warp_to_cog')
+    fused.add_argument('inputs', nargs='*', help='Geotiffs to convert, all the .tif in Test/tiff by default')
+    fused.add_argument('--proj-epsg', default='EPSG:3978', help='Projection EPSG code')
+    fused.add_argument('--res', type=float, default=5, help='Resolution in X and Y')
+    fused.add_argument('--repeat', type=int, default=3, help='Number of runs, the best time is reported')
+    profiles = subparsers.add_parser('profiles', help='Compare the GDAL performance profiles on warp_to_cog')
+    profiles.add_argument('inputs', nargs='*', help='Geotiffs to convert, all the .tif in Test/tiff by default')
+    profiles.add_argument('--proj-epsg', default='EPSG:3978', help='Projection EPSG code')
+    profiles.add_argument('--res', type=float, default=5, help='Resolution in X and Y')
+    profiles.add_argument('--repeat', type=int, default=3, help='Number of runs, the best time is reported')
+    profiles.add_argument('--profiles', nargs='+', default=['default', 'fast', 'small'], help='Names of the profiles in gdal_profile.PROFILES')
+    profiles.add_argument('--workers', type=int, default=1, help="Number of GDAL workers the 'auto' threads are shared with")
+    upload = subparsers.add_parser('upload', help='Compare the uploads with a client per file and with the shared S3 client')
+    upload.add_argument('inputs', nargs='*', help='Files to upload, all the .tif in Test/tiff by default')
+    upload.add_argument('--endpoint', default=None, help="Endpoint of a local S3 stand-in such as MinIO, moto's server by default")
+    upload.add_argument('--files', type=int, default=20, help='Number of files uploaded, the inputs are repeated')
+    upload.add_argument('--workers', type=int, default=8, help='Number of files uploaded at the same time')
+    upload.add_argument('--repeat', type=int, default=3, help='Number of runs, the best time is reported')
+    suite = subparsers.add_parser('suite', help='Time every step of the pipeline and end to end, and store the results of the commit')
+    suite.add_argument('--repeat', type=int, default=3, help='Number of runs, the best and median times are stored')
+    suite.add_argument('--sizes-mb', type=int, nargs='+', default=[0, 8, 32], help='Padding of the synthetic zips in MB, on top of the sample Geotiff')
+    suite.add_argument('--links', type=int, default=2, help='Number of zips of every size')
+    suite.add_argument('--workers', type=int, default=2, help='GDAL processes of main.main()')
+    suite.add_argument('--io-workers', type=int, default=4, help='Download and upload threads')
+    suite.add_argument('--endpoint', default=None, help="Endpoint of a local S3 stand-in such as MinIO, moto's server by default")
+    suite.add_argument('--output-dir', default=results_dir, help='Folder of the stored results')
+    compare = subparsers.add_parser('compare', help='Compare two stored results of the suite, the two latest by default')
+    compare.add_argument('results', nargs='*', help='Old and new result files')
+    compare.add_argument('--threshold', type=float, default=10, help='Percent slower reported as a regression')
+    compare.add_argument('--output-dir', default=results_dir, help='Folder of the stored results')
+    imports = subparsers.add_parser('imports', help='Time the start of main.py and its subcommands against an import-time budget')
+    imports.add_argument('--budget', type=float, default=0.25, help='Seconds allowed to import main.py or print the help of a subcommand')
+    imports.add_argument('--repeat', type=int, default=3, help='Number of runs, the best time is reported')
+    args = parser.parse_args()
+
+    if args.command == 'fused':
+        bench_fused(sample_inputs(args.inputs), args.proj_epsg, args.res, args.res, args.repeat)
+    elif args.command == 'profiles':
+        bench_profiles(sample_inputs(args.inputs), args.proj_epsg, args.res, args.res, args.repeat, args.profiles, args.workers)
+    elif args.command == 'upload':
+        bench_upload(sample_inputs(args.inputs), args.endpoint, args.repeat, args.files, args.workers)
+    elif args.command == 'suite':
+        bench_suite(args.repeat, args.sizes_mb, args.links, args.workers, args.io_workers, args.endpoint, args.output_dir)
+    elif args.command == 'compare':
+        if len(args.results) not in (0, 2):
+            parser.error('compare takes no result file or two')
+        regressions = compare_results(*(args.results or [None, None]), threshold=args.threshold, output_dir=args.output_dir)
+        sys.exit(1 if regressions else 0)
+    elif args.command == 'imports':
+        sys.exit(1 if bench_imports(args.budget, args.repeat) else 0)
+    else:
+        parser.print_help()
+"""
+# Run the benchmark from the terminal
+python benchmark.py fused --repeat 3
+# Tune the profile for a node running 4 GDAL workers
+python benchmark.py profiles --profiles default fast small --workers 4
+# Time the pipeline on this commit, and compare with the previous results
+python benchmark.py suite --repeat 3 --sizes-mb 0 8 32
+python benchmark.py compare
+# Check that main.py and its subcommands start within 0.25 seconds without GDAL, boto3 or requests
+python benchmark.py imports --budget 0.25
+# Compare the uploads against moto's server, or MinIO with --endpoint http://127.0.0.1:9000
+python benchmark.py upload --files 20 --workers 8
+"""
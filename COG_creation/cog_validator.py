@@ -0,0 +1,405 @@
+import argparse
+import json
+import os
+import struct
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+"""
+Cloud optimized GeoTIFF validator reading only the TIFF header and the IFDs, in place of rio_cogeo's cog_validate.
+It checks the same layout as GDAL's validate_cloud_optimized_geotiff.py:
+    - the main IFD comes right after the header, or after the GDAL ghost area
+    - the main image is tiled, and so are its overviews
+    - the overviews are in decreasing size, their IFDs are in increasing offset, before the image data
+    - the image data goes from the smallest overview to the full resolution, and the tiles of every image are in order
+The files are read through a Reader with a few ranged reads, a local file or an S3 object, so a whole cog/ prefix can
+be audited without downloading the COGs.
+"""
+
+# Bytes fetched by one ranged read, the header and IFDs of a COG usually fit in the first one
+CHUNK_SIZE = 64 * 1024
+
+# Sizes of the TIFF field types, and their struct formats
+FIELD_TYPES = {1: 'B', 2: 'c', 3: 'H', 4: 'I', 5: 'II', 6: 'b', 7: 'B', 8: 'h', 9: 'i', 10: 'ii', 11: 'f', 12: 'd',
+               13: 'I', 16: 'Q', 17: 'q', 18: 'Q'}
+
+NEW_SUBFILE_TYPE = 254
+IMAGE_WIDTH = 256
+IMAGE_LENGTH = 257
+STRIP_OFFSETS = 273
+TILE_WIDTH = 322
+TILE_LENGTH = 323
+TILE_OFFSETS = 324
+TILE_BYTE_COUNTS = 325
+
+# Bits of NewSubfileType
+REDUCED_IMAGE = 1
+MASK = 4
+
+
+class Reader:
+    """
+    Ranged reads of a file in CHUNK_SIZE chunks, each chunk is read once. Subclasses implement _fetch(start, end).
+    """
+    def __init__(self, name, chunk_size=CHUNK_SIZE):
+        self.name = name
+        self.chunk_size = chunk_size
+        self.chunks = {}
+        self.requests = 0
+        self.bytes_read = 0
+
+    def _fetch(self, start, end):
+        """
+        Return the bytes start to end excluded, fewer at the end of the file
+        """
+        raise NotImplementedError
+
+    def read(self, offset, size):
+        first = offset // self.chunk_size
+        last = (offset + size - 1) // self.chunk_size
+        missing = [i for i in range(first, last + 1) if i not in self.chunks]
+        if missing:
+            # One request for the missing chunks of this read
+            data = self._fetch(missing[0] * self.chunk_size, (missing[-1] + 1) * self.chunk_size)
+            self.requests += 1
+            self.bytes_read += len(data)
+            for i in missing:
+                start = (i - missing[0]) * self.chunk_size
+                self.chunks[i] = data[start:start + self.chunk_size]
+        data = b''.join(self.chunks[i] for i in range(first, last + 1))
+        start = offset - first * self.chunk_size
+        if len(data) < start + size:
+            raise EOFError(f'{self.name} ends before byte {offset + size}')
+        return data[start:start + size]
+
+    def close(self):
+        pass
+
+
+class LocalReader(Reader):
+    def __init__(self, file_path, chunk_size=CHUNK_SIZE):
+        super().__init__(file_path, chunk_size)
+        self.file = open(file_path, 'rb')
+
+    def _fetch(self, start, end):
+        self.file.seek(start)
+        return self.file.read(end - start)
+
+    def close(self):
+        self.file.close()
+
+
+class S3Reader(Reader):
+    def __init__(self, bucket_name, key, chunk_size=CHUNK_SIZE, s3_client=None):
+        super().__init__(f's3://{bucket_name}/{key}', chunk_size)
+        if s3_client is None:
+            from s3_operations import get_s3_client
+            s3_client = get_s3_client()
+        self.s3_client = s3_client
+        self.bucket_name = bucket_name
+        self.key = key
+
+    def _fetch(self, start, end):
+        response = self.s3_client.get_object(Bucket=self.bucket_name, Key=self.key, Range=f'bytes={start}-{end - 1}')
+        return response['Body'].read()
+
+
+class VsiReader(Reader):
+    """
+    Reader of a GDAL virtual file, e.g. a COG written to /vsimem/ by the stream mode of the pipeline
+    """
+    def __init__(self, vsi_path, chunk_size=CHUNK_SIZE):
+        from osgeo import gdal
+        super().__init__(vsi_path, chunk_size)
+        self.gdal = gdal
+        self.file = gdal.VSIFOpenL(vsi_path, 'rb')
+        if self.file is None:
+            raise FileNotFoundError(vsi_path)
+
+    def _fetch(self, start, end):
+        self.gdal.VSIFSeekL(self.file, start, 0)
+        return self.gdal.VSIFReadL(1, end - start, self.file)
+
+    def close(self):
+        self.gdal.VSIFCloseL(self.file)
+
+
+def open_reader(path, s3_client=None):
+    """
+    Return the Reader of a local path, of an s3://bucket/key url or of a GDAL /vsi path
+    """
+    if path.startswith('s3://'):
+        bucket_name, _, key = path[len('s3://'):].partition('/')
+        return S3Reader(bucket_name, key, s3_client=s3_client)
+    if path.startswith('/vsi'):
+        return VsiReader(path)
+    return LocalReader(path)
+
+
+def _unpack(reader, endian, offset, fmt):
+    size = struct.calcsize(endian + fmt)
+    return struct.unpack(endian + fmt, reader.read(offset, size))
+
+
+def read_ifds(reader):
+    """
+    Parse the TIFF header and the chain of IFDs
+    :return: (header dict {'bigtiff', 'endian', 'first_ifd', 'ghost'}, list of IFD dicts {'offset', 'tags'}),
+             tags maps the tag number to its tuple of values, or to {'offset', 'count', 'type'} of the values that are
+             not inline in the IFD, read later by _values
+    """
+    byte_order = reader.read(0, 2)
+    if byte_order not in (b'II', b'MM'):
+        raise ValueError('Not a TIFF file')
+    endian = '<' if byte_order == b'II' else '>'
+    version, = _unpack(reader, endian, 2, 'H')
+    if version == 42:
+        bigtiff = False
+        first_ifd, = _unpack(reader, endian, 4, 'I')
+        header_size, count_fmt, entry_fmt, offset_fmt, inline_size = 8, 'H', 'HHI', 'I', 4
+    elif version == 43:
+        bigtiff = True
+        first_ifd, = _unpack(reader, endian, 8, 'Q')
+        header_size, count_fmt, entry_fmt, offset_fmt, inline_size = 16, 'Q', 'HHQ', 'Q', 8
+    else:
+        raise ValueError(f'Not a TIFF file, version {version}')
+    header = {'bigtiff': bigtiff, 'endian': endian, 'first_ifd': first_ifd, 'header_size': header_size, 'ghost': None}
+    # GDAL ghost area: GDAL_STRUCTURAL_METADATA_SIZE=XXXXXX bytes\n followed by the metadata
+    ghost_prefix = b'GDAL_STRUCTURAL_METADATA_SIZE='
+    try:
+        start = reader.read(header_size, len(ghost_prefix) + 13)
+    except EOFError:
+        start = b''
+    if start.startswith(ghost_prefix):
+        size = int(start[len(ghost_prefix):len(ghost_prefix) + 6])
+        line_size = len(ghost_prefix) + 13
+        header['ghost'] = reader.read(header_size + line_size, size).decode('ascii', 'replace')
+        header['ghost_end'] = header_size + line_size + size
+
+    ifds = []
+    offset = first_ifd
+    seen = set()
+    entry_size = struct.calcsize(endian + entry_fmt) + inline_size
+    count_size = struct.calcsize(endian + count_fmt)
+    while offset and offset not in seen:
+        seen.add(offset)
+        entry_count, = _unpack(reader, endian, offset, count_fmt)
+        data = reader.read(offset + count_size, entry_count * entry_size + inline_size)
+        tags = {}
+        for i in range(entry_count):
+            entry = data[i * entry_size:(i + 1) * entry_size]
+            tag, field_type, count = struct.unpack(endian + entry_fmt, entry[:entry_size - inline_size])
+            value_bytes = entry[entry_size - inline_size:]
+            fmt = FIELD_TYPES.get(field_type)
+            if fmt is None:
+                continue
+            size = struct.calcsize(endian + fmt) * count
+            if size <= inline_size:
+                tags[tag] = struct.unpack(endian + fmt * count, value_bytes[:size])
+            else:
+                value_offset, = struct.unpack(endian + offset_fmt, value_bytes)
+                tags[tag] = {'offset': value_offset, 'count': count, 'type': field_type}
+        ifds.append({'offset': offset, 'tags': tags})
+        offset, = struct.unpack(endian + offset_fmt, data[entry_count * entry_size:entry_count * entry_size + inline_size])
+    return header, ifds
+
+
+def _values(reader, header, ifd, tag):
+    """
+    Return the tuple of values of a tag, reading them from the file if they are not inline in the IFD
+    """
+    value = ifd['tags'].get(tag)
+    if isinstance(value, dict):
+        value = _unpack(reader, header['endian'], value['offset'], FIELD_TYPES[value['type']] * value['count'])
+        ifd['tags'][tag] = value
+    return value
+
+
+def _first_value(reader, header, ifd, tag):
+    values = _values(reader, header, ifd, tag)
+    return values[0] if values else None
+
+
+def validate(reader):
+    """
+    Validate the COG layout of the file of reader
+    :return: report dict {'path', 'valid', 'errors', 'warnings', 'width', 'height', 'blocksize', 'overviews',
+             'requests', 'bytes_read'}
+    """
+    errors, warnings = [], []
+    report = {'path': reader.name, 'valid': False, 'errors': errors, 'warnings': warnings}
+    try:
+        header, ifds = read_ifds(reader)
+    except (ValueError, EOFError, struct.error) as e:
+        errors.append(f'Cannot read the TIFF structure: {e}')
+        report.update(requests=reader.requests, bytes_read=reader.bytes_read)
+        return report
+
+    images, masks = [], []
+    for ifd in ifds:
+        subfile_type = _first_value(reader, header, ifd, NEW_SUBFILE_TYPE) or 0
+        (masks if subfile_type & MASK else images).append(ifd)
+    if not images:
+        errors.append('The file has no image IFD')
+        report.update(requests=reader.requests, bytes_read=reader.bytes_read)
+        return report
+    main = images[0]
+    width = _first_value(reader, header, main, IMAGE_WIDTH)
+    height = _first_value(reader, header, main, IMAGE_LENGTH)
+    if width is None or height is None:
+        errors.append('The main IFD has no ImageWidth or ImageLength')
+        report.update(requests=reader.requests, bytes_read=reader.bytes_read)
+        return report
+    tiled = TILE_WIDTH in main['tags']
+    report.update(width=width, height=height,
+                  blocksize=[_first_value(reader, header, main, TILE_WIDTH), _first_value(reader, header, main, TILE_LENGTH)] if tiled else None)
+
+    # Main IFD right after the header, or the ghost area
+    expected = header.get('ghost_end', header['header_size'])
+    # IFDs start on a word boundary
+    expected += expected % 2
+    if header['first_ifd'] != expected:
+        errors.append(f'The offset of the main IFD should be {expected}. It is {header["first_ifd"]} instead')
+    if header['ghost'] is not None:
+        if 'LAYOUT=IFDS_BEFORE_DATA' not in header['ghost']:
+            warnings.append('The GDAL structural metadata does not declare LAYOUT=IFDS_BEFORE_DATA')
+    if not tiled and (width > 512 or height > 512):
+        errors.append('The file is greater than 512xH or Wx512, but is not tiled')
+
+    overviews = images[1:]
+    report['overviews'] = []
+    if not overviews and (width > 512 or height > 512):
+        warnings.append('The file is greater than 512xH or Wx512, it is recommended to include internal overviews')
+    previous_width = width
+    for i, ifd in enumerate(overviews):
+        ovr_width = _first_value(reader, header, ifd, IMAGE_WIDTH)
+        ovr_height = _first_value(reader, header, ifd, IMAGE_LENGTH)
+        report['overviews'].append([ovr_width, ovr_height])
+        if not (_first_value(reader, header, ifd, NEW_SUBFILE_TYPE) or 0) & REDUCED_IMAGE:
+            errors.append(f'Overview of index {i} is not a reduced image, its NewSubfileType is not set to reduced image')
+        if TILE_WIDTH not in ifd['tags']:
+            errors.append(f'Overview of index {i} is not tiled')
+        if ovr_width >= previous_width:
+            errors.append(f'Overview of index {i} is not smaller than the previous image, {ovr_width} >= {previous_width}')
+        previous_width = ovr_width
+
+    # IFDs in increasing offset, all before the image data
+    ifd_offsets = [ifd['offset'] for ifd in ifds]
+    for i in range(1, len(ifd_offsets)):
+        if ifd_offsets[i] < ifd_offsets[i - 1]:
+            errors.append(f'The offset of the IFD of index {i} is {ifd_offsets[i]}, '
+                          f'whereas it should be greater than the one of index {i - 1}, which is at byte {ifd_offsets[i - 1]}')
+
+    # Image data from the smallest overview to the full resolution, the tiles of every image in order
+    first_offsets = []
+    for ifd in images:
+        offsets = _values(reader, header, ifd, TILE_OFFSETS if TILE_WIDTH in ifd['tags'] else STRIP_OFFSETS) or ()
+        byte_counts = _values(reader, header, ifd, TILE_BYTE_COUNTS) if TILE_WIDTH in ifd['tags'] else None
+        data = [offset for j, offset in enumerate(offsets) if offset and (byte_counts is None or byte_counts[j])]
+        first_offsets.append(data[0] if data else None)
+        if any(data[j] < data[j - 1] for j in range(1, len(data))):
+            name = 'main resolution image' if ifd is main else f'overview of index {images.index(ifd) - 1}'
+            errors.append(f'The tiles of the {name} are not in increasing offset')
+    if first_offsets[0] is not None and first_offsets[0] < max(ifd_offsets):
+        errors.append('The image data of the main resolution image is before the last IFD, the IFDs should be before the data')
+    for i in range(len(overviews)):
+        current, smaller = first_offsets[i + 1], (first_offsets[i + 2] if i + 2 < len(first_offsets) else None)
+        if smaller is not None and current is not None and current < smaller:
+            errors.append(f'The offset of the first block of overview of index {i} should be after the one of the overview of index {i + 1}')
+    if overviews and first_offsets[0] is not None and first_offsets[1] is not None and first_offsets[0] < first_offsets[1]:
+        errors.append('The offset of the first block of the main resolution image should be after the one of the overview of index 0')
+
+    report.update(valid=not errors, requests=reader.requests, bytes_read=reader.bytes_read)
+    return report
+
+
+def validate_cog(path, s3_client=None):
+    """
+    Validate a local COG, an s3://bucket/key url or a GDAL /vsi path
+    :return: report dict, see validate
+    """
+    reader = open_reader(path, s3_client=s3_client)
+    try:
+        return validate(reader)
+    finally:
+        reader.close()
+
+
+def cog_validate(src_path):
+    """
+    Same result as rio_cogeo.cogeo.cog_validate: (is_valid, errors, warnings)
+    """
+    report = validate_cog(src_path)
+    return report['valid'], report['errors'], report['warnings']
+
+
+def audit(bucket_name, folder_path, workers=16, report_path=None):
+    """
+    Validate every .tif under an S3 prefix with ranged reads, on a pool of workers threads
+    :param bucket_name: name of the bucket
+    :param folder_path: S3 prefix of the COGs, e.g. 'Datacube/RiverIce/cog/'
+    :param report_path: optional local JSON file of the report
+    :return: report dict {'bucket_name', 'folder_path', 'summary', 'files': list of the reports of validate}
+    """
+    from s3_operations import get_s3_client, iter_s3_objects
+    s3_client = get_s3_client()
+    start = time.perf_counter()
+    keys = [obj['key'] for obj in iter_s3_objects(bucket_name, folder_path) if obj['key'].lower().endswith(('.tif', '.tiff'))]
+    print(f'{len(keys)} Geotiffs to validate in {bucket_name}/{folder_path}')
+    files = []
+    lock = threading.Lock()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(validate_cog, f's3://{bucket_name}/{key}', s3_client): key for key in keys}
+        for future in as_completed(futures):
+            try:
+                file_report = future.result()
+            except Exception as e:
+                file_report = {'path': f's3://{bucket_name}/{futures[future]}', 'valid': False,
+                               'errors': [f'Cannot read the file: {e!r}'], 'warnings': []}
+            with lock:
+                files.append(file_report)
+            if not file_report['valid']:
+                print(f'{file_report["path"]} is not a valid cloud optimized GeoTIFF: {file_report["errors"]}')
+    files.sort(key=lambda file_report: file_report['path'])
+    summary = {
+        'files': len(files),
+        'valid': sum(1 for file_report in files if file_report['valid']),
+        'invalid': sum(1 for file_report in files if not file_report['valid']),
+        'with_warnings': sum(1 for file_report in files if file_report['warnings']),
+        'bytes_read': sum(file_report.get('bytes_read', 0) for file_report in files),
+        'seconds': round(time.perf_counter() - start, 2),
+    }
+    print(f'{summary["valid"]} valid and {summary["invalid"]} invalid COGs, {summary["bytes_read"] / 1e6:.1f} MB read '
+          f'in {summary["seconds"]} seconds')
+    report = {'bucket_name': bucket_name, 'folder_path': folder_path, 'summary': summary, 'files': files}
+    if report_path:
+        with open(report_path, 'w') as file:
+            json.dump(report, file, indent=2)
+        print(f'Report written to {report_path}')
+    return report
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Validate cloud optimized GeoTIFFs from their header and IFDs.')
+    subparsers = parser.add_subparsers(dest='command')
+    check = subparsers.add_parser('validate', help='Validate local COGs or s3://bucket/key urls')
+    check.add_argument('paths', nargs='+', help='Local paths or s3://bucket/key urls')
+    audit_parser = subparsers.add_parser('audit', help='Validate every COG under an S3 prefix')
+    audit_parser.add_argument('bucket_name', type=str, help='Bucket name')
+    audit_parser.add_argument('folder_path', type=str, help="Prefix of the COGs, e.g. 'Datacube/RiverIce/cog/'")
+    audit_parser.add_argument('--workers', type=int, default=16, help='Number of COGs validated at the same time')
+    audit_parser.add_argument('--report', type=str, default='audit_report.json', help='Local JSON file of the report')
+    args = parser.parse_args()
+
+    if args.command == 'validate':
+        for path in args.paths:
+            print(json.dumps(validate_cog(path), indent=2))
+    elif args.command == 'audit':
+        audit(args.bucket_name, args.folder_path, workers=args.workers, report_path=args.report)
+    else:
+        parser.print_help()
+"""
+# Run the scripts from the termial
+python cog_validator.py validate Test/tiff/RiverIce_CAN_ON_Moose_20160503_232950_cog.tif
+python cog_validator.py audit nrcan-egs-product-archive Datacube/RiverIce/cog/ --workers 16 --report audit_report.json
+"""
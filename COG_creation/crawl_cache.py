@@ -0,0 +1,86 @@
+import json
+import os
+import threading
+
+from get_zip_links import parse_hrefs
+"""
+On-disk cache of the EGS directory listings, keyed by listing url.
+Each entry keeps the hrefs of the page and its ETag/Last-Modified validators, so a page is revalidated
+with a conditional GET and only downloaded and parsed again when it changed.
+"""
+
+
+class CrawlCache:
+    def __init__(self, cache_path, refresh=False):
+        """
+        :param cache_path: local JSON file of the cache, created on save if it does not exist
+        :param refresh: ignore the cached entries and download every listing again, the cache is still rewritten
+        """
+        self.cache_path = cache_path
+        self.refresh = refresh
+        self.entries = {}
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        if os.path.exists(cache_path) and not refresh:
+            with open(cache_path, 'r') as file:
+                self.entries = json.load(file)
+            print(f'{len(self.entries)} listings loaded from the crawl cache {cache_path}')
+
+    def cached_hrefs(self, url):
+        """
+        Return the cached hrefs of a listing without any request, None if the url is not cached
+        """
+        with self._lock:
+            entry = self.entries.get(url)
+            if entry is None:
+                return None
+            self.hits += 1
+        return entry['hrefs']
+
+    def list_hrefs(self, session, url, timeout=60):
+        """
+        Return the hrefs of a listing page, revalidating the cached entry with a conditional GET
+        :return (hrefs, unchanged), unchanged is True when the server answered 304 Not Modified
+        """
+        with self._lock:
+            entry = self.entries.get(url)
+        headers = {}
+        if entry:
+            if entry.get('etag'):
+                headers['If-None-Match'] = entry['etag']
+            if entry.get('last_modified'):
+                headers['If-Modified-Since'] = entry['last_modified']
+        response = session.get(url, headers=headers, timeout=timeout)
+        if response.status_code == 304 and entry:
+            with self._lock:
+                self.hits += 1
+            return entry['hrefs'], True
+        with self._lock:
+            self.misses += 1
+        if response.status_code == 404:
+            with self._lock:
+                self.entries.pop(url, None)
+            return [], False
+        response.raise_for_status()
+        hrefs = parse_hrefs(response.content)
+        with self._lock:
+            self.entries[url] = {'hrefs': hrefs,
+                                 'etag': response.headers.get('ETag'),
+                                 'last_modified': response.headers.get('Last-Modified')}
+        return hrefs, False
+
+    def save(self):
+        """
+        Write the cache to cache_path, through a temporary file so an interrupted run keeps the previous cache
+        """
+        with self._lock:
+            content = json.dumps(self.entries)
+        folder = os.path.dirname(self.cache_path)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        tmp_path = self.cache_path + '.tmp'
+        with open(tmp_path, 'w') as file:
+            file.write(content)
+        os.replace(tmp_path, self.cache_path)
+        print(f'Crawl cache saved to {self.cache_path}: {self.hits} listings reused, {self.misses} downloaded')
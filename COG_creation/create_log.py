@@ -5,39 +5,46 @@ import requests
 import json 
 
 from get_zip_links import * 
-from s3_operations import list_files_in_s3,upload_fileContent_to_s3
+from crawl_cache import CrawlCache
+from state_index import load_state_index
+from s3_inventory import S3Inventory
+from s3_operations import upload_fileContent_to_s3, upload_contents_to_s3
 
 # Test 1: cross check zip_links and cog_list
 bucket_name = 'nrcan-egs-product-archive'
 root_url = 'https://data.eodms-sgdot.nrcan-rncan.gc.ca'
 years = [year for year in range(2005, 2024)]   
 keyword = 'RiverIce' 
-zip_links = []
-for year in years: 
-    links = get_zip_links(root_url, year, keyword)
-    zip_links.extend(links)
+# Shared with main.py, the listings unchanged since the last run are not downloaded again 
+crawl_cache = CrawlCache('crawl_cache.json')
+zip_links = list(crawl_zip_links(root_url, years, [keyword], cache=crawl_cache))
 print(len(zip_links))
 
 
-# Test2: 
-log_content = ' '
-cog_list =  list_files_in_s3(bucket_name, folder_path= 'Datacube/RiverIce/cog')
+# Test2: record the links with an existing cog in manifest.jsonl, and log.txt for the tools still reading it. 
+# The index is loaded from S3 with its deltas, so only the links without any record get a stub 
+state_index = load_state_index(bucket_name, 'Datacube/RiverIce/', 'manifest.jsonl')
+inventory = S3Inventory(bucket_name)
+cog_list = inventory.names('Datacube/RiverIce/cog/')
 for link in zip_links: 
     filename =link.split('/')[-1]
     filename = filename.replace('.zip', '.tif')
-    if filename in cog_list: 
+    if filename in cog_list and link not in state_index: 
         print(f'{link} is in the cog_list')
-        log_content = log_content + '\n' + link
+        state_index.add(link, sync=False, cog_key=cog_list[filename], source='create_log.py')
         
-print(len(log_content))
-upload_fileContent_to_s3(bucket_name, file_key='Datacube/RiverIce/' + 'log.txt', file_content=log_content)
+print(len(state_index))
+state_index.publish()
+upload_fileContent_to_s3(bucket_name, file_key='Datacube/RiverIce/' + 'log.txt', file_content=state_index.log_text())
 
-# Test3  - put the zip url as json in S3 bucket
+# Test3  - put the zip url as json in S3 bucket, only the JSONs that are new or changed are uploaded, 16 at a time 
+sidecars = {}
 for link in zip_links: 
     data = {
     'River Ice product url': link
     }
-    json_object = json.dumps(data, indent=4)
     filename =link.split('/')[-1]
     filename = filename.replace('.zip', '.json')
-    upload_fileContent_to_s3(bucket_name, file_key='Datacube/RiverIce/json/' + filename, file_content=json_object)
+    sidecars['Datacube/RiverIce/json/' + filename] = json.dumps(data, indent=4)
+report = upload_contents_to_s3(bucket_name, sidecars, existing=inventory.keys('Datacube/RiverIce/json/'), max_workers=16)
+print(f"{report['skipped']} sidecar JSONs skipped, {report['uploaded']} uploaded, {len(report['failed'])} failed")
@@ -2,42 +2,187 @@ from osgeo import gdal
 import math
 import argparse
 import os
+import shutil
+import tempfile
+from concurrent.futures import ProcessPoolExecutor, as_completed
 """
 script adopted from Data_conversion/tools/create_thumbnail · master · datacube / prepare-ingest · GitLab (ssc-spc.gc.ca).
+The thumbnails are read from the smallest internal overview of the COG that is still at least the thumbnail size,
+so the full resolution is never decoded. They run on a pool of processes over a local folder or an S3 prefix,
+or as a stage of the pipeline in main.py, and are uploaded next to the COG in cog/.
 """
-"""
-parser = argparse.ArgumentParser(description="Define variable")
-parser.add_argument("-c", "--cog_path", type=str, help="Path of the folder containing the input cogs", required=True)
-args = parser.parse_args()
+THUMBNAIL_SIZE = 600
+FORMATS = {'png': ('PNG', '.png'), 'webp': ('WEBP', '.webp')}
 
-directory = args.cog_path
-"""
-directory = 'C:/Users/xcai/Documents/EGS_projects/RiverIce/cog/'
-def create_thumbnail(raster):
+
+def thumbnail_size(width, height, max_size=THUMBNAIL_SIZE):
+    """
+    Return (width, height) of the thumbnail, the longest side is max_size and the aspect ratio is kept
+    """
+    if width >= height:
+        return max_size, max(1, math.ceil(max_size * height / width))
+    return max(1, math.ceil(max_size * width / height)), max_size
+
+
+def overview_level(band, width):
+    """
+    Return the index of the smallest overview of the band whose width is still at least the thumbnail width,
+    None to read the full resolution when the raster has no overview larger than the thumbnail
+    """
+    level = None
+    for i in range(band.GetOverviewCount()):
+        if band.GetOverview(i).XSize >= width:
+            level = i
+    return level
+
+
+def thumbnail_path(cog_path, format='png'):
+    """
+    Return the thumbnail path or key of a COG path or key: RiverIce_..._cog.tif -> RiverIce_..._cog.png
+    """
+    return os.path.splitext(cog_path)[0] + FORMATS[format][1]
+
+
+def create_thumbnail(raster, rasterOut, max_size=THUMBNAIL_SIZE, format='png'):
+    """
+    Create the thumbnail of a COG from its overviews
+    :param raster: path of the COG, a local path or a GDAL virtual path like /vsis3/bucket/key
+    :param rasterOut: path of the PNG or WebP thumbnail
+    :param max_size: size in pixels of the longest side of the thumbnail
+    :param format: 'png' or 'webp'
+    :return: rasterOut
+    """
     rds = gdal.Open(raster)
-    height = rds.RasterYSize
-    width = rds.RasterXSize
-    new_height = math.ceil(600*height/width)
-    if new_height > 600: 
-        new_height = 600
-    print(new_height)
+    if rds is None:
+        raise RuntimeError(f'GDAL could not open {raster}')
+    band = rds.GetRasterBand(1)
+    width, height = thumbnail_size(rds.RasterXSize, rds.RasterYSize, max_size)
+    level = overview_level(band, width)
+    color_table = band.GetColorTable() is not None
+    data_type = band.DataType
+    band_count = rds.RasterCount
+    rds = None
+    if level is not None:
+        rds = gdal.OpenEx(raster, gdal.OF_RASTER, open_options=[f'OVERVIEW_LEVEL={level}'])
+    else:
+        rds = gdal.Open(raster)
+    driver, _ = FORMATS[format]
     kwargs = {
-    'height': 'new_height',
-    'width': '600'
+        'format': driver,
+        'width': width,
+        'height': height,
+        'resampleAlg': 'nearest' if color_table else 'average',
     }
-    
-    gdal.Translate(rasterOut,raster,**kwargs)
-
-for file in os.listdir(directory):
-    
-    raster = os.path.join(directory,file)
-    
-    print (raster)
-    
-    #directoryOut = directory.replace('-cog','-thumbnail')
-    rasterOut = os.path.join(directory,file)
-    rasterOut = rasterOut.replace('.tif','.png')
-    
-    print (rasterOut)
-    
-    create_thumbnail(raster)
+    if data_type != gdal.GDT_Byte:
+        # Stretch the values to 0-255, PNG and WebP thumbnails are 8 bits
+        kwargs['outputType'] = gdal.GDT_Byte
+        kwargs['scaleParams'] = [[]]
+    if format == 'webp':
+        # WebP only takes RGB or RGBA
+        if color_table:
+            kwargs['rgbExpand'] = 'rgba'
+        elif band_count < 3:
+            kwargs['bandList'] = [1, 1, 1]
+    out = gdal.Translate(rasterOut, rds, **kwargs)
+    if out is None:
+        raise RuntimeError(f'GDAL could not create {rasterOut}')
+    out = None
+    rds = None
+    # Remove the .aux.xml GDAL writes next to a PNG with a georeference
+    if os.path.exists(rasterOut + '.aux.xml'):
+        os.remove(rasterOut + '.aux.xml')
+    return rasterOut
+
+
+def s3_thumbnail(cog_key, bucket_name, max_size=THUMBNAIL_SIZE, format='png'):
+    """
+    Create the thumbnail of a COG in S3, reading only its overviews through /vsis3/, and upload it next to the COG
+    :return: key of the thumbnail
+    """
+    from geotiff_to_cog import use_s3_endpoint
+    from s3_operations import upload_file_to_s3
+    use_s3_endpoint()
+    work_dir = tempfile.mkdtemp(prefix='thumbnail_')
+    try:
+        key = thumbnail_path(cog_key, format)
+        folder_path, _, file_name = key.rpartition('/')
+        local_path = create_thumbnail(f'/vsis3/{bucket_name}/{cog_key}', os.path.join(work_dir, file_name), max_size, format)
+        if not upload_file_to_s3(bucket_name, folder_path + '/', local_path, file_name):
+            raise RuntimeError(f'Failed to upload {key} to {bucket_name}')
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return key
+
+
+def create_thumbnails(task, items, workers=4, **kwargs):
+    """
+    Run task(item, **kwargs) on a pool of workers processes, a failed item is reported and does not stop the others
+    :return: dict item -> result, None for the failed items
+    """
+    results = {}
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(task, item, **kwargs): item for item in items}
+        for future in as_completed(futures):
+            item = futures[future]
+            try:
+                results[item] = future.result()
+                print(f'{results[item]} created')
+            except Exception as e:
+                results[item] = None
+                print(f'Failed to create the thumbnail of {item}: {e!r}')
+    print(f'{sum(1 for result in results.values() if result)} thumbnails created, '
+          f'{sum(1 for result in results.values() if not result)} failed')
+    return results
+
+
+def local_thumbnail(raster, output_dir=None, max_size=THUMBNAIL_SIZE, format='png'):
+    rasterOut = thumbnail_path(raster, format)
+    if output_dir:
+        rasterOut = os.path.join(output_dir, os.path.basename(rasterOut))
+    return create_thumbnail(raster, rasterOut, max_size, format)
+
+
+def directory_thumbnails(directory, output_dir=None, workers=4, max_size=THUMBNAIL_SIZE, format='png'):
+    """
+    Create the thumbnails of every .tif of a local folder, next to the COGs or in output_dir
+    """
+    if output_dir:
+        os.makedirs(output_dir, exist_ok=True)
+    rasters = sorted(os.path.join(directory, file) for file in os.listdir(directory) if file.endswith('.tif'))
+    return create_thumbnails(local_thumbnail, rasters, workers, output_dir=output_dir, max_size=max_size, format=format)
+
+
+def prefix_thumbnails(bucket_name, folder_path, workers=4, max_size=THUMBNAIL_SIZE, format='png', overwrite=False):
+    """
+    Create and upload the thumbnails of every COG under an S3 prefix, e.g. 'Datacube/RiverIce/cog/'.
+    The COGs that already have a thumbnail are skipped unless overwrite is set.
+    """
+    from s3_inventory import S3Inventory
+    keys = S3Inventory(bucket_name).keys(folder_path)
+    cog_keys = sorted(key for key in keys if key.endswith('.tif') and (overwrite or thumbnail_path(key, format) not in keys))
+    print(f'{len(cog_keys)} COGs without a thumbnail in {bucket_name}/{folder_path}')
+    return create_thumbnails(s3_thumbnail, cog_keys, workers, bucket_name=bucket_name, max_size=max_size, format=format)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Create the thumbnails of COGs from their overviews.')
+    parser.add_argument('-c', '--cog_path', type=str, help='Path of the folder containing the input cogs')
+    parser.add_argument('-o', '--output_path', type=str, default=None, help='Folder of the thumbnails, next to the cogs by default')
+    parser.add_argument('--bucket', type=str, default=None, help='Bucket of the cogs, --cog_path is then an S3 prefix like Datacube/RiverIce/cog/')
+    parser.add_argument('--format', choices=sorted(FORMATS), default='png', help='Format of the thumbnails')
+    parser.add_argument('--size', type=int, default=THUMBNAIL_SIZE, help='Size in pixels of the longest side of the thumbnails')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help='Number of processes')
+    parser.add_argument('--overwrite', action='store_true', help='Create the thumbnails that already exist in S3 again')
+    args = parser.parse_args()
+    if args.cog_path is None:
+        parser.error('--cog_path is required')
+    if args.bucket:
+        prefix_thumbnails(args.bucket, args.cog_path, workers=args.workers, max_size=args.size, format=args.format, overwrite=args.overwrite)
+    else:
+        directory_thumbnails(args.cog_path, args.output_path, workers=args.workers, max_size=args.size, format=args.format)
+"""
+# Run the scripts from the termial
+python create_thumbnail.py -c C:/Users/xcai/Documents/EGS_projects/RiverIce/cog/
+# Every COG of the bucket without a thumbnail, as WebP
+python create_thumbnail.py --bucket nrcan-egs-product-archive -c Datacube/RiverIce/cog/ --format webp --workers 8
+"""
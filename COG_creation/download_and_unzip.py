@@ -1,34 +1,239 @@
+import email.utils
 import requests
 import os 
+import time
 import zipfile
+from datetime import datetime, timezone
 
-def download_and_unzip(zip_url, zip_dir): 
+from archive_cache import file_sha256
+
+# Size of the chunks written to disk while downloading, only one chunk is held in memory at a time 
+CHUNK_SIZE = 1024 * 1024
+
+class IncompleteDownload(Exception): 
     """
-    Given a URL link, download the zip file, unzip to a local folder with the same filename 
-    :param zip_url: a full url path to the .zip fi;e 
+    The downloaded file does not have the size announced by the server, or is not a valid zip 
+    """
+
+
+class RetryableResponse(Exception): 
+    """
+    The server answered with a transient error status, retry_after is its Retry-After delay in seconds if any 
+    """
+    def __init__(self, message, retry_after=None): 
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+# HTTP status answered by the server when it is busy or temporarily failing 
+RETRY_STATUS = (429, 500, 502, 503, 504)
+
+def _retry_after_seconds(value): 
+    """
+    Parse a Retry-After header given in seconds or as an HTTP date, None if it is missing or invalid 
+    """
+    if not value: 
+        return None
+    if value.strip().isdigit(): 
+        return int(value)
+    try: 
+        retry_date = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError): 
+        return None
+    return max(0, (retry_date - datetime.now(timezone.utc)).total_seconds())
+
+def _total_size(response, offset): 
+    """
+    Return the full size of the file from the Content-Range or Content-Length headers, None if unknown 
+    """
+    content_range = response.headers.get('Content-Range')
+    if content_range and '/' in content_range and not content_range.endswith('/*'): 
+        return int(content_range.split('/')[-1])
+    content_length = response.headers.get('Content-Length')
+    if content_length is not None: 
+        return offset + int(content_length)
+    return None
+
+def _part_validator(response): 
+    """
+    Return the If-Range value of a response, its strong ETag or its Last-Modified, None if it has neither 
+    """
+    etag = response.headers.get('ETag')
+    if etag and not etag.startswith('W/'): 
+        return etag
+    return response.headers.get('Last-Modified')
+
+def _remove(*paths): 
+    for path in paths: 
+        if os.path.exists(path): 
+            os.remove(path)
+
+def verify_zip(zip_file_path, expected_size=None): 
+    """
+    Check the size of the zip and the CRC of every member, raise IncompleteDownload if any of them is wrong 
+    """
+    size = os.path.getsize(zip_file_path)
+    if expected_size is not None and size != expected_size: 
+        raise IncompleteDownload(f'{zip_file_path} has {size} bytes, {expected_size} expected')
+    try: 
+        with zipfile.ZipFile(zip_file_path, 'r') as zip_ref: 
+            bad_member = zip_ref.testzip()
+    except zipfile.BadZipFile as e: 
+        raise IncompleteDownload(f'{zip_file_path} is not a valid zip: {e}')
+    if bad_member is not None: 
+        raise IncompleteDownload(f'{zip_file_path} has a bad CRC for {bad_member}')
+
+def download_zip(zip_url, zip_dir, chunk_size=CHUNK_SIZE, session=None, retries=5, backoff=1, timeout=60, cache=None, stats=None, etag=None): 
+    """
+    Given a URL link, stream the zip file to zip_dir in chunks, without holding the whole archive in memory 
+    The zip is written to a .part file first. After a dropped connection or a transient error status, the download 
+    resumes from the end of the .part file with an HTTP Range request, waiting backoff * 2**attempt seconds or the 
+    Retry-After of the server. The ETag or Last-Modified of the response that started the .part file is kept in a 
+    .part.validator file and sent as If-Range, so a zip changed on the server is sent in full (200) and downloaded 
+    again instead of appended to the old bytes. The size and the zip CRCs are checked before the .part file is 
+    renamed to the zip. 
+    :param zip_url: a full url path to the .zip file 
     :param zip_dir: a folder name to save the zip downloads, a path will be created locally use the zip_dir
+    :param chunk_size: number of bytes read from the response and written to disk at a time 
+    :param session: optional requests Session to reuse its connections 
+    :param retries: number of retries after the first attempt 
+    :param backoff: delay in seconds before the first retry, doubled at every retry 
+    :param timeout: seconds to wait for the server to connect or send data 
+    :param cache: optional ArchiveCache, a cached archive is not downloaded again and a new one is added to it 
+    :param stats: optional dict filled with 'bytes' downloaded, 'retries', 'from_cache', 'size', 'sha256' and 'etag' 
+    :param etag: optional current ETag of the zip, a cached archive with another ETag is downloaded again 
+    :return the local path of the zip file 
     """
     # Make temporary directory to save the zip downloads  
-    if not os.path.exists(zip_dir): 
-        os.makedirs(zip_dir, exist_ok=True)
-        print("Directory created successfully!")
-    else:     
-        print("Directory already exists.")
-    # Download the zip file 
-    filename = os.path.join(zip_url.split('/')[-1])
+    os.makedirs(zip_dir, exist_ok=True)
+    filename = zip_url.split('/')[-1]
     zip_file_path = os.path.join(zip_dir, filename)
-    response = requests.get(zip_url)
-    # try-except 
-    with open(zip_file_path, 'wb') as file:
-        file.write(response.content)
+    part_path = zip_file_path + '.part'
+    validator_path = part_path + '.validator'
+    stats = stats if stats is not None else {}
+    stats.update({'bytes': 0, 'retries': 0, 'from_cache': False})
+    if cache is not None: 
+        record = cache.get(zip_url, zip_file_path, etag=etag)
+        if record: 
+            print(f'{filename} found in the archive cache')
+            stats.update({'from_cache': True, 'size': record['size'], 'sha256': record['sha256'], 'etag': record['etag']})
+            return zip_file_path
+    http = session or requests
+    response_etag = None
+    attempt = 0
+    while True: 
+        offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+        total = None
+        headers = {'Range': f'bytes={offset}-'} if offset else {}
+        if offset and os.path.exists(validator_path): 
+            with open(validator_path, 'r') as file: 
+                headers['If-Range'] = file.read()
+        try: 
+            with http.get(zip_url, headers=headers, stream=True, timeout=timeout) as response: 
+                if response.status_code in RETRY_STATUS: 
+                    raise RetryableResponse(f'{zip_url} answered {response.status_code}', 
+                                            _retry_after_seconds(response.headers.get('Retry-After')))
+                if response.status_code == 416: 
+                    # The .part file is already complete, or the archive changed on the server 
+                    total = offset
+                else: 
+                    response.raise_for_status()
+                    if response.status_code != 206: 
+                        # The server ignored the Range, or the zip changed since the .part file, the download starts over 
+                        offset = 0
+                        validator = _part_validator(response)
+                        _remove(validator_path)
+                        if validator: 
+                            with open(validator_path, 'w') as file: 
+                                file.write(validator)
+                    total = _total_size(response, offset)
+                    response_etag = response.headers.get('ETag', response_etag)
+                    with open(part_path, 'ab' if offset else 'wb') as file:
+                        for chunk in response.iter_content(chunk_size=chunk_size): 
+                            file.write(chunk)
+                            stats['bytes'] += len(chunk)
+            verify_zip(part_path, expected_size=total)
+            break
+        except (requests.RequestException, IncompleteDownload, RetryableResponse) as e: 
+            if isinstance(e, IncompleteDownload) and os.path.exists(part_path) and total is not None \
+                    and os.path.getsize(part_path) >= total: 
+                # Complete but corrupted, start again from an empty file 
+                _remove(part_path, validator_path)
+            attempt += 1
+            if attempt > retries: 
+                raise
+            delay = getattr(e, 'retry_after', None)
+            delay = backoff * 2 ** (attempt - 1) if delay is None else delay
+            print(f'Download of {filename} failed ({e}), retry {attempt}/{retries} in {delay:.0f}s')
+            stats['retries'] = attempt
+            time.sleep(delay)
+    os.replace(part_path, zip_file_path)
+    _remove(validator_path)
+    stats.update({'size': os.path.getsize(zip_file_path), 'etag': response_etag})
+    if cache is not None: 
+        stats['sha256'] = cache.add(zip_url, zip_file_path, etag=response_etag)['sha256']
+    else: 
+        stats['sha256'] = file_sha256(zip_file_path)
+    return zip_file_path
 
-    # Unzip 
+def extract_members(zip_file_path, unzip_dir, keyword=None, format=None): 
+    """
+    Extract the members of the zip whose filename contains the keyword and ends with format, all the members if both are None 
+    :param zip_file_path: local path of the zip file 
+    :param unzip_dir: folder to extract the members to 
+    :return a list of the extracted file paths 
+    """
+    os.makedirs(unzip_dir, exist_ok=True)
+    extracted = []
     with zipfile.ZipFile(zip_file_path, 'r') as zip_ref:
-        unzip_dir = os.path.join(zip_dir, filename[:-4]) 
-        os.makedirs(unzip_dir, exist_ok=True)
-        zip_ref.extractall(unzip_dir)
+        for info in zip_ref.infolist(): 
+            name = os.path.basename(info.filename)
+            if info.is_dir() or (keyword and keyword not in name) or (format and not name.endswith(format)): 
+                continue
+            extracted.append(zip_ref.extract(info, unzip_dir))
+    return extracted
+
+def download_and_unzip(zip_url, zip_dir, keyword=None, format=None, **download_options): 
+    """
+    Given a URL link, download the zip file, unzip to a local folder with the same filename 
+    The zip is streamed to disk, and when keyword or format are given only the matching members are extracted 
+    :param zip_url: a full url path to the .zip fi;e 
+    :param zip_dir: a folder name to save the zip downloads, a path will be created locally use the zip_dir
+    :param keyword: optional, only extract the members whose filename contains the keyword 
+    :param format: optional, only extract the members with this file extension, e.g. '.tif'
+    :param download_options: passed to download_zip, e.g. retries, cache or stats 
+    """
+    zip_file_path = download_zip(zip_url, zip_dir, **download_options)
+    # Unzip 
+    unzip_dir = zip_file_path[:-4]
+    extract_members(zip_file_path, unzip_dir, keyword=keyword, format=format)
     return unzip_dir
 
+def vsizip_geotiff_path(zip_path, format, keyword): 
+    """
+    Given a local zip path or a zip url, return the Geotiff filenames and the GDAL paths to read them inside the zip, 
+    through /vsizip/ for a local zip or /vsizip//vsicurl/ for a url, so nothing needs to be extracted 
+    :param zip_path: local path of the zip file or full url of the zip 
+    :param format: file format for the search, in this case is .tif
+    :param keyword: only keep the members whose filename contains the keyword 
+    """
+    if zip_path.startswith(('http://', 'https://')): 
+        from osgeo import gdal
+        vsi_root = '/vsizip//vsicurl/' + zip_path
+        members = gdal.ReadDirRecursive(vsi_root) or []
+    else: 
+        vsi_root = '/vsizip/' + os.path.abspath(zip_path).replace(os.sep, '/')
+        with zipfile.ZipFile(zip_path, 'r') as zip_ref:
+            members = zip_ref.namelist()
+    geotiff_filenames = []
+    geotiff_paths = []
+    for member in members: 
+        name = member.split('/')[-1]
+        if keyword in name and name.endswith(format): 
+            geotiff_filenames.append(name)
+            geotiff_paths.append(vsi_root + '/' + member)
+    return (geotiff_filenames, geotiff_paths)
+
 def geotiff_path(unzip_dir, format, keyword): 
 
     """
@@ -53,10 +258,14 @@ def geotiff_path(unzip_dir, format, keyword):
 # Test 
 zip_url = 'https://data.eodms-sgdot.nrcan-rncan.gc.ca/public/EGS/2016/RiverIce/CAN/ON/RiverIce_CAN_ON_Attawapiskat_20160420_114518.zip'
 zip_dir = 'zip_test'
-unzip_dir = download_and_unzip(zip_url, zip_dir)
+unzip_dir = download_and_unzip(zip_url, zip_dir, keyword='RiverIce', format='.tif')
 print('unzip_dir is: {}'.format(unzip_dir))
 
 geotiff_filenames, geotif_paths =  geotiff_path(unzip_dir=unzip_dir, format='.tif', keyword='RiverIce')
 print(geotiff_filenames)
 print(geotif_paths)
+
+# Read the Geotiff in place, without extracting it 
+geotiff_filenames, geotif_paths = vsizip_geotiff_path(unzip_dir + '.zip', format='.tif', keyword='RiverIce')
+geotiff_filenames, geotif_paths = vsizip_geotiff_path(zip_url, format='.tif', keyword='RiverIce')
 """
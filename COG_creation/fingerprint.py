@@ -0,0 +1,110 @@
+import hashlib
+import json
+
+import requests
+"""
+Fingerprints of the processed links, to reprocess only the outputs that are out of date.
+A fingerprint is kept in the record of every link in manifest.jsonl:
+    {"config": hash of the processing parameters, "etag": ETag of the zip, "size": size of the zip}
+A link is processed again when the parameters of the run hash differently, e.g. after a change of proj_epsg, xRes/yRes
+or compression, or, with check_source, when a HEAD request shows that its zip changed on the EGS server.
+The records written before the fingerprints (e.g. migrated from log.txt) are considered up to date. They get a
+legacy fingerprint, {"config": "legacy", "assumed": hash of the run that found them}, so they stay distinct from the
+links really processed with those parameters, and the next parameter change rebuilds them too.
+Only the parameters that change the pixels are hashed: --two-step writes the same COG through an intermediate file.
+The CRC of the zip members is left out of the fingerprint on purpose: a HEAD request does not give it, and reading it
+from the central directory of every zip would cost ranged requests on every run to detect what the ETag already does.
+The CRCs are checked by verify_zip on every download.
+"""
+
+# Bump when a change of the code changes the COGs, to rebuild every link on the next run
+PIPELINE_VERSION = 1
+# Keys of a job that change the COG
+PROCESSING_KEYS = ('proj_epsg', 'xRes', 'yRes')
+# Config of the fingerprint of the records processed before the fingerprints, with unknown parameters
+LEGACY = 'legacy'
+# Keys of the GDAL profile that change the COG, the threads and memory settings only change the speed
+PROFILE_KEYS = ('compress', 'level', 'predictor', 'blocksize')
+
+
+def processing_params(job):
+    """
+    Return the parameters of a job that change its outputs
+    """
+    params = {key: job.get(key) for key in PROCESSING_KEYS}
+    params['xRes'] = float(params['xRes']) if params['xRes'] is not None else None
+    params['yRes'] = float(params['yRes']) if params['yRes'] is not None else None
+    profile = job.get('profile') or {}
+    params['profile'] = {key: profile.get(key) for key in PROFILE_KEYS}
+    params['version'] = PIPELINE_VERSION
+    return params
+
+
+def config_hash(job):
+    """
+    Return a short hash of the processing parameters of a job, the same for every link of a run
+    """
+    text = json.dumps(processing_params(job), sort_keys=True)
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()[:16]
+
+
+def legacy_fingerprint(config):
+    """
+    Return the fingerprint of a record processed before the fingerprints, assumed to match the parameters hashed to config
+    """
+    return {'config': LEGACY, 'assumed': config}
+
+
+def source_fingerprint(link, session=None):
+    """
+    Return {'etag', 'size'} of the zip of a link from a HEAD request, None if the server did not answer
+    """
+    try:
+        response = (session or requests).head(link, allow_redirects=True, timeout=30)
+    except requests.RequestException:
+        return None
+    if not response.ok:
+        return None
+    size = response.headers.get('Content-Length')
+    return {'etag': response.headers.get('ETag'), 'size': int(size) if size else None}
+
+
+def source_changed(fingerprint, source):
+    """
+    Compare the fingerprint of a record with the source_fingerprint of its link, by ETag, by size without ETags.
+    A fingerprint without source (a legacy record) or a source that could not be read is not a change.
+    """
+    if not fingerprint or not source:
+        return False
+    if fingerprint.get('etag') and source.get('etag'):
+        return fingerprint['etag'] != source['etag']
+    if fingerprint.get('size') and source.get('size'):
+        return fingerprint['size'] != source['size']
+    return False
+
+
+def stale_reason(record, config):
+    """
+    Return why a link must be processed with the parameters hashed to config, None if its record is up to date.
+    The source itself is checked by the download stage, see source_changed.
+    """
+    if record is None:
+        return 'new'
+    fingerprint = record.get('fingerprint')
+    if fingerprint is None:
+        # Processed before the fingerprints, with unknown parameters assumed to be the current ones
+        return None
+    if fingerprint.get('config') == LEGACY:
+        return 'parameters changed' if fingerprint.get('assumed') != config else None
+    if fingerprint.get('config') != config:
+        return 'parameters changed'
+    return None
+
+
+"""
+# Test
+job = {'proj_epsg': 'EPSG:3978', 'xRes': 5, 'yRes': 5, 'profile': {'compress': 'LZW', 'blocksize': 512, 'threads': 4}}
+print(config_hash(job), config_hash(dict(job, xRes=10)))
+link = 'https://data.eodms-sgdot.nrcan-rncan.gc.ca/public/EGS/2016/RiverIce/CAN/ON/RiverIce_CAN_ON_Moose_20160503_232950.zip'
+print(source_fingerprint(link))
+"""
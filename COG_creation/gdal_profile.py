@@ -0,0 +1,100 @@
+import os
+"""
+GDAL performance profiles applied to reproject_raster, geotiff_to_cog and warp_to_cog.
+A profile is a plain dict, so it can travel with the pipeline jobs to the GDAL worker processes:
+    threads: GDAL threads for the warp and the COG compression, an integer, 'ALL_CPUS', or 'auto' to share
+             the cores between the GDAL workers
+    warp_memory_mb: memory the warper can use for its chunks, None for the GDAL default (64 MB)
+    cache_mb: GDAL_CACHEMAX of the process, None for the GDAL default (5% of the RAM)
+    compress: COG codec, LZW, DEFLATE or ZSTD
+    level: compression level of DEFLATE (1-12) or ZSTD (1-22), None for the codec default
+    predictor: None, 'YES'/2 horizontal differencing, or 'FLOATING_POINT'/3 for float rasters
+    blocksize: COG tile size in pixels
+"""
+
+PROFILES = {
+    # Same output as before the profiles, single-threaded LZW
+    'default': {'threads': 1, 'warp_memory_mb': None, 'cache_mb': None, 'compress': 'LZW',
+                'level': None, 'predictor': None, 'blocksize': 512},
+    # Multi-threaded warp and compression, fast ZSTD level
+    'fast': {'threads': 'auto', 'warp_memory_mb': 512, 'cache_mb': 1024, 'compress': 'ZSTD',
+             'level': 1, 'predictor': None, 'blocksize': 512},
+    # Multi-threaded, smallest output for the archive
+    'small': {'threads': 'auto', 'warp_memory_mb': 512, 'cache_mb': 1024, 'compress': 'DEFLATE',
+              'level': 9, 'predictor': 'YES', 'blocksize': 512},
+}
+
+CODECS = ('LZW', 'DEFLATE', 'ZSTD')
+
+
+def get_profile(name='default', workers=1, **overrides):
+    """
+    Return a copy of a named profile with the overrides that are not None, 'auto' threads resolved for workers processes
+    :param name: key of PROFILES
+    :param workers: number of GDAL worker processes sharing the cores
+    :param overrides: profile keys to change, e.g. compress='ZSTD', level=9
+    """
+    if name not in PROFILES:
+        raise ValueError(f'Unknown GDAL profile {name}, choose from {", ".join(PROFILES)}')
+    profile = dict(PROFILES[name])
+    profile.update({key: value for key, value in overrides.items() if value is not None})
+    if profile['compress'] not in CODECS:
+        raise ValueError(f'Unknown codec {profile["compress"]}, choose from {", ".join(CODECS)}')
+    if profile['threads'] == 'auto':
+        profile['threads'] = max(1, (os.cpu_count() or 1) // max(1, workers))
+    return profile
+
+
+def num_threads(profile):
+    return str((profile or PROFILES['default'])['threads'])
+
+
+def warp_kwargs(profile):
+    """
+    Keyword arguments of gdal.WarpOptions for the profile
+    """
+    profile = profile or PROFILES['default']
+    kwargs = {}
+    if profile['threads'] != 1:
+        kwargs['multithread'] = True
+        kwargs['warpOptions'] = [f'NUM_THREADS={num_threads(profile)}']
+    if profile['warp_memory_mb']:
+        kwargs['warpMemoryLimit'] = profile['warp_memory_mb'] * 1024 * 1024
+    return kwargs
+
+
+def cog_creation_options(profile):
+    """
+    Creation options of the COG driver for the profile, see https://gdal.org/drivers/raster/cog.html#raster-cog
+    """
+    profile = profile or PROFILES['default']
+    options = [f'COMPRESS={profile["compress"]}', f'BLOCKSIZE={profile["blocksize"]}']
+    if profile['threads'] != 1:
+        options.append(f'NUM_THREADS={num_threads(profile)}')
+    if profile['level'] is not None and profile['compress'] != 'LZW':
+        options.append(f'LEVEL={profile["level"]}')
+    if profile['predictor'] is not None:
+        options.append(f'PREDICTOR={profile["predictor"]}')
+    return options
+
+
+def add_profile_arguments(parser):
+    """
+    Add the options of the GDAL profile to an argparse parser, read them back with profile_from_args
+    """
+    parser.add_argument('--profile', choices=sorted(PROFILES), default='default', help='GDAL performance profile')
+    parser.add_argument('--threads', type=str, default=None, help="GDAL threads per worker, an integer, 'ALL_CPUS' or 'auto'")
+    parser.add_argument('--cache-mb', type=int, default=None, help='GDAL_CACHEMAX of every worker in MB')
+    parser.add_argument('--warp-mem-mb', type=int, default=None, help='Memory limit of the warper in MB')
+    parser.add_argument('--compress', choices=CODECS, default=None, help='COG codec')
+    parser.add_argument('--level', type=int, default=None, help='DEFLATE or ZSTD compression level')
+    parser.add_argument('--predictor', type=str, default=None, help="COG predictor, 'YES'/2 or 'FLOATING_POINT'/3")
+
+
+def profile_from_args(args, workers=1):
+    threads = args.threads
+    if threads is not None and threads.isdigit():
+        threads = int(threads)
+    return get_profile(args.profile, workers=workers, threads=threads, cache_mb=args.cache_mb,
+                       warp_memory_mb=args.warp_mem_mb, compress=args.compress, level=args.level,
+                       predictor=args.predictor)
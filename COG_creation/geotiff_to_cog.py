@@ -1,6 +1,9 @@
 import os 
+import time
 from osgeo import gdal
-from rio_cogeo.cogeo import cog_validate
+from cog_validator import cog_validate
+
+from gdal_profile import warp_kwargs, cog_creation_options
 def print_gdal_info(file_path, print_keys=True):
     """"
     Print gdal.Info giventhe file_path 
@@ -16,62 +19,206 @@ def print_gdal_info(file_path, print_keys=True):
         print(info) 
     return info
     
-def reproject_raster(input_path, dstSRS, xRes, yRes): 
-    """"
-    Reproject geotiff or cog to a desinination projection, with a specific xRes and yRes
-    :param input_path: file path
-    :param dstSRS: desination projection in EPSG:xxxx
-    :param xRes and yRes: resolution 
+def _apply_cache(profile): 
     """
-    reProj_path = input_path.replace('.tif', '_reprj.tif')
-    # Open input Geotiff, reproject, resize, and close the Geotiff  
-    warp_options = gdal.WarpOptions(
-        format='GTiff', 
+    Set GDAL_CACHEMAX of this process from the profile 
+    """
+    if profile and profile.get('cache_mb'): 
+        gdal.SetCacheMax(profile['cache_mb'] * 1024 * 1024)
+
+def use_s3_endpoint(): 
+    """
+    Point GDAL /vsis3/ to the S3 endpoint of s3_operations.s3_settings, e.g. a local MinIO, nothing to do for AWS 
+    """
+    from s3_operations import s3_settings
+    endpoint = s3_settings['endpoint_url']
+    if endpoint: 
+        gdal.SetConfigOption('AWS_S3_ENDPOINT', endpoint.split('://')[-1])
+        gdal.SetConfigOption('AWS_HTTPS', 'YES' if endpoint.startswith('https') else 'NO')
+        gdal.SetConfigOption('AWS_VIRTUAL_HOSTING', 'FALSE')
+
+def use_vsicurl(): 
+    """
+    GDAL settings of the /vsizip//vsicurl/ reads of the zips on the EGS server: no listing of the server folder when a 
+    zip is opened, retries of the failed range requests, and larger ranges cached in memory as the zip is read in order 
+    """
+    gdal.SetConfigOption('GDAL_DISABLE_READDIR_ON_OPEN', 'EMPTY_DIR')
+    gdal.SetConfigOption('GDAL_HTTP_MAX_RETRY', '5')
+    gdal.SetConfigOption('GDAL_HTTP_RETRY_DELAY', '1')
+    gdal.SetConfigOption('CPL_VSIL_CURL_CHUNK_SIZE', str(1024 * 1024))
+    gdal.SetConfigOption('VSI_CACHE', 'TRUE')
+
+class VsiFile: 
+    """
+    Read-only file object over a GDAL virtual file, e.g. a COG written to /vsimem/, to upload it without a local copy 
+    """
+    def __init__(self, path): 
+        stat = gdal.VSIStatL(path)
+        self.file = gdal.VSIFOpenL(path, 'rb')
+        if stat is None or self.file is None: 
+            raise FileNotFoundError(path)
+        self.path = path
+        self.size = stat.size
+
+    def read(self, size=-1): 
+        if size is None or size < 0: 
+            size = self.size - gdal.VSIFTellL(self.file)
+        return gdal.VSIFReadL(1, size, self.file) if size > 0 else b''
+
+    def close(self): 
+        if self.file is not None: 
+            gdal.VSIFCloseL(self.file)
+            self.file = None
+
+def upload_vsi_file(vsi_path, bucket_name, s3_key, delete=True): 
+    """
+    Upload a GDAL virtual file to S3 from this process, and free it 
+    :param vsi_path: path of the file, e.g. /vsimem/name_cog.tif 
+    :param delete: unlink the file once uploaded or failed, to give its memory back 
+    :return the size of the file in bytes, None if the upload failed 
+    """
+    from s3_operations import upload_fileobj_to_s3
+    file = VsiFile(vsi_path)
+    try: 
+        uploaded = upload_fileobj_to_s3(bucket_name, s3_key, file)
+    finally: 
+        file.close()
+        if delete: 
+            gdal.Unlink(vsi_path)
+    return file.size if uploaded else None
+
+def _warp_options(dstSRS, xRes, yRes, format='GTiff', profile=None, exact=False, **options): 
+    """
+    Warp options shared by reproject_raster, warp_to_cog and tiled_reproject, so every path produces the same pixels 
+    :param profile: GDAL profile from gdal_profile.get_profile, for the warp threads and memory limit 
+    :param exact: compute the transformation of every pixel (errorThreshold=0) instead of interpolating it over the 
+        output lines within 1/8 pixel. The interpolation depends on the extent of the warp, so only the exact warp of 
+        a tile picks the same source pixels as the warp of the whole raster, at the cost of a slower warp 
+    :param options: other gdal.WarpOptions, replacing the defaults, e.g. the outputBounds of a tile 
+    """
+    kwargs = dict(
+        format=format, 
         dstSRS = dstSRS, 
         xRes=xRes, 
         yRes=yRes, 
         targetAlignedPixels=True, 
         resampleAlg = 'near' , 
         srcNodata=0,
-        dstNodata=0  
+        dstNodata=0,
+        **warp_kwargs(profile)
     )
-    ds = gdal.Warp(destNameOrDestDS=reProj_path, srcDSOrSrcDSTab=input_path, options=warp_options)
-    
-    # Close the data 
-    ds = None 
-    
+    if exact: 
+        kwargs['errorThreshold'] = 0
+    kwargs.update(options)
+    return gdal.WarpOptions(**kwargs)
 
-def geotiff_to_cog(input_path, output_path, datetime_value):
+def _translate_options(datetime_value, profile=None): 
     """
-    Translate geotiff to COG using using gdal.translate, and add TIFFTAG_DATETIME
-    :param input_path: str, Geotiff path include file name  
-    :param output_path: str, COG path include file name 
-    :param datetime_value: date in format '2021:05:03 01:29:09'
+    COG options shared by geotiff_to_cog and warp_to_cog 
+    :param profile: GDAL profile from gdal_profile.get_profile, for the codec, level, predictor and threads 
     """
     # Set the COG options, see creation options here: https://gdal.org/drivers/raster/cog.html#raster-cog
-    translate_options = gdal.TranslateOptions(
-        # Default option: internal overview, block size 512 x 512
+    return gdal.TranslateOptions(
+        # Default option: internal overview, LZW, block size 512 x 512
         format='COG', 
-        creationOptions=['COMPRESS=LZW',
-                         'BLOCKSIZE = 512', 
-                         'BLOCKSIZE = 512'
-                         ],
+        creationOptions=cog_creation_options(profile),
         # Add datetime tag while creating the COG 
         metadataOptions=[f'TIFFTAG_DATETIME = {datetime_value}']
         )    
-    # Translate the TIFF to COG
-    # https://github.com/cogeotiff/rio-cogeo/blob/main/rio_cogeo/cogeo.py
-    ds = gdal.Translate(output_path, input_path, options=translate_options)   
-    # Validate COG   
+
+def _timed(timings, step, start): 
+    """
+    Add the seconds since start to timings[step] if timings is a dict, and return a new start 
+    """
+    now = time.perf_counter()
+    if timings is not None: 
+        timings[step] = round(timings.get(step, 0) + now - start, 3)
+    return now
+
+def _validate(output_path, timings=None): 
+    """
+    Validate the COG and return the message logged in lastRun.txt 
+    """
+    start = time.perf_counter()
     is_valid= cog_validate(src_path=output_path)
+    _timed(timings, 'validate', start)
     if is_valid[0]:
         msg = f'{output_path} is a valid cloud optimized GeoTIFF'
     else: 
         msg = f'{output_path} is not a valid cloud optimized GeoTIFF \n {is_valid}'
     print(msg)
+    return msg 
+
+def reproject_raster(input_path, dstSRS, xRes, yRes, output_path=None, profile=None, timings=None): 
+    """"
+    Reproject geotiff or cog to a desinination projection, with a specific xRes and yRes
+    :param input_path: file path, or a GDAL virtual path such as /vsizip/path/to/file.zip/file.tif
+    :param dstSRS: desination projection in EPSG:xxxx
+    :param xRes and yRes: resolution 
+    :param output_path: optional, the default is the input_path with the _reprj.tif suffix 
+    :param profile: optional GDAL profile from gdal_profile.get_profile 
+    :param timings: optional dict the seconds of the warp are added to, under 'warp' 
+    :return the path of the reprojected Geotiff 
+    """
+    reProj_path = output_path or input_path.replace('.tif', '_reprj.tif')
+    _apply_cache(profile)
+    start = time.perf_counter()
+    # Open input Geotiff, reproject, resize, and close the Geotiff  
+    ds = gdal.Warp(destNameOrDestDS=reProj_path, srcDSOrSrcDSTab=input_path, options=_warp_options(dstSRS, xRes, yRes, profile=profile))
+    
+    # Close the data 
+    ds = None 
+    _timed(timings, 'warp', start)
+    return reProj_path
+    
+
+def geotiff_to_cog(input_path, output_path, datetime_value, profile=None, timings=None):
+    """
+    Translate geotiff to COG using using gdal.translate, and add TIFFTAG_DATETIME
+    :param input_path: str, Geotiff path include file name  
+    :param output_path: str, COG path include file name 
+    :param datetime_value: date in format '2021:05:03 01:29:09'
+    :param profile: optional GDAL profile from gdal_profile.get_profile 
+    :param timings: optional dict the seconds of the steps are added to, under 'translate' and 'validate' 
+    """
+    _apply_cache(profile)
+    start = time.perf_counter()
+    # Translate the TIFF to COG
+    # https://github.com/cogeotiff/rio-cogeo/blob/main/rio_cogeo/cogeo.py
+    ds = gdal.Translate(output_path, input_path, options=_translate_options(datetime_value, profile))   
     # Close the data
     ds = None 
-    return msg 
+    _timed(timings, 'translate', start)
+    # Validate COG   
+    return _validate(output_path, timings)
+
+def warp_to_cog(input_path, output_path, dstSRS, xRes, yRes, datetime_value, profile=None, timings=None, exact=False): 
+    """
+    Reproject the Geotiff and write it as a COG in a single pass, without the intermediate _reprj.tif. 
+    The warp is only described by an in-memory VRT, and its pixels are computed while gdal.Translate writes the COG, 
+    so the output is the same as reproject_raster followed by geotiff_to_cog with half the disk I/O. 
+    :param input_path: file path, or a GDAL virtual path such as /vsizip/path/to/file.zip/file.tif
+    :param output_path: str, COG path include file name, or a /vsimem/ path to keep the COG in memory, see upload_vsi_file 
+    :param dstSRS: desination projection in EPSG:xxxx
+    :param xRes and yRes: resolution 
+    :param datetime_value: date in format '2021:05:03 01:29:09'
+    :param profile: optional GDAL profile from gdal_profile.get_profile 
+    :param timings: optional dict the seconds of the steps are added to, under 'warp', 'translate' and 'validate'. 
+        The pixels are warped while the COG is written, so 'translate' includes most of the warp 
+    :param exact: warp without the approximation of the transformer, to compare with the tiled warp, see _warp_options 
+    """
+    _apply_cache(profile)
+    start = time.perf_counter()
+    vrt_ds = gdal.Warp(destNameOrDestDS='', srcDSOrSrcDSTab=input_path, 
+                       options=_warp_options(dstSRS, xRes, yRes, format='VRT', profile=profile, exact=exact))
+    start = _timed(timings, 'warp', start)
+    ds = gdal.Translate(output_path, vrt_ds, options=_translate_options(datetime_value, profile))
+    # Close the data
+    ds = None 
+    vrt_ds = None 
+    _timed(timings, 'translate', start)
+    # Validate COG   
+    return _validate(output_path, timings)
     
 """
 # Test
@@ -85,4 +232,7 @@ proj_path=input_path.replace('.tif', '_reprj.tif')
 
 geotiff_to_cog(input_path, output_path, datetime_value='2020:05:13 01:37:45')
 #print_gdal_info(output_path, print_keys=True)
+
+# Same COG in a single pass, see benchmark.py to compare both paths
+warp_to_cog(input_path, output_path, dstSRS='EPSG:3978', xRes=5, yRes=5, datetime_value='2020:05:13 01:37:45')
 """
\ No newline at end of file
@@ -1,79 +1,163 @@
 from bs4 import BeautifulSoup
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from datetime import datetime
+from urllib.parse import urljoin, urlparse
 import requests
-#TODO Change the Function to recursively retrieve the ZIP file links
-def get_zip_links(root_url, year, keyword): 
+
+
+class CrawlError(requests.RequestException):
+    """
+    Raised at the end of a crawl when some directory pages could not be listed, their links are missing from the crawl
+    """
+    def __init__(self, failures):
+        """
+        :param failures: list of (url, error) of the pages that could not be listed
+        """
+        self.failures = failures
+        super().__init__(f'Failed to list {len(failures)} directory pages: ' + ', '.join(url for url, _ in failures))
+
+def make_session(pool_size=16):
+    """
+    Create a requests Session that keeps up to pool_size connections open, so every directory page
+    of the crawl reuses a connection instead of doing a new TCP/TLS handshake
+    :param pool_size: number of pooled connections, should be at least the number of crawler workers
+    """
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=3)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+def parse_hrefs(content):
     """
-    Given root url, a year, and search keyword, returning all the urls contain the zip files  
+    Return all the hrefs found in the HTML content of a directory listing page
     Beautifulsoup documentation: https://www.crummy.com/software/BeautifulSoup/bs4/doc/
-    :param root_url: EODMS ESG ftp root url https://data.eodms-sgdot.nrcan-rncan.gc.ca/public/EGS
-    :param year: year for the EGS product 
-    :param keyworf: type of EGS product, can be RiverIce or Flood. 
     """
-    count = 0 
-    zip_links = []
-    url = f'{root_url}/public/EGS/{year}/'
+    soup = BeautifulSoup(content, 'html.parser')
+    return [link.get('href') for link in soup.find_all('a') if link.get('href')]
 
-    # Send a GET request to the URL
-    response = requests.get(url)
-    # Parse the HTML content using BeautifulSoup
-    soup = BeautifulSoup(response.content, 'html.parser')
-    
-    # Extracting all the URLs found in the url page 
-    href_list = [link.get('href') for link in soup.find_all('a')]
-    href_str = " ".join(href_list)
-    if keyword in href_str: 
-        # Extracting first subdirectory: /public/EGS/2016
-        for href in href_list:
-            if keyword in href:
-                subdir1 = root_url + href
-                #print(f'Folder contains keyword {keyword},  continue to search in the first level subdirectory {subdir1}') 
-                response = requests.get(subdir1)
-                soup = BeautifulSoup(response.content, 'html.parser')
-                # Extracting second subdirectory: /public/EGS/2016/RiverIce
-                for link in soup.find_all("a"): 
-                    subdir1_href = link.get('href')
-                    subdir2 = root_url + subdir1_href
-                    if keyword in subdir1_href and not subdir1_href.endswith(".zip"): 
-                        #print(f'Folder contains keyword {keyword} but not the zip file,  continue to search in second level subdirectory {subdir2}') 
-                        response = requests.get(subdir2)
-                        soup = BeautifulSoup(response.content, 'html.parser')
-                        # Extracting thrid subdirectory: /public/EGS/2016/RiverIce/CAN
-                        for link in soup.find_all("a"): 
-                            subdir2_href = link.get('href')
-                            subdir3 = root_url + subdir2_href
-                            if keyword in subdir2_href and not subdir2_href.endswith(".zip"): 
-                                #print(f'Folder contains keyword {keyword} but not the zip file,  continue to search in third level subdirectory {subdir3}') 
-                                response = requests.get(subdir3)
-                                soup = BeautifulSoup(response.content, 'html.parser')
-                                # Extracting forth(normally the last for EGS strcuture) subdirectory: /public/EGS/2016/RiverIce/CAN/Prov
-                                for link in soup.find_all("a"): 
-                                    subdir3_href = link.get('href')
-                                    subdir4 = root_url + subdir3_href
-                                    # Append only the zip files 
-                                    if keyword in subdir3_href and subdir3_href.endswith(".zip"): 
-                                        zip_links.append(subdir4)
-                                        count += 1 
-                            elif keyword in subdir2_href and subdir2_href.endswith(".zip"):
-                                zip_links.append(subdir3)
-                                count += 1
-                    elif keyword in subdir1_href and subdir1_href.endswith(".zip"): 
-                        zip_links.append(subdir2)
-                        count += 1
-                    else: 
-                        pass 
-            else:
-                pass       
-    else: 
+def list_hrefs(session, url, timeout=60):
+    """
+    Return all the hrefs found in a directory listing page, an empty list if the page does not exist
+    """
+    response = session.get(url, timeout=timeout)
+    if response.status_code == 404:
+        return []
+    response.raise_for_status()
+    return parse_hrefs(response.content)
+
+def _list_page(session, url, cache, trusted):
+    """
+    Return (hrefs, unchanged) for a listing page, from the crawl cache when one is given.
+    A trusted page is taken from the cache without any request if it is cached.
+    """
+    if cache is None:
+        return list_hrefs(session, url), False
+    if trusted:
+        hrefs = cache.cached_hrefs(url)
+        if hrefs is not None:
+            return hrefs, True
+    return cache.list_hrefs(session, url)
+
+def crawl_zip_links(root_url, years, keywords, max_workers=8, session=None, cache=None, trust_before_year=None, raise_errors=False):
+    """
+    Recursively crawl /public/EGS/{year}/ for every year and yield the zip links of every keyword as they are found.
+    The directory pages are fetched concurrently on max_workers threads sharing one pooled session,
+    only folders below the current page whose path contains a keyword are followed, whatever their depth.
+    With a crawl cache, every page is revalidated with a conditional GET, and for the years before
+    trust_before_year the whole subtree of a page that has not changed is read from the cache without requests.
+    :param root_url: EODMS ESG ftp root url https://data.eodms-sgdot.nrcan-rncan.gc.ca
+    :param years: list of years for the EGS product
+    :param keywords: list of EGS product types, e.g. ['RiverIce', 'Flood']
+    :param max_workers: maximum number of directory pages requested at the same time
+    :param session: optional requests Session, one is created with make_session otherwise
+    :param cache: optional CrawlCache, saved once the crawl is over
+    :param trust_before_year: years whose unchanged subtrees are skipped, default is the current year,
+        so the current year is always crawled in full
+    :param raise_errors: raise a CrawlError once the other pages are crawled if some pages could not be listed,
+        instead of only printing them, e.g. so a crawl unit of the job queue is crawled again
+    """
+    session = session or make_session(pool_size=max_workers)
+    trust_before_year = trust_before_year or datetime.now().year
+    seen = set()
+    failures = []
+    try:
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            pending = {}
+            for year in years:
+                url = f'{root_url}/public/EGS/{year}/'
+                pending[pool.submit(_list_page, session, url, cache, False)] = (url, year)
+            while pending:
+                done, _ = wait(list(pending), return_when=FIRST_COMPLETED)
+                for future in done:
+                    url, year = pending.pop(future)
+                    try:
+                        hrefs, unchanged = future.result()
+                    except requests.RequestException as e:
+                        print(f'Failed to list {url}: {e}')
+                        failures.append((url, e))
+                        continue
+                    trust_children = unchanged and year < trust_before_year
+                    for href in hrefs:
+                        child = urljoin(url, href)
+                        parsed = urlparse(child)
+                        # Skip parent folders, the page itself and the column sorting links
+                        if not child.startswith(url) or child == url or parsed.query or child in seen:
+                            continue
+                        if not any(keyword in parsed.path for keyword in keywords):
+                            continue
+                        seen.add(child)
+                        if child.endswith('.zip'):
+                            yield child
+                        elif child.endswith('/'):
+                            pending[pool.submit(_list_page, session, child, cache, trust_children)] = (child, year)
+    finally:
+        if cache is not None:
+            cache.save()
+    if failures:
+        print(f'{len(failures)} directory pages could not be listed, their links are missing from the crawl')
+        if raise_errors:
+            raise CrawlError(failures)
+
+def get_zip_links(root_url, year, keyword, session=None, cache=None):
+    """
+    Given root url, a year, and search keyword, returning all the urls contain the zip files
+    :param root_url: EODMS ESG ftp root url https://data.eodms-sgdot.nrcan-rncan.gc.ca
+    :param year: year for the EGS product
+    :param keyword: type of EGS product, can be RiverIce or Flood.
+    :param cache: optional CrawlCache to revalidate the listings instead of downloading them again
+    """
+    url = f'{root_url}/public/EGS/{year}/'
+    zip_links = list(crawl_zip_links(root_url, [year], [keyword], session=session, cache=cache))
+    if not zip_links:
         print(f'Year {year} does not have {keyword} instance recorded, stop searching and return zero links')
-    # Check if keywords exist in the url subdirectory. Continue search only when the keyword exist, else exist  
-    print(f'There are {count} {keyword} instance recorded in {url}')
+    print(f'There are {len(zip_links)} {keyword} instance recorded in {url}')
     return zip_links
 
+def get_link_datetime(link):
+    """
+    Extract the acquisition datetime from an EGS zip link, e.g. RiverIce_CAN_ON_Moose_20160503_232950.zip
+    :param link: zip url or filename ending with _YYYYMMDD_HHMMSS.zip
+    :return a datetime object
+    """
+    time_str = link.split('_')[-1].split('.')[0]
+    date_str = link.split('_')[-2].split('.')[0]
+    timestamp = date_str + "_" + time_str
+    return datetime.strptime(timestamp, '%Y%m%d_%H%M%S')
+
 """
 #Test
 root_url = 'https://data.eodms-sgdot.nrcan-rncan.gc.ca'
-year = 2018  
-keyword = 'RiverIce' 
+year = 2018
+keyword = 'RiverIce'
 zip_links = get_zip_links(root_url, year=2020, keyword='Flood')
 print(zip_links)
-"""
\ No newline at end of file
+
+# Stream the links of several years and products in one pass
+for link in crawl_zip_links(root_url, years=range(2016, 2021), keywords=['RiverIce', 'Flood'], max_workers=16):
+    print(link)
+
+# Revalidate the listings cached by the previous run
+from crawl_cache import CrawlCache
+zip_links = list(crawl_zip_links(root_url, years=range(2005, 2024), keywords=['RiverIce'], cache=CrawlCache('crawl_cache.json')))
+"""
@@ -0,0 +1,228 @@
+import json
+import math
+import os
+import threading
+import time
+"""
+Per-link, per-stage instrumentation of the pipeline.
+Every stage function is wrapped with Instrumented, which records in job['metrics'][stage] the wall time, the bytes
+read and written, the peak RSS of the worker and the retries. The wrapper is a plain object, so it is sent to the GDAL
+processes with the job. RunMetrics writes one JSON line per link, and summarizes the run at the end: percentiles of
+the stage times and MB/s per stage.
+A profiler (cProfile, or pyinstrument if it is installed) can be turned on for the links matching a substring.
+"""
+
+
+def _size(path):
+    try:
+        return os.path.getsize(path) if path else 0
+    except OSError:
+        return 0
+
+
+def peak_rss_mb():
+    """
+    Peak resident memory of this process in MB, None if it cannot be read on this platform
+    """
+    try:
+        import resource
+        # ru_maxrss is in KB on Linux, in bytes on macOS
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return round(peak / (1024 * 1024 if os.uname().sysname == 'Darwin' else 1024), 1)
+    except ImportError:
+        pass
+    try:
+        import psutil
+        info = psutil.Process().memory_info()
+        return round(getattr(info, 'peak_wset', info.rss) / (1024 * 1024), 1)
+    except ImportError:
+        return None
+
+
+# Bytes (in, out) of every stage, read from the job once the stage returned
+STAGE_BYTES = {
+    'download_stage': lambda job: (job.get('download', {}).get('bytes', 0), _size(job.get('zip_file_path'))),
+    'convert_stage': lambda job: (_size(job.get('input_path')) or _size(job.get('zip_file_path')), job.get('cog_bytes') or _size(job.get('output_path'))),
+    'thumbnail_stage': lambda job: (0, _size(job.get('thumbnail_path'))),
+    'stac_stage': lambda job: (0, _size(job.get('stac_path'))),
+    'upload_stage': lambda job: (0, sum(_size(job.get(key)) for key in ('zip_file_path', 'output_path', 'thumbnail_path', 'stac_path'))
+                                 + (job.get('download', {}).get('bytes', 0) if job.get('read_mode') == 'stream' else 0)),
+}
+
+
+class Instrumented:
+    def __init__(self, fn, name=None):
+        """
+        Stage function recording its metrics in job['metrics']
+        :param fn: stage function, or a functools.partial of one
+        :param name: name of the stage, the name of fn by default
+        """
+        self.fn = fn
+        self.__name__ = name or getattr(fn, '__name__', None) or fn.func.__name__
+
+    def __call__(self, job):
+        metrics = job.setdefault('metrics', {})
+        start = time.perf_counter()
+        try:
+            if job.get('profile_link') and job['profile_link'] in job['link']:
+                job = profile_call(self.fn, job, self.__name__)
+            else:
+                job = self.fn(job)
+        finally:
+            bytes_in, bytes_out = STAGE_BYTES.get(self.__name__, lambda job: (0, 0))(job)
+            stage_metrics = {'seconds': round(time.perf_counter() - start, 3), 'bytes_in': bytes_in, 'bytes_out': bytes_out,
+                             'peak_rss_mb': peak_rss_mb(), 'pid': os.getpid()}
+            if self.__name__ == 'download_stage':
+                stage_metrics['retries'] = job.get('download', {}).get('retries', 0)
+                stage_metrics['from_cache'] = job.get('download', {}).get('from_cache', False)
+                stage_metrics['scratch_wait'] = round(job.get('download', {}).get('scratch_wait', 0), 3)
+            if self.__name__ == 'convert_stage':
+                # Seconds of gdal.Warp, the COG translate and the validation
+                stage_metrics['steps'] = job.get('gdal_timings', {})
+            metrics[self.__name__] = stage_metrics
+        return job
+
+
+def profile_call(fn, job, name):
+    """
+    Run fn(job) under pyinstrument if job['profiler'] asks for it and it is installed, under cProfile otherwise.
+    The profile is written to {profile_dir}/{link filename}_{stage}.prof, or .html for pyinstrument.
+    """
+    profile_dir = job.get('profile_dir') or '.'
+    os.makedirs(profile_dir, exist_ok=True)
+    base_path = os.path.join(profile_dir, f'{job["link"].split("/")[-1].replace(".zip", "")}_{name}')
+    if job.get('profiler') == 'pyinstrument':
+        try:
+            from pyinstrument import Profiler
+        except ImportError:
+            print('pyinstrument is not installed, profiling with cProfile')
+        else:
+            profiler = Profiler()
+            profiler.start()
+            try:
+                return fn(job)
+            finally:
+                profiler.stop()
+                with open(base_path + '.html', 'w') as file:
+                    file.write(profiler.output_html())
+                print(f'Profile of {name} written to {base_path}.html')
+    import cProfile
+    profiler = cProfile.Profile()
+    try:
+        return profiler.runcall(fn, job)
+    finally:
+        profiler.dump_stats(base_path + '.prof')
+        print(f'Profile of {name} written to {base_path}.prof, read it with python -m pstats')
+
+
+def percentile(values, q):
+    """
+    Nearest-rank percentile of a list of numbers, q in 0-100
+    """
+    if not values:
+        return None
+    values = sorted(values)
+    rank = max(1, math.ceil(q / 100 * len(values)))
+    return values[min(rank, len(values)) - 1]
+
+
+class RunMetrics:
+    def __init__(self, metrics_path='metrics.jsonl'):
+        """
+        Metrics of a run, one JSON line per link in metrics_path
+        :param metrics_path: local JSON Lines file, overwritten by every run
+        """
+        self.metrics_path = metrics_path
+        self.start = time.time()
+        self.records = []
+        self.timers = {}
+        self._lock = threading.Lock()
+        open(metrics_path, 'w').close()
+
+    def timed(self, iterable, name):
+        """
+        Yield the items of iterable, adding the time spent waiting for them to the timer name, e.g. the crawl
+        """
+        iterator = iter(iterable)
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                self._add_time(name, time.perf_counter() - start, 0)
+                return
+            self._add_time(name, time.perf_counter() - start, 1)
+            yield item
+
+    def _add_time(self, name, seconds, count):
+        with self._lock:
+            timer = self.timers.setdefault(name, {'seconds': 0.0, 'items': 0})
+            timer['seconds'] += seconds
+            timer['items'] += count
+
+    def add(self, job):
+        """
+        Record the metrics of a finished job
+        """
+        record = {'link': job['link'], 'error': job.get('error'), 'metrics': job.get('metrics', {})}
+        with self._lock:
+            self.records.append(record)
+            with open(self.metrics_path, 'a') as file:
+                file.write(json.dumps(record) + '\n')
+
+    def summary(self):
+        """
+        Return the run summary: per stage, the count, p50/p90/p99/max seconds, MB in and out, MB/s and retries
+        """
+        stages = {}
+        for record in self.records:
+            for name, metrics in record['metrics'].items():
+                stages.setdefault(name, []).append(metrics)
+                for step, seconds in metrics.get('steps', {}).items():
+                    stages.setdefault(f'{name}.{step}', []).append({'seconds': seconds, 'bytes_in': 0, 'bytes_out': 0})
+        summary = {'seconds': round(time.time() - self.start, 1), 'links': len(self.records),
+                   'failed': sum(1 for record in self.records if record['error']),
+                   'timers': {name: dict(timer, seconds=round(timer['seconds'], 1)) for name, timer in self.timers.items()},
+                   'stages': {}}
+        for name, metrics in stages.items():
+            seconds = [m['seconds'] for m in metrics]
+            megabytes = sum(max(m['bytes_in'], m['bytes_out']) for m in metrics) / 1e6
+            stage = {
+                'count': len(metrics),
+                'p50': percentile(seconds, 50), 'p90': percentile(seconds, 90), 'p99': percentile(seconds, 99), 'max': max(seconds),
+                'total_seconds': round(sum(seconds), 1),
+                'mb_in': round(sum(m['bytes_in'] for m in metrics) / 1e6, 1),
+                'mb_out': round(sum(m['bytes_out'] for m in metrics) / 1e6, 1),
+                'mb_per_s': round(megabytes / sum(seconds), 2) if sum(seconds) else None,
+                'peak_rss_mb': max((m['peak_rss_mb'] for m in metrics if m.get('peak_rss_mb') is not None), default=None),
+            }
+            if any('retries' in m for m in metrics):
+                stage['retries'] = sum(m.get('retries', 0) for m in metrics)
+            summary['stages'][name] = stage
+        return summary
+
+    def format_summary(self, summary=None):
+        """
+        Return the summary as a text table
+        """
+        summary = summary or self.summary()
+        lines = [f'{summary["links"]} links in {summary["seconds"]} seconds, {summary["failed"]} failed']
+        for name, timer in summary['timers'].items():
+            lines.append(f'{name}: {timer["seconds"]} seconds waiting for {timer["items"]} items')
+        lines.append(f'{"stage":<26} {"count":>6} {"p50 s":>8} {"p90 s":>8} {"p99 s":>8} {"max s":>8} {"MB in":>9} {"MB out":>9} {"MB/s":>7} {"RSS MB":>8}')
+        for name, stage in summary['stages'].items():
+            lines.append(f'{name:<26} {stage["count"]:>6} {stage["p50"]:>8.2f} {stage["p90"]:>8.2f} {stage["p99"]:>8.2f} {stage["max"]:>8.2f} '
+                         f'{stage["mb_in"]:>9.1f} {stage["mb_out"]:>9.1f} {stage["mb_per_s"] or 0:>7.1f} {stage["peak_rss_mb"] or 0:>8.1f}'
+                         + (f'  {stage["retries"]} retries' if 'retries' in stage else ''))
+        return '\n'.join(lines)
+
+    def upload(self, bucket_name, folder_path):
+        """
+        Upload metrics.jsonl and run_report.json next to lastRun.txt, and return the text summary
+        """
+        from s3_operations import upload_fileContent_to_s3
+        summary = self.summary()
+        with open(self.metrics_path, 'r') as file:
+            upload_fileContent_to_s3(bucket_name, file_key=folder_path + 'metrics.jsonl', file_content=file.read())
+        upload_fileContent_to_s3(bucket_name, file_key=folder_path + 'run_report.json', file_content=json.dumps(summary, indent=2))
+        return self.format_summary(summary)
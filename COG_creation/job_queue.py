@@ -0,0 +1,293 @@
+import argparse
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+"""
+Durable work queue of the pipeline on a local SQLite file.
+The planner expands products x years into crawl units, and every unit into one job per zip link. The jobs go
+through pending -> running -> done or failed, and each one is checkpointed as soon as it finishes, so a run stopped
+in the middle of a year resumes exactly at the links that were not done. A unit whose crawl could not list every
+page is marked failed with the links found so far, and crawled again on the next run.
+Jobs are claimed in a BEGIN IMMEDIATE transaction, so several processes, or nodes sharing the file, never get the
+same job. A running job whose worker stopped is claimed again once its lease expires. A job that failed is pending
+again after a delay growing with its attempts, until it was claimed max_attempts times.
+SQLite needs a file system with working locks: a local disk, or a network share that supports them.
+"""
+
+PENDING = 'pending'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS units (
+    product TEXT NOT NULL,
+    year INTEGER NOT NULL,
+    state TEXT NOT NULL DEFAULT 'pending',
+    worker TEXT,
+    claimed_at REAL,
+    links INTEGER,
+    PRIMARY KEY (product, year)
+);
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    product TEXT NOT NULL,
+    year INTEGER,
+    link TEXT NOT NULL,
+    state TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    worker TEXT,
+    claimed_at REAL,
+    finished_at REAL,
+    retry_at REAL,
+    error TEXT,
+    result TEXT,
+    UNIQUE (product, link)
+);
+CREATE INDEX IF NOT EXISTS jobs_product_state ON jobs (product, state);
+"""
+
+
+class JobQueue:
+    def __init__(self, db_path, worker_id=None, lease_seconds=3600, max_attempts=3, retry_delay=60):
+        """
+        :param db_path: SQLite file of the queue, created if it does not exist
+        :param worker_id: name of this worker, {host name}-{process id} by default. An id given to a process must not be
+            used by another process at the same time, reset_worker puts back to pending the jobs running under this id
+        :param lease_seconds: seconds after which a running job or crawl unit is considered abandoned
+        :param max_attempts: number of claims of a job before a failed or abandoned job is marked failed for good
+        :param retry_delay: seconds before a failed job is claimed again, multiplied by its number of attempts
+        """
+        self.db_path = db_path
+        self.worker_id = worker_id or f'{socket.gethostname()}-{os.getpid()}'
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self._lock = threading.Lock()
+        # Transactions are managed explicitly, the connection is shared by the threads of this process under _lock
+        self.conn = sqlite3.connect(db_path, timeout=60, isolation_level=None, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.executescript(SCHEMA)
+        # Queues created before the automatic retries
+        if 'retry_at' not in [row[1] for row in self.conn.execute('PRAGMA table_info(jobs)')]:
+            self.conn.execute('ALTER TABLE jobs ADD COLUMN retry_at REAL')
+
+    @contextmanager
+    def _transaction(self):
+        """
+        Write transaction holding the database lock from its start, so two workers cannot read the same pending rows
+        """
+        with self._lock:
+            self.conn.execute('BEGIN IMMEDIATE')
+            try:
+                yield self.conn
+            except Exception:
+                self.conn.execute('ROLLBACK')
+                raise
+            self.conn.execute('COMMIT')
+
+    def plan(self, product, years, refresh=()):
+        """
+        Add the crawl units of a product for the years not planned yet, and put back to pending the units whose crawl failed
+        :param refresh: years crawled again even if they were expanded, e.g. the current year that still gets new links
+        """
+        with self._transaction() as conn:
+            conn.executemany('INSERT OR IGNORE INTO units (product, year) VALUES (?, ?)', [(product, year) for year in years])
+            conn.executemany('UPDATE units SET state = ? WHERE product = ? AND year = ? AND state = ?',
+                             [(PENDING, product, year, FAILED) for year in years])
+            conn.executemany('UPDATE units SET state = ? WHERE product = ? AND year = ? AND state = ?',
+                             [(PENDING, product, year, DONE) for year in refresh])
+
+    def claim_unit(self, product):
+        """
+        Claim the next crawl unit of a product that is pending or abandoned
+        :return: the year of the unit, None if there is none
+        """
+        now = time.time()
+        with self._transaction() as conn:
+            row = conn.execute('SELECT year FROM units WHERE product = ? AND (state = ? OR (state = ? AND claimed_at < ?)) '
+                               'ORDER BY year LIMIT 1', (product, PENDING, RUNNING, now - self.lease_seconds)).fetchone()
+            if row is None:
+                return None
+            conn.execute('UPDATE units SET state = ?, worker = ?, claimed_at = ? WHERE product = ? AND year = ?',
+                         (RUNNING, self.worker_id, now, product, row[0]))
+        return row[0]
+
+    def add_links(self, product, year, links, complete=True):
+        """
+        Add the links of a crawl unit as pending jobs, the links already queued are kept as they are, and close the unit
+        :param complete: False if the crawl of the unit failed, the unit is marked failed to be crawled again
+        :return: the number of new jobs
+        """
+        with self._transaction() as conn:
+            before = conn.total_changes
+            conn.executemany('INSERT OR IGNORE INTO jobs (product, year, link) VALUES (?, ?, ?)',
+                             [(product, year, link) for link in links])
+            added = conn.total_changes - before
+            conn.execute('UPDATE units SET state = ?, links = ? WHERE product = ? AND year = ?',
+                         (DONE if complete else FAILED, len(links), product, year))
+        return added
+
+    def expand(self, product, crawl):
+        """
+        Crawl every unit of a product that is not expanded yet, several workers can expand the units of a product together.
+        The links of a crawl that raised an IOError, e.g. a requests error or a CrawlError, are queued and the unit is marked
+        failed, to be crawled again by the next plan. The unit of any other error is marked failed and the error raised.
+        :param crawl: function of a year returning the zip links of the product for that year
+        :return: the list of the years whose crawl failed
+        """
+        failed = []
+        while True:
+            year = self.claim_unit(product)
+            if year is None:
+                return failed
+            links = []
+            try:
+                links.extend(crawl(year))
+            except Exception as e:
+                added = self.add_links(product, year, links, complete=False)
+                print(f'The crawl of {product} {year} failed, {added} new jobs of {len(links)} links queued, '
+                      f'it is crawled again on the next run: {e}')
+                if not isinstance(e, IOError):
+                    raise
+                failed.append(year)
+                continue
+            print(f'{self.add_links(product, year, links)} new jobs of {len(links)} links queued for {product} {year}')
+
+    def claim(self, product):
+        """
+        Claim the next pending job of a product whose retry delay is over, or a running job whose lease expired.
+        An abandoned job that was already claimed max_attempts times is marked failed instead.
+        :return: (job id, link), None when there is no job left to claim
+        """
+        now = time.time()
+        with self._transaction() as conn:
+            conn.execute("UPDATE jobs SET state = ?, error = 'abandoned by its worker', finished_at = ? "
+                         'WHERE product = ? AND state = ? AND claimed_at < ? AND attempts >= ?',
+                         (FAILED, now, product, RUNNING, now - self.lease_seconds, self.max_attempts))
+            row = conn.execute('SELECT id, link FROM jobs WHERE product = ? AND ((state = ? AND (retry_at IS NULL OR retry_at <= ?)) '
+                               'OR (state = ? AND claimed_at < ?)) ORDER BY id LIMIT 1',
+                               (product, PENDING, now, RUNNING, now - self.lease_seconds)).fetchone()
+            if row is None:
+                return None
+            conn.execute('UPDATE jobs SET state = ?, worker = ?, claimed_at = ?, attempts = attempts + 1 WHERE id = ?',
+                         (RUNNING, self.worker_id, now, row[0]))
+        return row
+
+    def next_retry(self, product):
+        """
+        Return the seconds before the retry delay of the next failed job of a product is over, 0 if it is over,
+        None if no job of the product is pending
+        """
+        with self._lock:
+            row = self.conn.execute('SELECT COUNT(*), MIN(COALESCE(retry_at, 0)) FROM jobs WHERE product = ? AND state = ?', (product, PENDING)).fetchone()
+        if not row[0]:
+            return None
+        return max(0.0, row[1] - time.time())
+
+    def done(self, job_id, result=None):
+        """
+        Checkpoint a finished job
+        :param result: optional JSON serializable result, e.g. the COG key
+        """
+        with self._transaction() as conn:
+            conn.execute('UPDATE jobs SET state = ?, finished_at = ?, error = NULL, retry_at = NULL, result = ? WHERE id = ?',
+                         (DONE, time.time(), json.dumps(result) if result is not None else None, job_id))
+
+    def failed(self, job_id, error):
+        """
+        Record the error of a job. It is pending again after retry_delay * attempts seconds if it was claimed fewer than
+        max_attempts times, and failed for good otherwise, see requeue_failed
+        :return: True if the job will be retried
+        """
+        now = time.time()
+        with self._transaction() as conn:
+            attempts = conn.execute('SELECT attempts FROM jobs WHERE id = ?', (job_id,)).fetchone()[0]
+            retry = attempts < self.max_attempts
+            if retry:
+                conn.execute('UPDATE jobs SET state = ?, finished_at = ?, error = ?, retry_at = ? WHERE id = ?',
+                             (PENDING, now, str(error), now + self.retry_delay * attempts, job_id))
+            else:
+                conn.execute('UPDATE jobs SET state = ?, finished_at = ?, error = ? WHERE id = ?', (FAILED, now, str(error), job_id))
+        return retry
+
+    def reset_worker(self):
+        """
+        Put back to pending the jobs and crawl units this worker was running when it stopped, to resume them right away.
+        Only useful with a worker_id kept from run to run, the jobs of the other ids are claimed again when their lease expires
+        """
+        with self._transaction() as conn:
+            jobs = conn.execute('UPDATE jobs SET state = ? WHERE state = ? AND worker = ?', (PENDING, RUNNING, self.worker_id)).rowcount
+            conn.execute('UPDATE units SET state = ? WHERE state = ? AND worker = ?', (PENDING, RUNNING, self.worker_id))
+        if jobs:
+            print(f'{jobs} jobs interrupted on {self.worker_id} are pending again')
+        return jobs
+
+    def requeue_failed(self, product=None):
+        """
+        Put the failed jobs back to pending, with their attempts reset
+        """
+        with self._transaction() as conn:
+            if product:
+                cursor = conn.execute('UPDATE jobs SET state = ?, attempts = 0, retry_at = NULL WHERE state = ? AND product = ?', (PENDING, FAILED, product))
+            else:
+                cursor = conn.execute('UPDATE jobs SET state = ?, attempts = 0, retry_at = NULL WHERE state = ?', (PENDING, FAILED))
+        return cursor.rowcount
+
+    def requeue_done(self, product, links=None):
+        """
+        Put the done jobs of a product back to pending, e.g. after a change of the processing parameters
+        :param links: only the jobs of these links, all the done jobs of the product if None
+        """
+        with self._transaction() as conn:
+            if links is None:
+                cursor = conn.execute('UPDATE jobs SET state = ?, attempts = 0, retry_at = NULL WHERE state = ? AND product = ?', (PENDING, DONE, product))
+                return cursor.rowcount
+            count = 0
+            for link in links:
+                count += conn.execute('UPDATE jobs SET state = ?, attempts = 0, retry_at = NULL WHERE state = ? AND product = ? AND link = ?',
+                                      (PENDING, DONE, product, link)).rowcount
+        return count
+
+    def counts(self, product=None):
+        """
+        Return a dict product -> {state: number of jobs}
+        """
+        with self._lock:
+            rows = self.conn.execute('SELECT product, state, COUNT(*) FROM jobs GROUP BY product, state').fetchall()
+        counts = {}
+        for row_product, state, count in rows:
+            if product is None or row_product == product:
+                counts.setdefault(row_product, {})[state] = count
+        return counts
+
+    def close(self):
+        self.conn.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Inspect the SQLite work queue of main.py --queue.')
+    parser.add_argument('db_path', type=str, help='SQLite file of the queue')
+    parser.add_argument('command', choices=['status', 'failed', 'requeue'], help='status: jobs per state, failed: list the failed jobs, '
+                        'requeue: put the failed jobs back to pending')
+    parser.add_argument('--product', type=str, default=None, help='Only this product')
+    args = parser.parse_args()
+    job_queue = JobQueue(args.db_path)
+    if args.command == 'status':
+        for product, states in sorted(job_queue.counts(args.product).items()):
+            print(product, ', '.join(f'{state}: {count}' for state, count in sorted(states.items())))
+    elif args.command == 'failed':
+        query = 'SELECT product, link, attempts, error FROM jobs WHERE state = ?' + (' AND product = ?' if args.product else '')
+        for row in job_queue.conn.execute(query, (FAILED, args.product) if args.product else (FAILED,)):
+            print(*row, sep='\t')
+    else:
+        print(f'{job_queue.requeue_failed(args.product)} failed jobs are pending again')
+"""
+# Run the scripts from the termial
+python job_queue.py queue.sqlite status
+python job_queue.py queue.sqlite requeue --product RiverIce
+"""
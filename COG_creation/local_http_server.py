@@ -0,0 +1,212 @@
+import email.utils
+import os
+import re
+import threading
+import zipfile
+from http import HTTPStatus
+from http.server import HTTPServer, SimpleHTTPRequestHandler
+from socketserver import ThreadingMixIn
+"""
+Local stand-in for the EODMS EGS file server, to run the crawler and the downloads without the network.
+The directory listings are the plain ones from http.server, with relative hrefs like 'CAN/',
+sent with ETag and Last-Modified validators and answering conditional GETs with 304 Not Modified.
+Files are sent with an ETag and can be requested with a Range header, honoured only if the If-Range validator
+matches, and FlakyHandler drops the first connections partway through.
+"""
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class DirectoryHandler(SimpleHTTPRequestHandler):
+    """
+    Serve the files under root_dir instead of the current working directory
+    """
+    root_dir = '.'
+
+    def translate_path(self, path):
+        path = super().translate_path(path)
+        return os.path.join(self.root_dir, os.path.relpath(path, os.getcwd()))
+
+    def send_head(self):
+        path = self.translate_path(self.path)
+        self._validators = None
+        self._file_etag = None
+        if os.path.isdir(path) and self.path.endswith('/'):
+            stat = os.stat(path)
+            etag = f'"{stat.st_mtime_ns:x}"'
+            last_modified = email.utils.formatdate(stat.st_mtime, usegmt=True)
+            if_none_match = self.headers.get('If-None-Match')
+            if_modified_since = self.headers.get('If-Modified-Since')
+            if (if_none_match == etag) or (if_none_match is None and if_modified_since == last_modified):
+                self.send_response(HTTPStatus.NOT_MODIFIED)
+                self.send_header('ETag', etag)
+                self.end_headers()
+                return None
+            self._validators = (etag, last_modified)
+        self._remaining = None
+        if not os.path.isfile(path):
+            return super().send_head()
+        stat = os.stat(path)
+        self._file_etag = f'"{stat.st_mtime_ns:x}-{stat.st_size:x}"'
+        match = re.match(r'bytes=(\d+)-(\d*)$', self.headers.get('Range') or '')
+        if_range = self.headers.get('If-Range')
+        if match is None or (if_range and if_range not in (self._file_etag, self.date_time_string(stat.st_mtime))):
+            # Without a Range, or the file changed since the validator of If-Range, the whole file is sent
+            return super().send_head()
+        return self._send_range(path, int(match.group(1)), match.group(2))
+
+    def _send_range(self, path, start, end):
+        """
+        Answer a single 'bytes=start-end' Range with 206 Partial Content, or 416 if it starts after the end of the file
+        """
+        file = open(path, 'rb')
+        size = os.fstat(file.fileno()).st_size
+        if start >= size:
+            file.close()
+            self.send_response(HTTPStatus.REQUESTED_RANGE_NOT_SATISFIABLE)
+            self.send_header('Content-Range', f'bytes */{size}')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return None
+        end = min(int(end), size - 1) if end else size - 1
+        self.send_response(HTTPStatus.PARTIAL_CONTENT)
+        self.send_header('Content-type', self.guess_type(path))
+        self.send_header('Content-Range', f'bytes {start}-{end}/{size}')
+        self.send_header('Content-Length', str(end - start + 1))
+        self.send_header('Last-Modified', self.date_time_string(os.fstat(file.fileno()).st_mtime))
+        self.end_headers()
+        file.seek(start)
+        self._remaining = end - start + 1
+        return file
+
+    def copyfile(self, source, outputfile):
+        remaining = getattr(self, '_remaining', None)
+        while remaining is None or remaining > 0:
+            chunk = source.read(64 * 1024 if remaining is None else min(64 * 1024, remaining))
+            if not chunk:
+                break
+            outputfile.write(chunk)
+            if remaining is not None:
+                remaining -= len(chunk)
+
+    def end_headers(self):
+        if getattr(self, '_file_etag', None):
+            self.send_header('ETag', self._file_etag)
+            self._file_etag = None
+        if getattr(self, '_validators', None):
+            self.send_header('ETag', self._validators[0])
+            self.send_header('Last-Modified', self._validators[1])
+            self._validators = None
+        super().end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FlakyHandler(DirectoryHandler):
+    """
+    Cut the first `drops` file downloads after `drop_after_bytes` bytes, and answer the next `busy`
+    requests with 503 and a Retry-After of 0 seconds, to exercise the retries of the downloads
+    """
+    drops = 1
+    drop_after_bytes = 1024
+    busy = 0
+    _lock = threading.Lock()
+
+    def _take(self, name):
+        with self._lock:
+            left = getattr(type(self), name)
+            if left > 0:
+                setattr(type(self), name, left - 1)
+                return True
+        return False
+
+    def send_head(self):
+        if not self.path.endswith('/') and self._take('busy'):
+            self.send_response(HTTPStatus.SERVICE_UNAVAILABLE)
+            self.send_header('Retry-After', '0')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return None
+        return super().send_head()
+
+    def copyfile(self, source, outputfile):
+        if not self._take('drops'):
+            return super().copyfile(source, outputfile)
+        outputfile.write(source.read(self.drop_after_bytes))
+        outputfile.flush()
+        self.close_connection = True
+
+
+def serve_directory(root_dir, port=0, handler=DirectoryHandler, **handler_options):
+    """
+    Serve root_dir over HTTP on localhost in a background thread
+    :param root_dir: local folder to serve, e.g. the folder created by build_fake_egs_tree
+    :param port: port to listen on, 0 picks a free one
+    :param handler: request handler class, its root_dir is set to root_dir
+    :param handler_options: class attributes set on the handler, e.g. drops=2 for FlakyHandler
+    :return (server, root_url), call server.shutdown() when done
+    """
+    attributes = dict(handler_options, root_dir=os.path.abspath(root_dir))
+    handler_class = type(handler.__name__, (handler,), attributes)
+    server = _ThreadingHTTPServer(('127.0.0.1', port), handler_class)
+    thread = threading.Thread(target=server.serve_forever, name='local-http-server', daemon=True)
+    thread.start()
+    root_url = f'http://127.0.0.1:{server.server_address[1]}'
+    return server, root_url
+
+
+def build_fake_egs_tree(root_dir, years, keywords, provinces=('ON', 'QC'), links_per_dir=3, member_path=None, padding_bytes=0):
+    """
+    Create the /public/EGS/{year}/{keyword}/CAN/{province}/ layout with small zips named like the EGS products
+    :param root_dir: local folder to create the tree in
+    :param years: list of years
+    :param keywords: list of EGS products, e.g. ['RiverIce', 'Flood']
+    :param provinces: province folders under CAN
+    :param links_per_dir: number of zips in each province folder
+    :param member_path: optional file (e.g. a Geotiff) zipped as the product .tif, a placeholder is used otherwise
+    :param padding_bytes: size of an incompressible member added to every zip, to make larger archives
+    :return a list of the zip paths relative to root_dir, e.g. public/EGS/2016/RiverIce/CAN/ON/RiverIce_CAN_ON_Site0_20160503_232950.zip
+    """
+    relative_paths = []
+    for year in years:
+        for keyword in keywords:
+            for province in provinces:
+                folder = os.path.join(root_dir, 'public', 'EGS', str(year), keyword, 'CAN', province)
+                os.makedirs(folder, exist_ok=True)
+                for i in range(links_per_dir):
+                    name = f'{keyword}_CAN_{province}_Site{i}_{year}0503_2329{i % 60:02d}'
+                    zip_path = os.path.join(folder, name + '.zip')
+                    with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED) as zip_ref:
+                        if member_path:
+                            zip_ref.write(member_path, name + '.tif')
+                        else:
+                            zip_ref.writestr(name + '.tif', b'placeholder')
+                        zip_ref.writestr(name + '.xml', b'<metadata/>')
+                        if padding_bytes:
+                            zip_ref.writestr(name + '_padding.bin', os.urandom(padding_bytes), zipfile.ZIP_STORED)
+                    relative_paths.append(os.path.relpath(zip_path, root_dir).replace(os.sep, '/'))
+    return relative_paths
+
+
+"""
+# Test
+import tempfile
+from get_zip_links import crawl_zip_links
+root_dir = tempfile.mkdtemp()
+build_fake_egs_tree(root_dir, years=[2016, 2017], keywords=['RiverIce', 'Flood'])
+server, root_url = serve_directory(root_dir)
+print(sorted(crawl_zip_links(root_url, years=[2016, 2017], keywords=['RiverIce'])))
+server.shutdown()
+
+# Downloads resuming after two dropped connections and a 503
+from download_and_unzip import download_zip
+zip_paths = build_fake_egs_tree(root_dir, years=[2016], keywords=['RiverIce'], member_path='Test/tiff/RiverIce_CAN_ON_Moose_20160503_232950.tif')
+server, root_url = serve_directory(root_dir, handler=FlakyHandler, drops=2, drop_after_bytes=4096, busy=1)
+stats = {}
+download_zip(f'{root_url}/{zip_paths[0]}', tempfile.mkdtemp(), backoff=0, stats=stats)
+print(stats)
+server.shutdown()
+"""
@@ -1,108 +1,288 @@
 import argparse
-import requests
 import os 
-import zipfile
-import boto3
-import logging
-from botocore.exceptions import ClientError
-from osgeo import gdal
-from bs4 import BeautifulSoup
+import sys
+import time
 from datetime import datetime
-from rio_cogeo.cogeo import cog_validate
 
-from get_zip_links import * 
-from download_and_unzip import * 
-from geotiff_to_cog import * 
-from s3_operations import * 
+from gdal_profile import add_profile_arguments, profile_from_args
+"""
+Command line of the pipeline, with one subcommand per step: 
+    crawl: list the zip links of the EGS site 
+    plan: print the links a conversion would process, from the crawl and the local manifest, without GDAL or S3 
+    convert: download, convert to COG and upload the new links, the default when the first argument is the root url 
+    publish: create the STAC items, thumbnails and mosaics of the COGs already in S3 
+    audit: validate the COGs of an S3 prefix with ranged reads 
+GDAL, boto3 and the other heavy modules are imported by the subcommands that use them, so a short command such as 
+plan or --help starts in a fraction of a second. benchmark.py imports checks the import time against a budget. 
+"""
 
+COMMANDS = ('crawl', 'plan', 'convert', 'publish', 'audit')
+
+
+def _saving_on_error(finished_jobs, state_index): 
+    """
+    Yield the finished jobs, and upload the links already recorded in the index before raising an error of the pipeline, 
+    e.g. a crawl error, so the next run does not process them again 
+    """
+    try: 
+        yield from finished_jobs
+    except Exception: 
+        state_index.sync()
+        raise
 
 # call Main function in command line 
-def main(root_url, years, keyword, bucket_name, folder_path, zip_dir, proj_epsg, xRes, yRes):
+def main(root_url, years, keyword, bucket_name, folder_path, zip_dir, proj_epsg, xRes, yRes, 
+         workers=1, io_workers=4, sync_every=50, manifest_path='manifest.jsonl', crawl_cache=None, archive_cache=None, retries=5, 
+         metrics_path='metrics.jsonl', scratch=None, job_queue=None, mosaic=None, mosaic_cog=False, **job_options):
     """
     Call every function to creat cog and upload to S3 bucket 
+    Downloads and uploads run on two pools of io_workers threads, the GDAL steps on a pool of workers processes. 
+    The uploads have their own pool, as the downloads waiting for scratch space must not hold back the uploads freeing it 
+    :param workers: number of processes for reprojection, COG translation and validation 
+    :param io_workers: number of threads for the crawl, downloads and uploads 
+    :param sync_every: upload manifest.jsonl to S3 every sync_every translated links 
+    :param manifest_path: local copy of manifest.jsonl, the index of the processed links 
+    :param crawl_cache: optional CrawlCache, the directory listings are revalidated instead of downloaded again 
+    :param archive_cache: optional ArchiveCache, the zips already downloaded by a previous run are taken from it 
+    :param retries: number of retries of a failed download, resuming where it stopped 
+    :param metrics_path: local JSON Lines file of the per-link, per-stage metrics, uploaded with run_report.json next to lastRun.txt 
+    :param scratch: optional ScratchSpace of the work directories, the default one is in zip_dir without quota. 
+        The files of a link are deleted as soon as its uploads are confirmed 
+    :param job_queue: optional JobQueue, the years are expanded into jobs of the queue, each link is checkpointed in the 
+        queue as it finishes, and the jobs left by a stopped run or by other workers sharing the queue are picked up 
+        The failed jobs are claimed again in the same run once their retry delay is over 
+    :param mosaic: optional 'year', 'season' or 'month', to update the VRT mosaics per region and time window of the 
+        new COGs after the run, with mosaic_cog the mosaics are also written as COGs, see mosaic.py 
+    :param job_options: options of the pipeline stages added to every job: 
+        read_mode: 'extract' to unzip only the Geotiff, 'vsizip' to read the Geotiff inside the zip through GDAL /vsizip/, 
+            'stream' to read it on the server through /vsizip//vsicurl/, write the COG to /vsimem/ and stream the zip to 
+            S3, without the zip or the COG on disk 
+        two_step: write the reprojected _reprj.tif before the COG instead of creating the COG in a single pass 
+        tile_size: warp the rasters larger than tile_size pixels tile by tile, tile_workers tiles at a time, to bound 
+            the memory of the GDAL workers 
+        profile: GDAL performance profile from gdal_profile.get_profile 
+        thumbnail: 'png' or 'webp' to create a thumbnail from the COG overviews, uploaded next to the COG 
+        thumbnail_size: size in pixels of the longest side of the thumbnail 
+        stac_collection: id of the STAC Collection, to create the STAC Item of every COG and update the Collection extent 
+        profile_link: run the stages of the links containing this substring under a profiler 
+        profiler: 'cprofile' or 'pyinstrument', profile_dir: folder of the profiles 
+        check_source: send a HEAD request for every processed link, and process it again if its zip changed 
+    The links already processed with other parameters (proj_epsg, xRes/yRes, compression) are processed again, 
+    see fingerprint.py 
     """
-    # Step 1: load log.txt content from S3 and create an empty list for lastRun content 
-    filenames = list_files_in_s3(bucket_name, folder_path)
-    if 'log.txt' in filenames:
-        print('Log file exists, loading it from S3 bucket') 
-        log_content = open_file_from_s3(bucket_name, folder_path, file_name='log.txt')
-    else: 
-        # Open the file in read and write mode ('r+')
-        print('Log file does not exist, creating an empty string as the content of log.txt') 
-        log_content = ' '
-    lastRun = ' '
+    from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+    from functools import partial
+    from get_zip_links import crawl_zip_links
+    from s3_operations import upload_fileContent_to_s3
+    from state_index import load_state_index
+    from pipeline import run_pipeline, download_stage, convert_stage, thumbnail_stage, stac_stage, upload_stage
+    from stac_metadata import StacCollection
+    from instrumentation import Instrumented, RunMetrics
+    from scratch_space import MB, ScratchSpace
+    from fingerprint import config_hash, legacy_fingerprint, stale_reason
+    from mosaic import update_mosaics
+    # Step 1: load the index of the processed links from manifest.jsonl in S3, migrating log.txt the first time, 
+    # and create an empty list for lastRun lines 
+    state_index = load_state_index(bucket_name, folder_path, manifest_path, batch_size=sync_every)
+    stac_collection = StacCollection(bucket_name, folder_path, job_options['stac_collection']) if job_options.get('stac_collection') else None
+    lastRun = [' ']
     count = 0 
-    for year in years: 
-        print(f'Start processing the COG for year {year}')
-        # Step 2: get a list of the zip links for specific year  
-        zip_links = get_zip_links(root_url, year, keyword)
-        # Step 3: for each zip url link, check: 
-        # 1) if the link has been translated 
-        # 2) If not translated, pass the link to lastrun list 
-        # 3) Get the full url link, and then download and unzip the file 
-        # 4) Get the geotiff path in the unzipped folder 
-        # 5) Convert the geotiff to vog 
-        # 6) Upload the zip and cog to S3 bucekt 
-        # 7) Update log_content 
-        # 8) Exit loop, upload log_content to S3 bucket as log.txt 
-        for link in zip_links: 
-            print(f'Start processing {link}')
-            if link not in log_content: 
-                print(f'This zip has not been translated and proceed to translation')
-                unzip_dir = download_and_unzip(link, zip_dir)
-                #print(f'unzip_dir is: {unzip_dir}')        
-                geotiff_filename, geotif_path =  geotiff_path(unzip_dir=unzip_dir, format='.tif', keyword = keyword)
-                input_path = os.path.join(os.getcwd(), geotif_path[0])
-                #print(geotiff_filename)
-                #print(geotif_path)
-        
-                reproject_raster(input_path=input_path, dstSRS=proj_epsg, xRes=xRes, yRes=yRes)
-                proj_path=input_path.replace('.tif', '_reprj.tif')
-                output_path = input_path.replace('.tif', '_cog.tif')
-        
-                # Extract datetime from the file name 
-                time_str = link.split('_')[-1].split('.')[0]
-                date_str = link.split('_')[-2].split('.')[0]
-                timestamp =date_str  +"_" + time_str
-                datetime_obj = datetime.strptime(timestamp, '%Y%m%d_%H%M%S')
-                formatted_datetime = datetime_obj.strftime('%Y:%m:%d %H:%M:%S')
-                #print(formatted_datetime)
-
-                is_valid = geotiff_to_cog(proj_path, output_path, datetime_value=formatted_datetime)
-                #print_gdal_info(output_path, print_keys=True)
-                #TODO upload cog to datacube S3 
-                zip_file_path = os.path.join(os.getcwd(), unzip_dir)
-                zip_file_path = zip_file_path + '.zip'
-                  
-                upload_file_to_s3(bucket_name, folder_path=folder_path+'zip/', local_file_path=zip_file_path, new_file_name=os.path.basename(zip_file_path))
-                upload_file_to_s3(bucket_name, folder_path=folder_path+'cog/', local_file_path=output_path, new_file_name=os.path.basename(geotif_path[0]))
-                    
-                count += 1
-                log_content = log_content + '\n' + link
-                lastRun = lastRun + '\n' + is_valid
-            else:
-                print(f'{link} has been translated') 
-        #Upload log.txt to S3 after running for each year 
-        upload_fileContent_to_s3(bucket_name, file_key=folder_path + 'log.txt', file_content=log_content)
+    metrics = RunMetrics(metrics_path)
+    scratch = scratch or ScratchSpace(zip_dir)
+    scratch.cleanup()
+    # Hash of the parameters of this run that change the COGs, kept in the fingerprint of every processed link. 
+    # The links processed before the fingerprints get a legacy fingerprint assuming this run's parameters, 
+    # without being processed again 
+    config = config_hash(dict(job_options, proj_epsg=proj_epsg, xRes=xRes, yRes=yRes))
+    legacy = [url for url, record in state_index.records.items() if 'fingerprint' not in record]
+    for url in legacy: 
+        state_index.update(url, sync=False, fingerprint=legacy_fingerprint(config))
+    if legacy: 
+        print(f'{len(legacy)} links processed before the fingerprints are considered up to date')
+    # Step 2: crawl the zip links of every year in one pass, and yield the links that have not been translated.
+    # The crawl runs while the first links are already processed. 
+    # With a job queue, the years not expanded yet are crawled into the queue, and the jobs are claimed one by one 
+    def make_job(link, previous_fingerprint=None): 
+        return dict(job_options, link=link, keyword=keyword, zip_dir=zip_dir, 
+                    proj_epsg=proj_epsg, xRes=xRes, yRes=yRes, 
+                    bucket_name=bucket_name, folder_path=folder_path, 
+                    fingerprint={'config': config}, previous_fingerprint=previous_fingerprint)
+    def job_of(link): 
+        """
+        Return the job of a link if it must be processed, None if it is up to date 
+        """
+        record = state_index.get(link)
+        reason = stale_reason(record, config)
+        if reason == 'new': 
+            print(f'{link} has not been translated and proceed to translation')
+            return make_job(link)
+        if reason: 
+            print(f'{link} was translated with other parameters and proceed to translation')
+            return make_job(link)
+        if job_options.get('check_source'): 
+            # The download stage compares the zip on the server with the fingerprint 
+            return make_job(link, previous_fingerprint=record['fingerprint'])
+        print(f'{link} has been translated') 
+        return None
+    def new_jobs(): 
+        for link in metrics.timed(crawl_zip_links(root_url, years, [keyword], max_workers=io_workers, cache=crawl_cache), 'crawl'): 
+            job = job_of(link)
+            if job is not None: 
+                yield job
+    def expand_queue(): 
+        job_queue.reset_worker()
+        # The years of the past are crawled once, the current year again on every run as it still gets new links. 
+        # The years whose crawl failed are crawled again on the next run 
+        job_queue.plan(keyword, years, refresh=[year for year in years if year >= datetime.now().year])
+        failed_years = job_queue.expand(keyword, lambda year: metrics.timed(crawl_zip_links(root_url, [year], [keyword], max_workers=io_workers, 
+                                                                                            cache=crawl_cache, raise_errors=True), 'crawl'))
+        if failed_years: 
+            lastRun.append(f'Crawl of {keyword} {", ".join(map(str, failed_years))} failed, crawled again on the next run')
+        # The done jobs out of date are claimed again, all of them to check their source 
+        if job_options.get('check_source'): 
+            requeued = job_queue.requeue_done(keyword)
+        else: 
+            requeued = job_queue.requeue_done(keyword, [url for url, record in state_index.records.items() if stale_reason(record, config)])
+        if requeued: 
+            print(f'{requeued} done jobs of {keyword} are checked again')
+    def queued_jobs(): 
+        while True: 
+            claimed = job_queue.claim(keyword)
+            if claimed is None: 
+                return
+            queue_id, link = claimed
+            job = job_of(link)
+            if job is None: 
+                job_queue.done(queue_id, {'cog_key': state_index.get(link).get('cog_key')})
+                continue
+            yield dict(job, queue_id=queue_id)
+    # Step 3: send the links through the pipeline stages: 
+    # 1) download and unzip the file, get the geotiff path in the unzipped folder (io_pool)
+    # 2) reproject, convert the geotiff to cog and validate it (gdal_pool)
+    # 3) Upload the zip and cog to S3 bucekt (upload_pool), with the thumbnail created from the cog overviews and the 
+    #    STAC item created from the cog header if asked (gdal_pool)
+    # 4) Record each link in the index as it finishes, manifest.jsonl is uploaded every sync_every links, 
+    #    and grow the extent of the STAC collection 
+    # 5) Exit loop, upload manifest.jsonl, collection.json, and log.txt for the tools still reading it 
+    with ThreadPoolExecutor(max_workers=io_workers) as io_pool, ThreadPoolExecutor(max_workers=io_workers) as upload_pool, \
+            ProcessPoolExecutor(max_workers=workers) as gdal_pool: 
+        stages = [(partial(download_stage, archive_cache=archive_cache, retries=retries, scratch=scratch), io_pool, io_workers), 
+                  (convert_stage, gdal_pool, workers), 
+                  (upload_stage, upload_pool, io_workers)]
+        if job_options.get('thumbnail'): 
+            stages.insert(-1, (thumbnail_stage, gdal_pool, workers))
+        if stac_collection: 
+            stages.insert(-1, (stac_stage, gdal_pool, workers))
+        # Record the time, bytes, peak memory and retries of every stage in job['metrics'] 
+        stages = [(Instrumented(fn), executor, limit) for fn, executor, limit in stages]
+        def finished_jobs(): 
+            if job_queue is None: 
+                yield from run_pipeline(new_jobs(), stages, queue_size=max(workers, io_workers))
+                return
+            expand_queue()
+            # The jobs that failed in a pass are pending again after their retry delay, they are claimed in another pass 
+            while True: 
+                yield from run_pipeline(queued_jobs(), stages, queue_size=max(workers, io_workers))
+                retry_in = job_queue.next_retry(keyword)
+                if retry_in is None: 
+                    return
+                print(f'Waiting {retry_in:.0f} seconds for the retry delay of the failed jobs of {keyword}')
+                time.sleep(retry_in)
+        for job in _saving_on_error(finished_jobs(), state_index): 
+            metrics.add(job)
+            # The uploads are confirmed or the job failed, free its scratch space for the next downloads 
+            if job.get('work_dir'): 
+                scratch.release(job['work_dir'])
+            if job.get('unchanged'): 
+                print(f'{job["link"]} has been translated and is unchanged on the server')
+                if job['fingerprint'] != job['previous_fingerprint']: 
+                    state_index.update(job['link'], fingerprint=job['fingerprint'])
+                if job.get('queue_id'): 
+                    job_queue.done(job['queue_id'], {'cog_key': state_index.get(job['link']).get('cog_key')})
+                continue
+            if job.get('error'): 
+                print(f'Failed to process {job["link"]}: {job["error"]}')
+                lastRun.append(f'{job["link"]} failed: {job["error"]}')
+                if job.get('queue_id') and job_queue.failed(job['queue_id'], job['error']): 
+                    print(f'{job["link"]} will be claimed again after {job_queue.retry_delay:.0f} seconds or more')
+                continue
+            print(f'Finished processing {job["link"]}')
+            count += 1
+            state_index.add(job['link'], sha256=job['download'].get('sha256'), cog_key=job['cog_key'], validation=job['is_valid'], 
+                            fingerprint=job['fingerprint'])
+            if job.get('queue_id'): 
+                job_queue.done(job['queue_id'], {'cog_key': job['cog_key']})
+            if stac_collection: 
+                stac_collection.add(job['stac_item'])
+            lastRun.append(job['is_valid'])
+    #Upload manifest.jsonl, merged with the records of the other workers, collection.json and log.txt to S3 after the run 
+    state_index.publish()
+    if stac_collection: 
+        stac_collection.save()
+    if count: 
+        upload_fileContent_to_s3(bucket_name, file_key=folder_path + 'log.txt', file_content=state_index.log_text())
+    if count and mosaic: 
+        update_mosaics(bucket_name, folder_path, period=mosaic, cog=mosaic_cog, workers=io_workers, profile=job_options.get('profile'))
     # Upload the lastRun.txt to s3
+    lastRun = '\n'.join(lastRun)
     upload_fileContent_to_s3(bucket_name, file_key=folder_path + 'lastRun.txt', file_content=lastRun)
+    print(f'Peak scratch space reserved: {scratch.peak_reserved / MB:.0f} MB')
+    # Upload metrics.jsonl and run_report.json next to lastRun.txt 
+    print(metrics.upload(bucket_name, folder_path))
     return lastRun
 
-# Set up argument parsing
-if __name__ == "__main__":
+def plan(root_url, years, keyword, folder_path, proj_epsg, xRes, yRes, manifest_path='manifest.jsonl', crawl_cache=None, io_workers=4, **job_options): 
     """
-    root_url = 'https://data.eodms-sgdot.nrcan-rncan.gc.ca' 
-    years = [year for year in range(2005, 2024)]
-    keyword = 'RiverIce' 
-    bucket_name = 'nrcan-egs-product-archive'
-    folder_path='Datacube/RiverIce/'
-    zip_dir = 'zip_test'
-    proj_epsg = 'EPSG:3978'
-    xRes=5
-    yRes=5
+    Print the work plan of main without GDAL or S3: the links of the crawl that are new or were processed with other 
+    parameters, from the local copy of manifest.jsonl left by the last run on this machine 
+    :return: dict reason -> number of links, reasons are 'new', 'parameters changed', 'check source' and 'up to date' 
     """
-    parser = argparse.ArgumentParser(description='Process EGS-publish-to-datacube parameters.')
+    from get_zip_links import crawl_zip_links
+    from state_index import StateIndex
+    from fingerprint import config_hash, stale_reason
+    state_index = StateIndex(manifest_path)
+    config = config_hash(dict(job_options, proj_epsg=proj_epsg, xRes=xRes, yRes=yRes))
+    counts = {}
+    for link in crawl_zip_links(root_url, years, [keyword], max_workers=io_workers, cache=crawl_cache): 
+        reason = stale_reason(state_index.get(link), config) or ('check source' if job_options.get('check_source') else 'up to date')
+        counts[reason] = counts.get(reason, 0) + 1
+        if reason != 'up to date': 
+            print(f'{reason}: {link}')
+    print(f'Plan of {keyword} to {folder_path}: ' + (', '.join(f'{count} {reason}' for reason, count in sorted(counts.items())) or 'no link'))
+    return counts
+
+def product_path(path, product, products): 
+    """
+    Local file of a product, path with '{keyword}' formatted, or with the product appended when there are several 
+    """
+    if '{keyword}' in path: 
+        return path.format(keyword=product)
+    if len(products) > 1: 
+        root, extension = os.path.splitext(path)
+        return f'{root}_{product}{extension}'
+    return path
+
+def add_s3_arguments(parser): 
+    parser.add_argument('--s3-endpoint', type=str, default=None, help='Endpoint of a local S3 stand-in such as moto or MinIO')
+    parser.add_argument('--s3-pool', type=int, default=32, help='Number of connections pooled by the shared S3 client')
+    parser.add_argument('--multipart-threshold-mb', type=int, default=64, help='Files larger than this are uploaded in parts')
+    parser.add_argument('--multipart-chunk-mb', type=int, default=16, help='Size of the parts of the multipart uploads')
+    parser.add_argument('--multipart-concurrency', type=int, default=8, help='Number of parts of a file uploaded at the same time')
+
+def configure_s3_from_args(args): 
+    from s3_operations import MB, configure_s3
+    configure_s3(max_pool_connections=args.s3_pool, multipart_threshold=args.multipart_threshold_mb * MB, 
+                 multipart_chunksize=args.multipart_chunk_mb * MB, max_concurrency=args.multipart_concurrency)
+    if args.s3_endpoint: 
+        configure_s3(endpoint_url=args.s3_endpoint)
+
+def add_crawl_arguments(parser): 
+    parser.add_argument('--products', type=str, nargs='+', default=[], help="More EGS products processed after keyword, use '{keyword}' in folder_path, e.g. 'Datacube/{keyword}/'")
+    parser.add_argument('--io-workers', type=int, default=4, help='Number of threads for the crawl, downloads and uploads')
+    parser.add_argument('--crawl-cache', type=str, default='crawl_cache.json', help='Local file caching the EGS directory listings')
+    parser.add_argument('--refresh', action='store_true', help='Ignore the crawl cache and download every directory listing again')
 
+def add_convert_arguments(parser): 
     parser.add_argument('root_url', type=str, help='Root URL')
     parser.add_argument('years', type=int, nargs='+', help='List of years')
     parser.add_argument('keyword', type=str, help='Keyword')
@@ -112,13 +292,187 @@ if __name__ == "__main__":
     parser.add_argument('proj_epsg', type=str, help='Projection EPSG code')
     parser.add_argument('xRes', type=float, help='Resolution in X')
     parser.add_argument('yRes', type=float, help='Resolution in Y')
+    parser.add_argument('--dry-run', action='store_true', help='Print the links to process, from the crawl and the local manifest, without GDAL or S3')
+    parser.add_argument('--workers', type=int, default=1, help='Number of processes for the GDAL steps (reproject, COG, validate)')
+    add_crawl_arguments(parser)
+    parser.add_argument('--manifest', type=str, default='manifest.jsonl', help='Local copy of manifest.jsonl, the index of the processed links')
+    parser.add_argument('--sync-every', type=int, default=50, help='Upload manifest.jsonl to S3 every N translated links')
+    parser.add_argument('--read-mode', choices=['extract', 'vsizip', 'stream'], default='extract', 
+                        help='extract: unzip only the Geotiff, vsizip: read the Geotiff inside the zip without extracting it, '
+                             'stream: read the zip on the server and write the COG in memory, nothing large on disk')
+    parser.add_argument('--archive-cache', type=str, default=None, help='Local folder caching the downloaded zips, so they are never downloaded twice')
+    parser.add_argument('--retries', type=int, default=5, help='Number of retries of a failed download')
+    parser.add_argument('--two-step', action='store_true', help='Write the reprojected _reprj.tif before the COG instead of a single warp-to-COG pass')
+    parser.add_argument('--tile-size', type=int, default=None, help='Warp the rasters larger than this many pixels tile by tile, to bound the memory of the workers')
+    parser.add_argument('--tile-workers', type=int, default=1, help='Number of tiles of a raster warped at the same time')
+    add_profile_arguments(parser)
+    parser.add_argument('--thumbnail', choices=['png', 'webp'], default=None, help='Create a thumbnail of every COG from its overviews, uploaded next to it')
+    parser.add_argument('--stac', action='store_true', help='Create the STAC Item of every COG and update the STAC Collection')
+    parser.add_argument('--stac-collection', type=str, default=None, help='Id of the STAC Collection, the keyword by default')
+    parser.add_argument('--thumbnail-size', type=int, default=600, help='Size in pixels of the longest side of the thumbnails')
+    parser.add_argument('--scratch-dir', type=str, default=None, help='Folder of the work directories of the links, zip_dir by default')
+    parser.add_argument('--tmpfs', action='store_true', help='Put the work directories on tmpfs (/dev/shm) when the system has one')
+    parser.add_argument('--scratch-quota-gb', type=float, default=None, help='Maximum scratch space reserved at once, downloads wait for it')
+    parser.add_argument('--scratch-expansion', type=float, default=4, help='Scratch space reserved for a link, as a multiple of its zip size')
+    parser.add_argument('--keep-files', action='store_true', help='Keep the zips and the Geotiffs after the upload')
+    parser.add_argument('--metrics', type=str, default='metrics.jsonl', help='Local JSON Lines file of the per-link, per-stage metrics')
+    parser.add_argument('--profile-link', type=str, default=None, help='Profile the stages of the links containing this substring')
+    parser.add_argument('--profiler', choices=['cprofile', 'pyinstrument'], default='cprofile', help='Profiler of --profile-link')
+    parser.add_argument('--profile-dir', type=str, default='profiles', help='Folder of the profiles of --profile-link')
+    parser.add_argument('--mosaic', choices=['year', 'season', 'month'], default=None, help='Update the VRT mosaics per region and time window after the run')
+    parser.add_argument('--mosaic-cog', action='store_true', help='Also write the mosaics of --mosaic as COGs')
+    parser.add_argument('--check-source', action='store_true', help='Check with a HEAD request if the zips already processed changed on the server')
+    parser.add_argument('--queue', type=str, default=None, help='SQLite work queue, the runs resume from it and several workers can share it')
+    parser.add_argument('--worker-id', type=str, default=None, help='Name of this worker in the queue, {host}-{pid} by default. '
+                        'A fixed id lets the next run resume its interrupted jobs at once, give each process its own')
+    parser.add_argument('--lease-minutes', type=float, default=120, help='Minutes after which a job claimed by a stopped worker is claimed again')
+    parser.add_argument('--max-attempts', type=int, default=3, help='Number of claims of a failed job of the queue before it stays failed')
+    parser.add_argument('--retry-minutes', type=float, default=1, help='Minutes before a failed job of the queue is claimed again, times its attempts')
+    add_s3_arguments(parser)
 
-    args = parser.parse_args()
+def run_crawl(args): 
+    from get_zip_links import crawl_zip_links
+    from crawl_cache import CrawlCache
+    crawl_cache = CrawlCache(args.crawl_cache, refresh=args.refresh)
+    keywords = [args.keyword] + [product for product in args.products if product != args.keyword]
+    links = list(crawl_zip_links(args.root_url, args.years, keywords, max_workers=args.io_workers, cache=crawl_cache))
+    if args.output: 
+        with open(args.output, 'w') as file: 
+            file.write(''.join(link + '\n' for link in links))
+    else: 
+        print('\n'.join(links))
+    print(f'{len(links)} zip links of {", ".join(keywords)} in {args.years[0]}-{args.years[-1]}')
+
+def run_convert(args): 
+    from crawl_cache import CrawlCache
+    crawl_cache = CrawlCache(args.crawl_cache, refresh=args.refresh)
+    products = [args.keyword] + [product for product in args.products if product != args.keyword]
+    profile = profile_from_args(args, workers=args.workers)
+    if args.dry_run: 
+        for product in products: 
+            plan(args.root_url, args.years, product, args.folder_path.replace('{keyword}', product), args.proj_epsg, args.xRes, args.yRes, 
+                 manifest_path=product_path(args.manifest, product, products), crawl_cache=crawl_cache, io_workers=args.io_workers, 
+                 two_step=args.two_step, profile=profile, check_source=args.check_source)
+        return
+    from archive_cache import ArchiveCache
+    from scratch_space import MB, ScratchSpace, tmpfs_root
+    from job_queue import JobQueue
+    configure_s3_from_args(args)
+    archive_cache = ArchiveCache(args.archive_cache) if args.archive_cache else None
+    scratch_dir = args.scratch_dir or args.zip_dir
+    if args.tmpfs: 
+        scratch_dir = tmpfs_root() or scratch_dir
+        print(f'Scratch space in {scratch_dir}')
+    scratch = ScratchSpace(scratch_dir, quota_bytes=int(args.scratch_quota_gb * 1024 * MB) if args.scratch_quota_gb else None, 
+                           expansion=args.scratch_expansion, keep=args.keep_files)
+
+    job_queue = JobQueue(args.queue, worker_id=args.worker_id, lease_seconds=args.lease_minutes * 60, max_attempts=args.max_attempts, 
+                         retry_delay=args.retry_minutes * 60) if args.queue else None
+    for product in products: 
+        lastRun = main(args.root_url, args.years, product, args.bucket_name, args.folder_path.replace('{keyword}', product), args.zip_dir, args.proj_epsg, args.xRes, args.yRes, 
+                       workers=args.workers, io_workers=args.io_workers, sync_every=args.sync_every, manifest_path=product_path(args.manifest, product, products), crawl_cache=crawl_cache, 
+                       read_mode=args.read_mode, archive_cache=archive_cache, retries=args.retries, 
+                       two_step=args.two_step, tile_size=args.tile_size, tile_workers=args.tile_workers, profile=profile, 
+                       thumbnail=args.thumbnail, thumbnail_size=args.thumbnail_size, 
+                       stac_collection=(args.stac_collection or product) if args.stac else None, metrics_path=product_path(args.metrics, product, products), scratch=scratch, 
+                       job_queue=job_queue, profile_link=args.profile_link, profiler=args.profiler, profile_dir=args.profile_dir, 
+                       check_source=args.check_source, mosaic=args.mosaic, mosaic_cog=args.mosaic_cog)
+        print(f'The lastRun logging of {product} is,  \n{lastRun}')
+    if job_queue is not None: 
+        print(f'Jobs in the queue: {job_queue.counts()}')
+
+def run_publish(args): 
+    """
+    Create the thumbnails, then the STAC items linking them, then the mosaics of the COGs in {folder_path}cog/ 
+    """
+    configure_s3_from_args(args)
+    if args.thumbnail: 
+        from create_thumbnail import prefix_thumbnails
+        prefix_thumbnails(args.bucket_name, args.folder_path + 'cog/', workers=args.workers, max_size=args.thumbnail_size, format=args.thumbnail)
+    if args.stac: 
+        from stac_metadata import prefix_items
+        prefix_items(args.bucket_name, args.folder_path, args.stac_collection or args.folder_path.strip('/').split('/')[-1], workers=args.workers)
+    if args.mosaic: 
+        from mosaic import update_mosaics
+        update_mosaics(args.bucket_name, args.folder_path, period=args.mosaic, cog=args.mosaic_cog, workers=args.workers)
 
-    lastRun = main(args.root_url, args.years, args.keyword, args.bucket_name, args.folder_path, args.zip_dir, args.proj_epsg, args.xRes, args.yRes)
-    print(f'The lastRun logging is,  \n{lastRun}')
+def run_audit(args): 
+    from cog_validator import audit
+    configure_s3_from_args(args)
+    audit(args.bucket_name, args.folder_path, workers=args.workers, report_path=args.report)
+
+def parse_args(argv): 
+    """
+    Parse the command line, a command line starting with the root url runs convert as before the subcommands 
+    """
+    if argv and argv[0] not in COMMANDS and not argv[0].startswith('-'): 
+        argv = ['convert'] + list(argv)
+    parser = argparse.ArgumentParser(description='Process EGS-publish-to-datacube parameters.')
+    subparsers = parser.add_subparsers(dest='command')
+    crawl = subparsers.add_parser('crawl', help='List the zip links of the EGS site')
+    crawl.add_argument('root_url', type=str, help='Root URL')
+    crawl.add_argument('years', type=int, nargs='+', help='List of years')
+    crawl.add_argument('keyword', type=str, help='Keyword')
+    crawl.add_argument('--output', type=str, default=None, help='Text file of the links, one per line, printed by default')
+    add_crawl_arguments(crawl)
+    plan_parser = subparsers.add_parser('plan', help='Print the links convert would process, without GDAL or S3')
+    add_convert_arguments(plan_parser)
+    plan_parser.set_defaults(dry_run=True)
+    convert = subparsers.add_parser('convert', help='Convert the new links to COG and upload them, the default command')
+    add_convert_arguments(convert)
+    publish = subparsers.add_parser('publish', help='Create the thumbnails, STAC items and mosaics of the COGs already in S3')
+    publish.add_argument('bucket_name', type=str, help='Bucket name')
+    publish.add_argument('folder_path', type=str, help="S3 folder prefix of the product, e.g. 'Datacube/RiverIce/'")
+    publish.add_argument('--thumbnail', choices=['png', 'webp'], default=None, help='Create the missing thumbnails')
+    publish.add_argument('--thumbnail-size', type=int, default=600, help='Size in pixels of the longest side of the thumbnails')
+    publish.add_argument('--stac', action='store_true', help='Create the missing STAC items and update the collection')
+    publish.add_argument('--stac-collection', type=str, default=None, help='Id of the STAC Collection, the last folder of folder_path by default')
+    publish.add_argument('--mosaic', choices=['year', 'season', 'month'], default=None, help='Update the VRT mosaics per region and time window')
+    publish.add_argument('--mosaic-cog', action='store_true', help='Also write the mosaics as COGs')
+    publish.add_argument('--workers', type=int, default=os.cpu_count() or 1, help='Number of processes or threads')
+    add_s3_arguments(publish)
+    audit = subparsers.add_parser('audit', help='Validate the COGs of an S3 prefix with ranged reads')
+    audit.add_argument('bucket_name', type=str, help='Bucket name')
+    audit.add_argument('folder_path', type=str, help="Prefix of the COGs, e.g. 'Datacube/RiverIce/cog/'")
+    audit.add_argument('--workers', type=int, default=16, help='Number of COGs validated at the same time')
+    audit.add_argument('--report', type=str, default='audit_report.json', help='Local JSON file of the report')
+    add_s3_arguments(audit)
+    args = parser.parse_args(argv)
+    if args.command is None: 
+        parser.print_help()
+        sys.exit(2)
+    return args
+
+# Set up argument parsing
+if __name__ == "__main__":
+    """
+    root_url = 'https://data.eodms-sgdot.nrcan-rncan.gc.ca' 
+    years = [year for year in range(2005, 2024)]
+    keyword = 'RiverIce' 
+    bucket_name = 'nrcan-egs-product-archive'
+    folder_path='Datacube/RiverIce/'
+    zip_dir = 'zip_test'
+    proj_epsg = 'EPSG:3978'
+    xRes=5
+    yRes=5
+    """
+    args = parse_args(sys.argv[1:])
+    commands = {'crawl': run_crawl, 'plan': run_convert, 'convert': run_convert, 'publish': run_publish, 'audit': run_audit}
+    commands[args.command](args)
 """    
 # Run the scripts from the termial 
 # Note that [years] should be a space-separated list of integers (e.g., 2005 2006 2007).
 python main.py "https://data.eodms-sgdot.nrcan-rncan.gc.ca" 2005 2006 2007 "RiverIce" "nrcan-egs-product-archive" "Datacube/RiverIce/" "zip_test" "EPSG:3978" 5 5
+# Same as 
+python main.py convert "https://data.eodms-sgdot.nrcan-rncan.gc.ca" 2005 2006 2007 "RiverIce" "nrcan-egs-product-archive" "Datacube/RiverIce/" "zip_test" "EPSG:3978" 5 5
+# Print the links that would be processed, without GDAL or S3 
+python main.py plan "https://data.eodms-sgdot.nrcan-rncan.gc.ca" 2005 2006 2007 "RiverIce" "nrcan-egs-product-archive" "Datacube/RiverIce/" "zip_test" "EPSG:3978" 5 5
+# Run with 4 GDAL processes and 8 download/upload threads 
+python main.py "https://data.eodms-sgdot.nrcan-rncan.gc.ca" 2005 2006 2007 "RiverIce" "nrcan-egs-product-archive" "Datacube/RiverIce/" "zip_test" "EPSG:3978" 5 5 --workers 4 --io-workers 8
+# Two products from a work queue, run the same command on other nodes sharing queue.sqlite with their own --worker-id 
+python main.py "https://data.eodms-sgdot.nrcan-rncan.gc.ca" 2005 2006 2007 "RiverIce" "nrcan-egs-product-archive" "Datacube/{keyword}/" "zip_test" "EPSG:3978" 5 5 --products Flood --queue queue.sqlite
+# The other steps 
+python main.py crawl "https://data.eodms-sgdot.nrcan-rncan.gc.ca" 2005 2006 2007 "RiverIce" --output links.txt
+python main.py publish "nrcan-egs-product-archive" "Datacube/RiverIce/" --thumbnail png --stac --mosaic season
+python main.py audit "nrcan-egs-product-archive" "Datacube/RiverIce/cog/" --workers 32
 """
@@ -0,0 +1,293 @@
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from get_zip_links import get_link_datetime
+from stac_metadata import s3_url
+"""
+Mosaics of the published COGs, per region and time window, so a river can be seen for a season in a single file.
+The scenes of {folder_path}cog/ are grouped by the region of their filename (RiverIce_CAN_ON_... -> CAN_ON, the
+CAN/province folders of the EGS site) and by year, season or month, and every group gets a GDAL VRT under
+{folder_path}mosaic/{period}/{region}/{window}.vrt, and optionally the same mosaic materialized as a COG.
+The VRT only references the COGs by their public urls (/vsicurl/), the latest scene is drawn on top.
+The bounds of the scenes are read once from the COG headers and kept in {folder_path}mosaic/index.json, so a new run
+only reads the headers of the new scenes. The index also keeps, for every view ({period}, or {period}/{area} for an
+area of interest), the signature of the scenes of every mosaic built, so a run rebuilds the mosaics whose scenes
+changed, the ones never built in this view or that failed, and deletes the mosaics left without scenes.
+The mosaics of an area of interest (bbox) select their scenes with an in-memory R-tree of the bounds.
+"""
+
+PERIODS = ('year', 'season', 'month')
+# Meteorological seasons, December counts in the winter of the next year
+SEASONS = {12: 'winter', 1: 'winter', 2: 'winter', 3: 'spring', 4: 'spring', 5: 'spring',
+           6: 'summer', 7: 'summer', 8: 'summer', 9: 'fall', 10: 'fall', 11: 'fall'}
+
+
+def mosaic_prefix(folder_path):
+    return folder_path + 'mosaic/'
+
+
+def region_of(name):
+    """
+    Return the region of a scene from its filename, e.g. RiverIce_CAN_ON_Moose_20160503_232950.tif -> CAN_ON
+    """
+    return '_'.join(os.path.basename(name).split('_')[1:3])
+
+
+def time_window(value, period='season'):
+    """
+    Return the time window of a datetime: '2016' for year, '2016-spring' for season, '2016-05' for month
+    """
+    if period == 'year':
+        return str(value.year)
+    if period == 'month':
+        return value.strftime('%Y-%m')
+    if period == 'season':
+        return f'{value.year + (value.month == 12)}-{SEASONS[value.month]}'
+    raise ValueError(f'Unknown period {period}, choose from {", ".join(PERIODS)}')
+
+
+def scene_bounds(path):
+    """
+    Return the [minX, minY, maxX, maxY] bounds of a raster in its projection, from its header only
+    """
+    from osgeo import gdal
+    ds = gdal.Open(path)
+    if ds is None:
+        raise RuntimeError(f'GDAL could not open {path}')
+    x0, dx, rx, y0, ry, dy = ds.GetGeoTransform()
+    xs = [x0, x0 + ds.RasterXSize * dx + ds.RasterYSize * rx]
+    ys = [y0, y0 + ds.RasterXSize * ry + ds.RasterYSize * dy]
+    ds = None
+    return [min(xs), min(ys), max(xs), max(ys)]
+
+
+class MosaicIndex:
+    def __init__(self, bucket_name, folder_path):
+        """
+        Bounds, datetime and region of the published COGs, loaded from {folder_path}mosaic/index.json if it exists
+        :param bucket_name: name of the bucket
+        :param folder_path: S3 folder prefix of the product, e.g. 'Datacube/RiverIce/'
+        """
+        from s3_operations import file_exists_in_s3, open_file_from_s3
+        self.bucket_name = bucket_name
+        self.folder_path = folder_path
+        self.scenes = {}
+        # view -> group -> signature of the scenes of the mosaic built
+        self.mosaics = {}
+        self.keys = []
+        self.changed = False
+        self._rtree = None
+        if file_exists_in_s3(bucket_name, mosaic_prefix(folder_path) + 'index.json'):
+            content = open_file_from_s3(bucket_name, mosaic_prefix(folder_path), file_name='index.json')
+            if content is False:
+                raise RuntimeError(f'{mosaic_prefix(folder_path)}index.json exists in {bucket_name} but could not be read')
+            content = json.loads(content)
+            self.scenes = content['scenes']
+            self.mosaics = content.get('mosaics', {})
+            print(f'index.json loaded with {len(self.scenes)} scenes')
+
+    def _read_scene(self, key, etag):
+        return key, {'etag': etag, 'bounds': scene_bounds(f'/vsis3/{self.bucket_name}/{key}'),
+                     'datetime': get_link_datetime(key).strftime('%Y-%m-%dT%H:%M:%SZ'), 'region': region_of(key)}
+
+    def update(self, workers=8):
+        """
+        List {folder_path}cog/, read the headers of the new or replaced COGs on workers threads and drop the deleted ones
+        :return: dict key -> scene of the scenes added, replaced or deleted, with their previous scene when replaced or deleted
+        """
+        from geotiff_to_cog import use_s3_endpoint
+        from s3_inventory import S3Inventory
+        use_s3_endpoint()
+        objects = {key: meta for key, meta in S3Inventory(self.bucket_name).keys(self.folder_path + 'cog/').items()
+                   if key.endswith('.tif')}
+        affected = {key: scene for key, scene in self.scenes.items() if key not in objects}
+        for key in affected:
+            del self.scenes[key]
+        new = {key: meta['etag'] for key, meta in objects.items()
+               if key not in self.scenes or self.scenes[key]['etag'] != meta['etag']}
+        print(f'{len(new)} new or replaced scenes, {len(affected)} deleted scenes in {self.bucket_name}/{self.folder_path}cog/')
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            futures = [pool.submit(self._read_scene, key, etag) for key, etag in new.items()]
+            for future in futures:
+                try:
+                    key, scene = future.result()
+                except Exception as e:
+                    print(f'Failed to read the header of a scene: {e!r}')
+                    continue
+                if key in self.scenes:
+                    affected[key + '#previous'] = self.scenes[key]
+                self.scenes[key] = affected[key] = scene
+        if affected:
+            self.changed = True
+            self._rtree = None
+        return affected
+
+    def spatial_index(self):
+        """
+        Return the R-tree of the scene bounds, bulk loaded in memory, ids are positions in self.keys
+        """
+        if self._rtree is None:
+            from rtree import index as rtree_index
+            self.keys = sorted(self.scenes)
+            self._rtree = rtree_index.Index((i, tuple(self.scenes[key]['bounds']), None) for i, key in enumerate(self.keys))
+        return self._rtree
+
+    def query(self, bbox):
+        """
+        Return the keys of the scenes intersecting bbox [minX, minY, maxX, maxY], in the projection of the COGs
+        """
+        if not self.scenes:
+            return []
+        return [self.keys[i] for i in self.spatial_index().intersection(tuple(bbox))]
+
+    def signature(self, sources):
+        """
+        Return a short hash of the keys and ETags of the scenes of a mosaic, in drawing order
+        """
+        text = json.dumps([[key, self.scenes[key]['etag']] for key in sources])
+        return hashlib.sha256(text.encode('utf-8')).hexdigest()[:16]
+
+    def record(self, view, group, signature):
+        """
+        Record the signature of a mosaic built, or forget the mosaic with signature None
+        """
+        built = self.mosaics.setdefault(view, {})
+        if signature is None:
+            built.pop(group, None)
+        else:
+            built[group] = signature
+        self.changed = True
+
+    def save(self):
+        """
+        Upload index.json if scenes or mosaics changed since it was loaded
+        """
+        from s3_operations import upload_fileContent_to_s3
+        if not self.changed:
+            return True
+        uploaded = upload_fileContent_to_s3(self.bucket_name, file_key=mosaic_prefix(self.folder_path) + 'index.json',
+                                            file_content=json.dumps({'scenes': self.scenes, 'mosaics': self.mosaics}))
+        self.changed = not uploaded
+        return uploaded
+
+
+def group_name(scene, period='season', area=None):
+    """
+    Return the group of a scene, {region}/{window}, or {area}/{window} for the mosaics of an area of interest
+    """
+    window = time_window(datetime.strptime(scene['datetime'], '%Y-%m-%dT%H:%M:%SZ'), period)
+    return f'{area or scene["region"]}/{window}'
+
+
+def build_mosaic(bucket_name, key_base, sources, cog=False, profile=None):
+    """
+    Write the VRT of the sources to {key_base}.vrt, and with cog the mosaic materialized to {key_base}.tif
+    :param sources: S3 keys of the COGs, the last one is drawn on top
+    :param profile: optional GDAL profile from gdal_profile.get_profile for the COG mosaic
+    """
+    from osgeo import gdal
+    from gdal_profile import cog_creation_options
+    from s3_operations import upload_fileContent_to_s3, upload_file_to_s3
+    work_dir = tempfile.mkdtemp(prefix='mosaic_')
+    try:
+        vrt_path = os.path.join(work_dir, 'mosaic.vrt')
+        vrt_ds = gdal.BuildVRT(vrt_path, ['/vsicurl/' + s3_url(bucket_name, key) for key in sources],
+                               options=gdal.BuildVRTOptions(resolution='highest', srcNodata=0, VRTNodata=0))
+        if vrt_ds is None:
+            raise RuntimeError(f'gdal.BuildVRT failed for {key_base}: {gdal.GetLastErrorMsg()}')
+        vrt_ds = None
+        with open(vrt_path, 'r') as file:
+            if not upload_fileContent_to_s3(bucket_name, file_key=key_base + '.vrt', file_content=file.read()):
+                raise RuntimeError(f'Failed to upload {key_base}.vrt')
+        if cog:
+            cog_path = os.path.join(work_dir, 'mosaic.tif')
+            ds = gdal.Translate(cog_path, vrt_path, options=gdal.TranslateOptions(format='COG', creationOptions=cog_creation_options(profile)))
+            ds = None
+            folder_path, _, name = key_base.rpartition('/')
+            if not upload_file_to_s3(bucket_name, folder_path + '/', cog_path, name + '.tif'):
+                raise RuntimeError(f'Failed to upload {key_base}.tif')
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return key_base
+
+
+def update_mosaics(bucket_name, folder_path, period='season', bbox=None, area=None, cog=False, workers=8, rebuild=False, profile=None):
+    """
+    Bring the mosaics of the product up to date with the COGs of {folder_path}cog/. Only the mosaics whose scenes
+    changed since they were built in this view are built, with the ones never built or failed, and the mosaics left
+    without scenes are deleted
+    :param period: 'year', 'season' or 'month'
+    :param bbox: optional [minX, minY, maxX, maxY] of an area of interest in the projection of the COGs, its scenes are
+                 selected with the R-tree and grouped by time window only
+    :param area: name of the area of interest in the mosaic keys, required with bbox
+    :param cog: also materialize every mosaic as a COG next to its VRT
+    :param workers: number of threads reading the headers and building the mosaics
+    :param rebuild: rebuild every group, e.g. after a change of the GDAL profile
+    :return: list of the S3 keys of the mosaics built, without extension
+    """
+    from s3_operations import delete_files_s3
+    if bbox is not None and not area:
+        raise ValueError('A mosaic of an area of interest needs the name of the area')
+    index = MosaicIndex(bucket_name, folder_path)
+    index.update(workers=workers)
+    selected = set(index.query(bbox)) if bbox is not None else set(index.scenes)
+    groups = {}
+    for key in selected:
+        groups.setdefault(group_name(index.scenes[key], period, area), []).append(key)
+    for group in groups:
+        groups[group].sort(key=lambda key: index.scenes[key]['datetime'])
+    view = f'{period}/{area}' if area else period
+    built_before = index.mosaics.get(view, {})
+    signatures = {group: index.signature(sources) for group, sources in groups.items()}
+    stale = {group for group in groups if rebuild or built_before.get(group) != signatures[group]}
+    empty = sorted(set(built_before) - set(groups))
+    if empty:
+        # The VRT and the COG of a mosaic, deleting a key that does not exist is not an error in S3
+        keys = {group: [f'{mosaic_prefix(folder_path)}{period}/{group}{extension}' for extension in ('.vrt', '.tif')] for group in empty}
+        failed = set(delete_files_s3(bucket_name, [key for group in empty for key in keys[group]]))
+        for group in empty:
+            if failed.isdisjoint(keys[group]):
+                index.record(view, group, None)
+        print(f'{len(empty)} mosaics without scene left deleted from {mosaic_prefix(folder_path)}{period}/')
+    print(f'{len(stale)} of {len(groups)} {period} mosaics to build in {bucket_name}/{mosaic_prefix(folder_path)}')
+    built = []
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(build_mosaic, bucket_name, f'{mosaic_prefix(folder_path)}{period}/{group}', groups[group], cog, profile): group
+                   for group in sorted(stale)}
+        for future, group in futures.items():
+            try:
+                built.append(future.result())
+            except Exception as e:
+                # Not recorded, so the mosaic is built again by the next run
+                print(f'Failed to build the mosaic {group}: {e!r}')
+                continue
+            index.record(view, group, signatures[group])
+    index.save()
+    print(f'{len(built)} mosaics built, {len(stale) - len(built)} failed')
+    return built
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Build the VRT and COG mosaics of the published COGs per region and time window.')
+    parser.add_argument('bucket_name', type=str, help='Bucket name')
+    parser.add_argument('folder_path', type=str, help="S3 folder prefix of the product, e.g. 'Datacube/RiverIce/'")
+    parser.add_argument('--period', choices=PERIODS, default='season', help='Time window of the mosaics')
+    parser.add_argument('--bbox', type=float, nargs=4, default=None, help='minX minY maxX maxY of an area of interest, in the projection of the COGs')
+    parser.add_argument('--area', type=str, default=None, help='Name of the area of interest of --bbox in the mosaic keys')
+    parser.add_argument('--cog', action='store_true', help='Also write every mosaic as a COG')
+    parser.add_argument('--workers', type=int, default=8, help='Number of threads reading the headers and building the mosaics')
+    parser.add_argument('--rebuild', action='store_true', help='Build every mosaic again')
+    args = parser.parse_args()
+    update_mosaics(args.bucket_name, args.folder_path, period=args.period, bbox=args.bbox, area=args.area, cog=args.cog,
+                   workers=args.workers, rebuild=args.rebuild)
+"""
+# Run the scripts from the termial
+python mosaic.py nrcan-egs-product-archive Datacube/RiverIce/ --period season
+python mosaic.py nrcan-egs-product-archive Datacube/RiverIce/ --period year --bbox -1000000 500000 -800000 700000 --area MooseRiver --cog
+"""
@@ -0,0 +1,333 @@
+import json
+import os
+import queue
+import threading
+import traceback
+from concurrent.futures import FIRST_COMPLETED, wait
+
+from get_zip_links import get_link_datetime
+from download_and_unzip import download_and_unzip, download_zip, geotiff_path, vsizip_geotiff_path
+from fingerprint import source_changed, source_fingerprint
+from s3_operations import upload_files_to_s3, upload_url_to_s3
+from stac_metadata import create_item, item_key, s3_url
+
+# Marker pushed through the queues once a stage has no more work
+_END = object()
+# Seconds a stage waits on its input queue or its running futures before checking the other
+_POLL = 0.1
+
+
+def _stage_name(fn):
+    """
+    Name of a stage function, also for a functools.partial of one
+    """
+    return getattr(fn, '__name__', None) or fn.func.__name__
+
+
+def _run_stage(fn, executor, limit, in_queue, out_queue, errors):
+    """
+    Feed jobs from in_queue to the executor, keeping at most `limit` jobs in flight, and put the
+    finished jobs on out_queue. A job that failed in an earlier stage, or found unchanged, is passed through untouched.
+    :param fn: stage function, takes a job dict and returns the updated job dict
+    :param executor: ThreadPoolExecutor or ProcessPoolExecutor running the stage
+    :param limit: maximum number of jobs submitted to the executor at once
+    :param in_queue: bounded queue.Queue the jobs are read from
+    :param out_queue: bounded queue.Queue the finished jobs are written to
+    :param errors: list the exception stopping the stage is appended to, raised by run_pipeline. _END is put on
+        out_queue whatever happens, so the next stages and the caller are never left waiting
+    """
+    pending = {}
+    finished = False
+    try:
+        while not finished or pending:
+            # Top up the executor while there is room, only block on the queue if nothing is running
+            while not finished and len(pending) < limit:
+                try:
+                    job = in_queue.get(timeout=_POLL if pending else None)
+                except queue.Empty:
+                    break
+                if job is _END:
+                    finished = True
+                elif job.get('error') or job.get('unchanged'):
+                    out_queue.put(job)
+                else:
+                    try:
+                        pending[executor.submit(fn, job)] = job
+                    except Exception as e:
+                        # e.g. BrokenProcessPool once a GDAL worker was killed, the job fails and the others go on
+                        job['error'] = f'{_stage_name(fn)} could not start: {e!r}'
+                        out_queue.put(job)
+            if not pending:
+                continue
+            done, _ = wait(list(pending), timeout=_POLL, return_when=FIRST_COMPLETED)
+            for future in done:
+                job = pending.pop(future)
+                try:
+                    job = future.result()
+                except Exception as e:
+                    job['error'] = f'{_stage_name(fn)} failed: {e!r}'
+                    traceback.print_exc()
+                out_queue.put(job)
+    except Exception as e:
+        errors.append(e)
+        traceback.print_exc()
+        # Read the rest of the input, so the stages before this one are not blocked on a full queue
+        while not finished:
+            finished = in_queue.get() is _END
+    finally:
+        out_queue.put(_END)
+
+
+def run_pipeline(jobs, stages, queue_size=4):
+    """
+    Run every job through the stages in order, each stage on its own executor, connected by bounded
+    queues so a slow stage holds back the faster ones instead of piling up work on disk.
+    Finished jobs are yielded as soon as they leave the last stage, in completion order.
+    A job that raises gets an 'error' entry, skips the remaining stages, and does not stop the others.
+    If the jobs iterable itself raises, e.g. on a crawl error, or a stage stops, the jobs already started are
+    finished and yielded, then the exception is raised to the caller.
+    :param jobs: iterable of job dicts
+    :param stages: list of (fn, executor, limit) tuples, see _run_stage
+    :param queue_size: number of finished jobs a stage can hold before the next stage picks them up
+    """
+    queues = [queue.Queue(maxsize=queue_size) for _ in range(len(stages) + 1)]
+    errors = []
+    threads = []
+    for i, (fn, executor, limit) in enumerate(stages):
+        thread = threading.Thread(target=_run_stage, args=(fn, executor, limit, queues[i], queues[i + 1], errors),
+                                  name=f'stage-{_stage_name(fn)}', daemon=True)
+        thread.start()
+        threads.append(thread)
+
+    def feed():
+        try:
+            for job in jobs:
+                queues[0].put(job)
+        except Exception as e:
+            errors.append(e)
+            traceback.print_exc()
+        finally:
+            queues[0].put(_END)
+
+    feeder = threading.Thread(target=feed, name='stage-feed', daemon=True)
+    feeder.start()
+    while True:
+        job = queues[-1].get()
+        if job is _END:
+            break
+        yield job
+    feeder.join()
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0]
+
+
+def download_stage(job, archive_cache=None, retries=5, scratch=None):
+    """
+    Network stage: stream the zip of the link to disk and locate the Geotiff matching the keyword.
+    With read_mode 'extract' only the Geotiff is unzipped, with 'vsizip' it is read in place inside the zip.
+    With read_mode 'stream' nothing is downloaded: GDAL reads the Geotiff inside the zip on the server through
+    /vsizip//vsicurl/, and upload_stage streams the zip to S3. The work directory only gets the thumbnail and STAC Item.
+    The download statistics (bytes, retries, sha256, ...) are kept in job['download'].
+    With a ScratchSpace, the link first waits for its share of the scratch quota, and all its files are written to
+    its own job['work_dir'], deleted once the job is done. The wait blocks a thread of the download executor, so the
+    uploads that free the space must run on another executor.
+    With job['check_source'], a link already processed with the same parameters (job['previous_fingerprint']) is only
+    downloaded if a HEAD request shows that its zip changed, otherwise the job is marked unchanged and skips the stages.
+    Bind archive_cache, retries and scratch with functools.partial, they cannot be sent to other processes in the job.
+    """
+    keyword = job['keyword']
+    job['download'] = {}
+    fingerprint = job.setdefault('fingerprint', {})
+    source = None
+    if job.get('check_source') and job.get('previous_fingerprint') is not None:
+        source = source_fingerprint(job['link'])
+        if not source_changed(job['previous_fingerprint'], source):
+            # Keep the ETag and size of a record that had none, to compare them on the next run
+            fingerprint.update(job['previous_fingerprint'])
+            fingerprint.update({key: value for key, value in (source or {}).items() if value and not fingerprint.get(key)})
+            job['unchanged'] = True
+            return job
+        print(f'{job["link"]} changed on the server, proceed to translation')
+    zip_dir = job['zip_dir']
+    name = job['link'].split('/')[-1].replace('.zip', '')
+    if job.get('read_mode') == 'stream':
+        from geotiff_to_cog import use_vsicurl
+        use_vsicurl()
+        if scratch is not None:
+            job['unzip_dir'], job['download']['scratch_wait'] = scratch.reserve(name, 0)
+            job['work_dir'] = job['unzip_dir']
+        else:
+            job['unzip_dir'] = os.path.abspath(os.path.join(zip_dir, name))
+            os.makedirs(job['unzip_dir'], exist_ok=True)
+        geotiff_filename, geotif_path = vsizip_geotiff_path(job['link'], format='.tif', keyword=keyword)
+        job['zip_file_path'] = None
+        job['input_path'] = geotif_path[0]
+        source = source or source_fingerprint(job['link']) or {}
+        fingerprint.update(etag=source.get('etag'), size=source.get('size'))
+        return job
+    if scratch is not None:
+        zip_dir, job['download']['scratch_wait'] = scratch.reserve(name, scratch.estimate(job['link'], archive_cache))
+        job['work_dir'] = zip_dir
+    # A changed zip is downloaded again instead of taken from the archive cache
+    download_options = {'cache': archive_cache, 'retries': retries, 'stats': job['download'], 'etag': (source or {}).get('etag')}
+    if job.get('read_mode') == 'vsizip':
+        zip_file_path = os.path.abspath(download_zip(job['link'], zip_dir, **download_options))
+        unzip_dir = zip_file_path[:-4]
+        os.makedirs(unzip_dir, exist_ok=True)
+        geotiff_filename, geotif_path = vsizip_geotiff_path(zip_file_path, format='.tif', keyword=keyword)
+        input_path = geotif_path[0]
+    else:
+        unzip_dir = os.path.abspath(download_and_unzip(job['link'], zip_dir, keyword=keyword, format='.tif',
+                                                       **download_options))
+        zip_file_path = unzip_dir + '.zip'
+        geotiff_filename, geotif_path = geotiff_path(unzip_dir=unzip_dir, format='.tif', keyword=keyword)
+        input_path = geotif_path[0]
+    job['unzip_dir'] = unzip_dir
+    job['zip_file_path'] = zip_file_path
+    job['input_path'] = input_path
+    fingerprint.update(etag=job['download'].get('etag'), size=job['download'].get('size'))
+    return job
+
+
+def convert_stage(job):
+    """
+    GDAL stage: reproject the Geotiff, translate it to COG with the acquisition datetime and validate it.
+    Both steps run in a single pass with warp_to_cog, unless job['two_step'] asks for the intermediate _reprj.tif.
+    With job['tile_size'], the rasters larger than one tile are warped tile by tile by job['tile_workers'] threads,
+    with a bounded memory, see tiled_reproject.py.
+    GDAL runs with the performance profile of job['profile'], see gdal_profile.py.
+    The outputs are written to the unzip folder of the link, the Geotiff itself may be inside the zip.
+    With read_mode 'stream', they are written to /vsimem/ instead, the COG is uploaded from this process and freed,
+    and the next stages read it back from S3 through /vsis3/. The memory of the worker then holds the COG, and the
+    _reprj.tif with two_step, while the tiles of tile_size still go to the work directory.
+    GDAL is imported here and in the other GDAL stages only, so run_pipeline and the network stages run without it.
+    """
+    from osgeo import gdal
+    from geotiff_to_cog import reproject_raster, geotiff_to_cog, warp_to_cog, upload_vsi_file, use_vsicurl
+    from tiled_reproject import tiled_warp_to_cog
+    input_path = job['input_path']
+    profile = job.get('profile')
+    filename = input_path.replace('\\', '/').split('/')[-1]
+    streaming = job.get('read_mode') == 'stream'
+    if streaming:
+        use_vsicurl()
+        output_dir = '/vsimem/' + os.path.basename(job['unzip_dir'])
+    else:
+        output_dir = job['unzip_dir']
+    output_path = os.path.join(output_dir, filename.replace('.tif', '_cog.tif'))
+    formatted_datetime = get_link_datetime(job['link']).strftime('%Y:%m:%d %H:%M:%S')
+    # Seconds of the warp, the COG translate and the validation, reported by instrumentation.py
+    timings = job['gdal_timings'] = {}
+    proj_path = os.path.join(output_dir, filename.replace('.tif', '_reprj.tif'))
+    try:
+        if job.get('tile_size'):
+            job['is_valid'] = tiled_warp_to_cog(input_path, output_path, dstSRS=job['proj_epsg'], xRes=job['xRes'], yRes=job['yRes'],
+                                                datetime_value=formatted_datetime, profile=profile, timings=timings,
+                                                tile_size=job['tile_size'], tile_workers=job.get('tile_workers', 1),
+                                                tile_dir=os.path.join(job['unzip_dir'], 'tiles') if streaming else None)
+        elif job.get('two_step'):
+            reproject_raster(input_path=input_path, dstSRS=job['proj_epsg'], xRes=job['xRes'], yRes=job['yRes'], output_path=proj_path,
+                             profile=profile, timings=timings)
+            job['is_valid'] = geotiff_to_cog(proj_path, output_path, datetime_value=formatted_datetime, profile=profile, timings=timings)
+        else:
+            job['is_valid'] = warp_to_cog(input_path, output_path, dstSRS=job['proj_epsg'], xRes=job['xRes'], yRes=job['yRes'],
+                                          datetime_value=formatted_datetime, profile=profile, timings=timings)
+        if streaming:
+            bucket_name = job['bucket_name']
+            zip_key, cog_key = _s3_keys(job)
+            job['cog_bytes'] = upload_vsi_file(output_path, bucket_name, cog_key)
+            if job['cog_bytes'] is None:
+                raise RuntimeError(f'Failed to upload {cog_key} to {bucket_name}')
+            job['cog_key'] = cog_key
+            job['is_valid'] = job['is_valid'].replace(output_path, s3_url(bucket_name, cog_key))
+            job['output_path'] = f'/vsis3/{bucket_name}/{cog_key}'
+        else:
+            job['output_path'] = output_path
+    finally:
+        if streaming:
+            # The worker process converts the next links, the rasters of this one are freed even if it failed
+            for vsi_path in (proj_path, output_path):
+                if gdal.VSIStatL(vsi_path) is not None:
+                    gdal.Unlink(vsi_path)
+    return job
+
+
+def thumbnail_stage(job):
+    """
+    GDAL stage: create the PNG or WebP thumbnail of job['thumbnail'] from the overviews of the COG
+    """
+    from geotiff_to_cog import use_s3_endpoint
+    from create_thumbnail import create_thumbnail, thumbnail_path
+    output_path = job['output_path']
+    if output_path.startswith('/vsis3/'):
+        use_s3_endpoint()
+    # Written to the unzip folder of the link, next to the COG unless the COG is read from S3
+    local_path = os.path.join(job['unzip_dir'], os.path.basename(thumbnail_path(output_path, job['thumbnail'])))
+    job['thumbnail_path'] = create_thumbnail(output_path, local_path,
+                                             max_size=job.get('thumbnail_size', 600), format=job['thumbnail'])
+    return job
+
+
+def _s3_keys(job):
+    """
+    Return the S3 keys of the zip and of the COG of a job
+    """
+    folder_path = job['folder_path']
+    return folder_path + 'zip/' + job['link'].split('/')[-1], folder_path + 'cog/' + os.path.basename(job['input_path'])
+
+
+def stac_stage(job):
+    """
+    GDAL stage: create the STAC Item of the COG from its header, linking the S3 urls the COG, the zip and the
+    thumbnail are uploaded to. The Item is kept in job['stac_item'] and written next to the COG for upload_stage.
+    """
+    from geotiff_to_cog import use_s3_endpoint
+    from create_thumbnail import thumbnail_path
+    bucket_name = job['bucket_name']
+    zip_key, cog_key = _s3_keys(job)
+    if job['output_path'].startswith('/vsis3/'):
+        use_s3_endpoint()
+    assets = {'archive': s3_url(bucket_name, zip_key)}
+    if job.get('thumbnail_path'):
+        assets['thumbnail'] = s3_url(bucket_name, thumbnail_path(cog_key, job['thumbnail']))
+    item = create_item(job['output_path'], s3_url(bucket_name, cog_key), datetime_value=get_link_datetime(job['link']),
+                       collection_id=job['stac_collection'], assets=assets)
+    job['stac_path'] = os.path.join(job['unzip_dir'], item['id'] + '.json')
+    with open(job['stac_path'], 'w') as file:
+        json.dump(item, file, indent=2)
+    job['stac_item'] = item
+    return job
+
+
+def upload_stage(job):
+    """
+    Network stage: upload the zip, the COG, and its thumbnail and STAC Item if any to the S3 bucket in parallel,
+    their keys are kept in job['zip_key'], job['cog_key'], job['thumbnail_key'] and job['stac_key']
+    With read_mode 'stream', the COG is already uploaded by convert_stage, and the zip is streamed from the server to S3,
+    its size and sha256 are kept in job['download'] as for a download.
+    """
+    bucket_name = job['bucket_name']
+    zip_key, cog_key = _s3_keys(job)
+    if job.get('read_mode') == 'stream':
+        if not upload_url_to_s3(job['link'], bucket_name, zip_key, stats=job['download']):
+            raise RuntimeError(f'Failed to upload {zip_key} to {bucket_name}')
+        files = []
+    else:
+        files = [(job['zip_file_path'], zip_key), (job['output_path'], cog_key)]
+    if job.get('thumbnail_path'):
+        from create_thumbnail import thumbnail_path
+        # The thumbnail is uploaded next to the COG, with the name of the COG
+        job['thumbnail_key'] = thumbnail_path(cog_key, job['thumbnail'])
+        files.append((job['thumbnail_path'], job['thumbnail_key']))
+    if job.get('stac_path'):
+        job['stac_key'] = item_key(job['folder_path'], job['stac_item']['id'])
+        files.append((job['stac_path'], job['stac_key']))
+    results = upload_files_to_s3(bucket_name, files, max_workers=len(files)) if files else {}
+    failed = [key for key, uploaded in results.items() if not uploaded]
+    if failed:
+        raise RuntimeError(f'Failed to upload {", ".join(failed)} to {bucket_name}')
+    job['zip_key'] = zip_key
+    job['cog_key'] = cog_key
+    return job
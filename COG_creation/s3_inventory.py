@@ -0,0 +1,188 @@
+import bisect
+import json
+import os
+import threading
+import time
+
+from s3_operations import iter_s3_objects
+"""
+Cached inventory of the objects of a bucket, listed once per prefix with the paginated listing.
+A prefix below one that is already listed is answered from memory, and the listings can be kept in a local
+JSON file for the next runs. Lookups by key or by filename are dict lookups, and the objects under a prefix are a
+slice of the sorted keys found by bisection. The listing of S3 runs outside the lock, so the lookups of other threads
+are answered while a prefix is listed.
+"""
+
+
+class S3Inventory:
+    def __init__(self, bucket_name, cache_path=None, max_age=None, s3_client=None):
+        """
+        :param bucket_name: name of the bucket
+        :param cache_path: optional local JSON file keeping the listings between runs
+        :param max_age: seconds a listing of the cache file is reused for, None to list S3 again on every run
+        :param s3_client: optional boto3 S3 client
+        """
+        self.bucket_name = bucket_name
+        self.cache_path = cache_path
+        self.max_age = max_age
+        self.s3_client = s3_client
+        # prefix -> time it was listed, and key -> {'size', 'etag'} for every object under the listed prefixes
+        self.listed = {}
+        self.objects = {}
+        self._names = {}
+        # Sorted keys of objects, for the prefix lookups, and prefix -> Event of the listings in progress
+        self._sorted = []
+        self._listing = {}
+        self._lock = threading.Lock()
+        if cache_path and max_age and os.path.exists(cache_path):
+            with open(cache_path, 'r') as file:
+                cached = json.load(file)
+            if cached.get('bucket_name') == bucket_name:
+                now = time.time()
+                self.listed = {prefix: listed_at for prefix, listed_at in cached['listed'].items() if now - listed_at < max_age}
+                self.objects = {key: meta for key, meta in cached['objects'].items() if self._covering(key)}
+                for key in self.objects:
+                    self._names.setdefault(key.split('/')[-1], key)
+                self._sorted = sorted(self.objects)
+
+    def _covering(self, prefix):
+        """
+        Return the listed prefix that contains prefix, None if it was never listed
+        """
+        for listed_prefix in self.listed:
+            if prefix.startswith(listed_prefix):
+                return listed_prefix
+        return None
+
+    def load(self, prefix, refresh=False):
+        """
+        List prefix in S3 unless it is already covered by a listing, return the number of objects under prefix
+        :param refresh: list S3 again even if the prefix is covered
+        """
+        while True:
+            with self._lock:
+                if not refresh and self._covering(prefix) is not None:
+                    return len(self._range(prefix))
+                pending = next((event for listing, event in self._listing.items() if prefix.startswith(listing)), None)
+                if pending is None:
+                    # The keys known before the listing, the ones added while it runs are kept
+                    known = set(self._range(prefix))
+                    event = self._listing[prefix] = threading.Event()
+                    break
+            # Another thread lists a prefix covering this one, wait for it instead of listing twice
+            pending.wait()
+            refresh = False
+        try:
+            listing = list(iter_s3_objects(self.bucket_name, prefix, s3_client=self.s3_client))
+            with self._lock:
+                for key in known.difference(obj['key'] for obj in listing):
+                    self._remove(key, index=False)
+                for obj in listing:
+                    self._put(obj['key'], obj['size'], obj['etag'], index=False)
+                # One sort of the mostly sorted keys instead of an insertion per key
+                self._sorted = sorted(self.objects)
+                # The new listing covers the older ones below it
+                self.listed = {p: t for p, t in self.listed.items() if not p.startswith(prefix)}
+                self.listed[prefix] = time.time()
+                count = len(self._range(prefix))
+        finally:
+            with self._lock:
+                del self._listing[prefix]
+            event.set()
+        print(f'{count} objects listed in {self.bucket_name}/{prefix}')
+        return count
+
+    def _range(self, prefix):
+        """
+        Return the sorted keys under prefix, a slice of _sorted between the bisections of prefix and of the next prefix
+        """
+        start = bisect.bisect_left(self._sorted, prefix)
+        if prefix:
+            end = bisect.bisect_left(self._sorted, prefix[:-1] + chr(ord(prefix[-1]) + 1), start)
+        else:
+            end = len(self._sorted)
+        return self._sorted[start:end]
+
+    def _put(self, key, size, etag, index=True):
+        if index and key not in self.objects:
+            bisect.insort(self._sorted, key)
+        self.objects[key] = {'size': size, 'etag': etag}
+        self._names.setdefault(key.split('/')[-1], key)
+
+    def _remove(self, key, index=True):
+        if self.objects.pop(key, None) is not None and index:
+            del self._sorted[bisect.bisect_left(self._sorted, key)]
+        name = key.split('/')[-1]
+        if self._names.get(name) == key:
+            del self._names[name]
+
+    def add(self, key, size=None, etag=None):
+        """
+        Record an object uploaded during the run, so the inventory stays up to date without listing again
+        """
+        with self._lock:
+            self._put(key, size, etag)
+
+    def __contains__(self, key):
+        """
+        True if the key exists, its prefix is listed first if needed
+        """
+        self.load(key.rsplit('/', 1)[0] + '/' if '/' in key else '')
+        return key in self.objects
+
+    def get(self, key):
+        """
+        Return {'size', 'etag'} of the key, None if it does not exist
+        """
+        self.load(key.rsplit('/', 1)[0] + '/' if '/' in key else '')
+        return self.objects.get(key)
+
+    def keys(self, prefix):
+        """
+        Return a dict key -> {'size', 'etag'} of the objects under prefix, from memory if the prefix is covered
+        """
+        if self._covering(prefix) is None:
+            self.load(prefix)
+        with self._lock:
+            return {key: self.objects[key] for key in self._range(prefix)}
+
+    def names(self, prefix):
+        """
+        Return a dict filename -> key of the objects under prefix, for O(1) checks like 'x.tif' in names
+        """
+        return {key.split('/')[-1]: key for key in self.keys(prefix)}
+
+    def find_name(self, name):
+        """
+        Return the key of an object with this filename in the listed prefixes, None if there is none
+        """
+        return self._names.get(name)
+
+    def save(self):
+        """
+        Write the listings to cache_path
+        """
+        if not self.cache_path:
+            return
+        with self._lock:
+            content = json.dumps({'bucket_name': self.bucket_name, 'listed': self.listed, 'objects': self.objects})
+        tmp_path = self.cache_path + '.tmp'
+        with open(tmp_path, 'w') as file:
+            file.write(content)
+        os.replace(tmp_path, self.cache_path)
+
+
+"""
+# Test with moto standing in for S3
+import boto3
+from moto import mock_aws
+with mock_aws():
+    s3_client = boto3.client('s3', region_name='us-east-1')
+    s3_client.create_bucket(Bucket='egs-test')
+    for i in range(2500):
+        s3_client.put_object(Bucket='egs-test', Key=f'Datacube/RiverIce/cog/RiverIce_{i}.tif', Body=b'')
+    inventory = S3Inventory('egs-test', s3_client=s3_client)
+    print(inventory.load('Datacube/RiverIce/'))
+    cog_names = inventory.names('Datacube/RiverIce/cog/')
+    print(len(cog_names), 'RiverIce_2499.tif' in cog_names)
+"""
@@ -1,29 +1,112 @@
 import boto3
+import hashlib
 import logging
+import threading
+import time
+import requests
+from boto3.exceptions import S3UploadFailedError
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
 from botocore.exceptions import ClientError
+from urllib3.exceptions import HTTPError
+from concurrent.futures import ThreadPoolExecutor
 import os 
 
+MB = 1024 * 1024
+# Settings of the shared S3 client and of the multipart transfers, change them with configure_s3 
+s3_settings = {
+    # Connections kept open by the client, at least io_workers * max_concurrency for parallel multipart uploads 
+    'max_pool_connections': 32, 
+    # Local S3 stand-in such as moto or MinIO, e.g. http://127.0.0.1:5000 
+    'endpoint_url': os.environ.get('S3_ENDPOINT_URL'), 
+    # Files larger than multipart_threshold are uploaded in multipart_chunksize parts, max_concurrency at a time 
+    'multipart_threshold': 64 * MB, 
+    'multipart_chunksize': 16 * MB, 
+    'max_concurrency': 8, 
+}
+_s3_client = None
+_s3_client_pid = None
+_s3_client_lock = threading.Lock()
+
+def configure_s3(**settings):
+    """ Change the settings of the shared S3 client, the client is created again on its next use 
+    :param settings: keys of s3_settings, e.g. max_pool_connections=64, multipart_chunksize=32 * MB 
+    """
+    global _s3_client
+    unknown = set(settings) - set(s3_settings)
+    if unknown: 
+        raise ValueError(f'Unknown S3 settings {", ".join(sorted(unknown))}')
+    with _s3_client_lock: 
+        s3_settings.update(settings)
+        _s3_client = None
+
+def get_s3_client():
+    """ Return the S3 client shared by every thread of the process, created on first use. 
+    boto3 clients are thread-safe, so credentials are resolved and connections pooled once per process. 
+    A process forked from the one that created the client gets its own. 
+    """
+    global _s3_client, _s3_client_pid
+    with _s3_client_lock: 
+        if _s3_client is None or _s3_client_pid != os.getpid(): 
+            session = boto3.session.Session()
+            _s3_client = session.client('s3', endpoint_url=s3_settings['endpoint_url'], 
+                                        config=Config(max_pool_connections=s3_settings['max_pool_connections']))
+            _s3_client_pid = os.getpid()
+        return _s3_client
+
+def get_transfer_config():
+    """ Return the TransferConfig of the multipart uploads from s3_settings 
+    """
+    return TransferConfig(multipart_threshold=s3_settings['multipart_threshold'], 
+                          multipart_chunksize=s3_settings['multipart_chunksize'], 
+                          max_concurrency=s3_settings['max_concurrency'], 
+                          use_threads=True)
+
+def iter_s3_objects(bucket_name, folder_path, s3_client=None):
+    """ Yield every object under a S3 prefix, page by page, so prefixes with more than 1000 objects are listed in full 
+    :param bucket_name: string, name of the bucket 
+    :param folder_path: string, prefix, can be empty 
+    :param s3_client: optional boto3 S3 client 
+    :return a generator of dicts {'key', 'size', 'etag'}, the ETag without its quotes 
+    """
+    s3_client = s3_client or get_s3_client()
+    paginator = s3_client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket_name, Prefix=folder_path):
+        for obj in page.get('Contents', []):
+            yield {'key': obj['Key'], 'size': obj['Size'], 'etag': obj['ETag'].strip('"')}
+
 def list_files_in_s3(bucket_name, folder_path):
     """ List a filenames in a S3 bucket or a S3 folder  
-    Note: if there are too many records (>999) to pricessm we may need to paginate 
     :param bucket_name: string, name of the bucket 
     :param folder_path: string, prefix, can be empty 
     :return a list of filenames within the bucket 
     """
-    s3_client = boto3.client('s3')
-    response = s3_client.list_objects_v2(Bucket = bucket_name, Prefix = folder_path)
     filename_list = []
     count = 0 
-   # print(response)
-    for obj in response.get('Contents', []):
-        if obj['Key'] != folder_path:  # Exclude the folder itself from the results
-            filename = obj['Key'].split('/')[-1] 
+    for obj in iter_s3_objects(bucket_name, folder_path):
+        if obj['key'] != folder_path:  # Exclude the folder itself from the results
+            filename = obj['key'].split('/')[-1] 
             if filename: # Exclude the folder inside the folder_path 
                 filename_list.append(filename)
                 count += 1 
     print(f"{count} files are included in the bucket {bucket_name} in folder {folder_path}")
     return filename_list
 
+def file_exists_in_s3(bucket_name, file_key):
+    """ Check if an object exists with a single HEAD request, without listing its folder 
+    :param bucket_name: string, name of the bucket 
+    :param file_key: full key of the object 
+    :return True or False 
+    """
+    s3_client = get_s3_client()
+    try: 
+        s3_client.head_object(Bucket=bucket_name, Key=file_key)
+    except ClientError as e:
+        if e.response['Error']['Code'] in ('404', 'NoSuchKey', 'NotFound'):
+            return False
+        raise
+    return True
+
 def open_file_from_s3(bucket_name, folder_path, file_name):
     """Open a S3 file from bucket, folder_path and filename and return the body as a string
     :param bucket: Bucket name
@@ -31,7 +114,7 @@ def open_file_from_s3(bucket_name, folder_path, file_name):
     :return: body of the file as a string
     """
     try: 
-        s3_client = boto3.client('s3')
+        s3_client = get_s3_client()
         s3_key = folder_path + file_name
         # Download the file from S3
         response = s3_client.get_object(Bucket=bucket_name, Key=s3_key)
@@ -48,7 +131,7 @@ def delete_file_s3(bucket_name, folder_path, filename):
     :param 
     :return: body of the file as a string
     """
-    s3_client = boto3.client('s3')
+    s3_client = get_s3_client()
     s3_key = folder_path + filename 
     error_msg = None 
     try: 
@@ -59,6 +142,25 @@ def delete_file_s3(bucket_name, folder_path, filename):
         error_msg += e
     return error_msg
 
+def delete_files_s3(bucket_name, keys):
+    """Delete many objects, 1000 per request 
+    :param bucket: Bucket name
+    :param keys: full keys of the objects 
+    :return: list of the keys that could not be deleted 
+    """
+    s3_client = get_s3_client()
+    keys = list(keys)
+    failed = []
+    for start in range(0, len(keys), 1000): 
+        batch = keys[start:start + 1000]
+        try: 
+            response = s3_client.delete_objects(Bucket=bucket_name, Delete={'Objects': [{'Key': key} for key in batch], 'Quiet': True})
+            failed += [error['Key'] for error in response.get('Errors', [])]
+        except ClientError as e: 
+            logging.error(e)
+            failed += batch
+    return failed
+
 def upload_fileContent_to_s3(bucket_name, file_key, file_content):
     """
     Given the text content, upload the content to S3 as a text file 
@@ -66,46 +168,183 @@ def upload_fileContent_to_s3(bucket_name, file_key, file_content):
     :param file_key: S3 folder_path + 'log.txt'
     :param: file_content: text body 
     """
-    s3 = boto3.resource('s3')
-    obj = s3.Object(bucket_name, file_key)
+    s3_client = get_s3_client()
     try: 
-        obj.put(Body=file_content)
+        s3_client.put_object(Bucket=bucket_name, Key=file_key, Body=file_content)
     except ClientError as e:
         logging.error(e)
         return False 
     return True
 
-def upload_file_to_s3(bucket_name, folder_path, local_file_path, new_file_name):
-    """Upload a file to S3 bucket 
+def upload_contents_to_s3(bucket_name, contents, existing=None, max_workers=16):
+    """Upload many small text objects in parallel, only the ones that are new or changed 
+    A text is unchanged when its MD5 is the ETag of the object in S3, which holds for the objects put in a single part 
+    :param bucket name: name of the bucket 
+    :param contents: dict s3_key -> text body, e.g. the sidecar JSONs of the zip links 
+    :param existing: optional dict s3_key -> {'etag'} of the objects in S3, e.g. S3Inventory.keys(prefix), 
+        by default the common folder of the keys is listed once 
+    :param max_workers: number of objects uploaded at the same time 
+    :return: dict {'skipped': number, 'uploaded': number, 'failed': list of s3_keys} 
+    """
+    if existing is None: 
+        prefix = os.path.commonprefix(list(contents)).rpartition('/')[0]
+        existing = {obj['key']: obj for obj in iter_s3_objects(bucket_name, prefix + '/' if prefix else '')}
+    changed = {key: text for key, text in contents.items() 
+               if key not in existing or (existing[key].get('etag') or '').strip('"') != hashlib.md5(text.encode('utf-8')).hexdigest()}
+    def upload(key): 
+        return key, upload_fileContent_to_s3(bucket_name, file_key=key, file_content=changed[key])
+    results = {}
+    if changed: 
+        with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(changed)))) as pool: 
+            results = dict(pool.map(upload, changed))
+    report = {'skipped': len(contents) - len(changed), 'uploaded': sum(results.values()), 
+              'failed': [key for key, uploaded in results.items() if not uploaded]}
+    print(f"{report['uploaded']} objects uploaded to bucket {bucket_name}, {report['skipped']} unchanged skipped, {len(report['failed'])} failed")
+    return report
+
+def upload_file_to_s3(bucket_name, folder_path, local_file_path, new_file_name, extra_args=None):
+    """Upload a file to S3 bucket, in parts for large files, see get_transfer_config 
     :param bucket: Bucket name
     :param folder_path: S3 folder prefix 
     :param local_file_path: flocal full path for the file to be uploaded 
     :param new_file_name: new file name when uploaded to S3
+    :param extra_args: ExtraArgs of the upload, public read ACL by default 
     :return: True or False 
     """
-    s3_client = boto3.client('s3')       
+    s3_client = get_s3_client()
     # Concatenate the folder path and file name 
     s3_key = folder_path + new_file_name
+    # Add public read ACL 
+    extra_args = {'ACL': 'public-read'} if extra_args is None else extra_args
     try: 
-        # Add public read ACL 
-        s3_client.upload_file(local_file_path, bucket_name, s3_key, ExtraArgs={'ACL': 'public-read'})
-    except ClientError as e:
+        s3_client.upload_file(local_file_path, bucket_name, s3_key, ExtraArgs=extra_args, Config=get_transfer_config())
+    except (ClientError, S3UploadFailedError) as e:
+        logging.error(e)
+        return False 
+    return True 
+
+def upload_fileobj_to_s3(bucket_name, s3_key, fileobj, extra_args=None):
+    """Upload a file object to S3 bucket as it is read, in parts for large objects, see get_transfer_config 
+    Only multipart_chunksize * max_concurrency bytes are held in memory when the object cannot seek 
+    :param bucket: Bucket name
+    :param s3_key: full key of the object 
+    :param fileobj: object with a read(size) method, e.g. an HTTP response or a GDAL /vsimem/ file 
+    :param extra_args: ExtraArgs of the upload, public read ACL by default 
+    :return: True or False 
+    """
+    s3_client = get_s3_client()
+    extra_args = {'ACL': 'public-read'} if extra_args is None else extra_args
+    try: 
+        s3_client.upload_fileobj(fileobj, bucket_name, s3_key, ExtraArgs=extra_args, Config=get_transfer_config())
+    except (ClientError, S3UploadFailedError) as e:
         logging.error(e)
         return False 
     return True 
 
-def download_file_from_s3(bucekt_name, folder_path, local_dir, format):
+class _HashingStream: 
+    """ Read-only stream over the raw body of an HTTP response, hashing and counting the bytes as they are read 
+    A body shorter than expected_size raises IOError at its end, before the upload of its last part is completed 
+    """
+    def __init__(self, raw, expected_size=None): 
+        self.raw = raw
+        self.expected_size = expected_size
+        self.sha256 = hashlib.sha256()
+        self.bytes = 0
+
+    def read(self, size=-1): 
+        if size is None or size < 0: 
+            data = self.raw.read()
+        else: 
+            # Fill the request, a shorter result is the end of the body 
+            chunks = []
+            left = size
+            while left > 0: 
+                chunk = self.raw.read(left)
+                if not chunk: 
+                    break
+                chunks.append(chunk)
+                left -= len(chunk)
+            data = b''.join(chunks)
+        self.sha256.update(data)
+        self.bytes += len(data)
+        if (size is None or size < 0 or len(data) < size) and self.expected_size is not None and self.bytes != self.expected_size: 
+            raise IOError(f'The body ended after {self.bytes} of {self.expected_size} bytes')
+        return data
+
+def upload_url_to_s3(url, bucket_name, s3_key, session=None, retries=5, backoff=1, timeout=60, stats=None, extra_args=None):
+    """Stream a file from a url to S3 bucket without writing it to disk, e.g. a zip of the EGS server 
+    The body of the response is sent to S3 as it arrives, in multipart_chunksize parts. A body shorter than its 
+    Content-Length fails before the object is completed, so a truncated file is never published. A dropped connection 
+    restarts the upload from the start, as an incomplete multipart upload cannot be resumed from another response 
+    :param url: full url of the file 
+    :param bucket: Bucket name
+    :param s3_key: full key of the object 
+    :param session: optional requests Session to reuse its connections 
+    :param retries: number of retries after the first attempt, waiting backoff * 2**attempt seconds 
+    :param timeout: seconds to wait for the server to connect or send data 
+    :param stats: optional dict filled with 'bytes' read, 'retries', 'size', 'sha256' and 'etag', as download_zip 
+    :param extra_args: ExtraArgs of the upload, public read ACL by default 
+    :return: True or False 
+    """
+    http = session or requests
+    stats = stats if stats is not None else {}
+    stats.update({'bytes': 0, 'retries': 0})
+    attempt = 0
+    while True: 
+        try: 
+            with http.get(url, stream=True, timeout=timeout) as response: 
+                response.raise_for_status()
+                # The raw bytes are uploaded as they are, even with a Content-Encoding, and checked against Content-Length 
+                size = response.headers.get('Content-Length')
+                stream = _HashingStream(response.raw, expected_size=int(size) if size else None)
+                try: 
+                    uploaded = upload_fileobj_to_s3(bucket_name, s3_key, stream, extra_args=extra_args)
+                finally: 
+                    stats['bytes'] += stream.bytes
+                if not uploaded: 
+                    raise IOError(f'Failed to upload {s3_key} to {bucket_name}')
+                stats.update({'size': stream.bytes, 'sha256': stream.sha256.hexdigest(), 'etag': response.headers.get('ETag')})
+            return True
+        except (requests.RequestException, HTTPError, IOError) as e: 
+            attempt += 1
+            if attempt > retries: 
+                logging.error(e)
+                return False
+            delay = backoff * 2 ** (attempt - 1)
+            print(f'Upload of {url} to {s3_key} failed ({e}), retry {attempt}/{retries} in {delay:.0f}s')
+            stats['retries'] = attempt
+            time.sleep(delay)
+
+def upload_files_to_s3(bucket_name, files, max_workers=8, extra_args=None):
+    """Upload many files to S3 bucket in parallel, sharing the pooled S3 client 
+    :param bucket: Bucket name
+    :param files: iterable of (local_file_path, s3_key) pairs 
+    :param max_workers: number of files uploaded at the same time, each large file also uses max_concurrency parts 
+    :param extra_args: ExtraArgs of the uploads, public read ACL by default 
+    :return: dict s3_key -> True or False 
+    """
+    files = list(files)
+    def upload(pair): 
+        local_file_path, s3_key = pair
+        folder_path, _, new_file_name = s3_key.rpartition('/')
+        folder_path = folder_path + '/' if folder_path else ''
+        return s3_key, upload_file_to_s3(bucket_name, folder_path, local_file_path, new_file_name, extra_args=extra_args)
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(files)))) as pool: 
+        results = dict(pool.map(upload, files))
+    failed = [key for key, uploaded in results.items() if not uploaded]
+    print(f"{len(results) - len(failed)} files uploaded to bucket {bucket_name}, {len(failed)} failed")
+    return results
+
+def download_file_from_s3(bucket_name, folder_path, local_dir, format):
     """
     :param format: string, file extension '.tif'
     """
     # Create a Boto3 S3 client
-    s3_client = boto3.client('s3')
-    # List objects in the S3 bucket
-    response = s3_client.list_objects_v2(Bucket=bucekt_name, Prefix = folder_path)
-    # Iterate over the objects in the bucket
-    for obj in response['Contents']:
+    s3_client = get_s3_client()
+    # Iterate over all the objects in the S3 folder, page by page
+    for obj in iter_s3_objects(bucket_name, folder_path, s3_client=s3_client):
         # Get the file key (path) of each object
-        file_key = obj['Key']
+        file_key = obj['key']
         # Check if the file is a .tif file
         if file_key.endswith(format):
             # Create the local directory if it doesn't exist
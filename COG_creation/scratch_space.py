@@ -0,0 +1,127 @@
+import os
+import shutil
+import threading
+import time
+
+import requests
+"""
+Bounded local scratch space of the pipeline.
+Every link gets its own work directory, where its zip, extracted Geotiff, _reprj.tif and COG are written, and the
+directory is deleted as soon as the uploads are confirmed. Before a download, the link reserves an estimate of the
+space it will use. When the reservations would go over the quota, or over the free space of the disk, the download
+waits for other links to release their directories instead of failing with ENOSPC, so the peak disk use scales with
+the number of links in flight and not with the size of the archive.
+"""
+
+MB = 1024 * 1024
+# Shared memory folder of Linux, a tmpfs kept in RAM
+TMPFS_DIR = '/dev/shm'
+
+
+def tmpfs_root(name='egs_scratch'):
+    """
+    Return a folder on tmpfs for the scratch space, None if this system has no /dev/shm
+    """
+    if os.path.isdir(TMPFS_DIR) and os.access(TMPFS_DIR, os.W_OK):
+        return os.path.join(TMPFS_DIR, name)
+    return None
+
+
+class ScratchSpace:
+    def __init__(self, root_dir, quota_bytes=None, expansion=4, default_size=256 * MB, keep=False, poll=5):
+        """
+        :param root_dir: folder of the work directories, e.g. zip_dir or a folder on tmpfs
+        :param quota_bytes: maximum bytes reserved at once, None for no quota besides the free space of the disk
+        :param expansion: space reserved for a link as a multiple of its zip size, for the zip, the extracted Geotiff,
+                          the _reprj.tif and the COG
+        :param default_size: zip size assumed when the server does not send a Content-Length
+        :param keep: keep the work directories after the upload, as before the scratch space
+        :param poll: seconds between two checks of the free space while waiting
+        """
+        self.root_dir = os.path.abspath(root_dir)
+        self.quota_bytes = quota_bytes
+        self.expansion = expansion
+        self.default_size = default_size
+        self.keep = keep
+        self.poll = poll
+        self.reservations = {}
+        self.reserved = 0
+        self.peak_reserved = 0
+        self._count = 0
+        self._condition = threading.Condition()
+        os.makedirs(self.root_dir, exist_ok=True)
+
+    def estimate(self, link, archive_cache=None, session=None):
+        """
+        Return the bytes to reserve for a link, from the size of its zip in the archive cache or from a HEAD request
+        """
+        size = None
+        if archive_cache is not None and link in archive_cache.index:
+            size = archive_cache.index[link]['size']
+        else:
+            try:
+                response = (session or requests).head(link, allow_redirects=True, timeout=30)
+                if response.ok and response.headers.get('Content-Length'):
+                    size = int(response.headers['Content-Length'])
+            except requests.RequestException:
+                pass
+        return int((size or self.default_size) * self.expansion)
+
+    def _fits(self, nbytes):
+        if not self.reservations:
+            # Alone, a link always gets its space, even larger than the quota, so the run cannot stall
+            return True
+        if self.quota_bytes is not None and self.reserved + nbytes > self.quota_bytes:
+            return False
+        # The space reserved by the other links may not be written yet
+        return shutil.disk_usage(self.root_dir).free >= self.reserved + nbytes
+
+    def reserve(self, name, nbytes):
+        """
+        Reserve nbytes for a link and create its work directory, waiting until they fit in the quota and on the disk
+        :param name: name of the work directory, e.g. the zip filename without extension
+        :return: (path of the work directory, seconds waited)
+        """
+        start = time.perf_counter()
+        with self._condition:
+            if not self._fits(nbytes):
+                print(f'Waiting for {nbytes / MB:.0f} MB of scratch space for {name}, {self.reserved / MB:.0f} MB are reserved')
+            while not self._fits(nbytes):
+                self._condition.wait(timeout=self.poll)
+            self._count += 1
+            work_dir = os.path.join(self.root_dir, f'{self._count:06d}_{name}')
+            self.reservations[work_dir] = nbytes
+            self.reserved += nbytes
+            self.peak_reserved = max(self.peak_reserved, self.reserved)
+        os.makedirs(work_dir, exist_ok=True)
+        return work_dir, time.perf_counter() - start
+
+    def release(self, work_dir):
+        """
+        Delete the work directory of a link, unless keep is set, and give its reservation back
+        """
+        if not self.keep:
+            shutil.rmtree(work_dir, ignore_errors=True)
+        with self._condition:
+            self.reserved -= self.reservations.pop(work_dir, 0)
+            self._condition.notify_all()
+
+    def cleanup(self):
+        """
+        Delete the work directories left by an interrupted run
+        """
+        if self.keep:
+            return
+        for name in os.listdir(self.root_dir):
+            path = os.path.join(self.root_dir, name)
+            if os.path.isdir(path) and path not in self.reservations and name[:6].isdigit() and name[6:7] == '_':
+                shutil.rmtree(path, ignore_errors=True)
+
+
+"""
+# Test: 4 links of 300 MB with a 1 GB quota, the fourth waits for the first one to be released
+scratch = ScratchSpace('zip_test', quota_bytes=1024 * MB)
+work_dirs = [scratch.reserve(f'link{i}', 300 * MB)[0] for i in range(3)]
+threading.Timer(1, scratch.release, args=(work_dirs[0],)).start()
+print(scratch.reserve('link3', 300 * MB))
+"""
@@ -0,0 +1,326 @@
+import argparse
+import json
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from get_zip_links import get_link_datetime
+"""
+STAC Items and Collection of the COGs, built from the COG headers only: the size, geotransform and projection are read
+by gdal.Open without decoding any pixel, and the datetime comes from the filename timestamp as in main.py.
+The Items are written under {folder_path}stac/items/{id}.json and the Collection to {folder_path}stac/collection.json.
+The Collection extent is updated with every new Item instead of being rebuilt from all the Items.
+"""
+
+STAC_VERSION = '1.0.0'
+PROJECTION_EXTENSION = 'https://stac-extensions.github.io/projection/v1.1.0/schema.json'
+RASTER_EXTENSION = 'https://stac-extensions.github.io/raster/v1.1.0/schema.json'
+COG_MEDIA_TYPE = 'image/tiff; application=geotiff; profile=cloud-optimized'
+MEDIA_TYPES = {'.png': 'image/png', '.webp': 'image/webp', '.zip': 'application/zip', '.json': 'application/json'}
+# Points per edge of the footprint, so the curved edges of the projected raster are kept in WGS84
+DENSIFY = 21
+
+
+def s3_url(bucket_name, key):
+    """
+    Return the public https url of an S3 object
+    """
+    return f'https://{bucket_name}.s3.amazonaws.com/{key}'
+
+
+def stac_prefix(folder_path):
+    return folder_path + 'stac/'
+
+
+def item_key(folder_path, item_id):
+    return f'{stac_prefix(folder_path)}items/{item_id}.json'
+
+
+def _footprint(ds):
+    """
+    Return the [[lon, lat], ...] ring of the raster outline in WGS84, and the EPSG code of the raster
+    """
+    from osgeo import osr
+    srs = osr.SpatialReference(wkt=ds.GetProjection())
+    srs.AutoIdentifyEPSG()
+    code = srs.GetAuthorityCode(None)
+    wgs84 = osr.SpatialReference()
+    wgs84.ImportFromEPSG(4326)
+    if hasattr(osr, 'OAMS_TRADITIONAL_GIS_ORDER'):
+        # GDAL 3 follows the axis order of the authority, latitude first for EPSG:4326
+        srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+        wgs84.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+    transform = osr.CoordinateTransformation(srs, wgs84)
+    x0, dx, rx, y0, ry, dy = ds.GetGeoTransform()
+    width, height = ds.RasterXSize, ds.RasterYSize
+    steps = [i / (DENSIFY - 1) for i in range(DENSIFY - 1)]
+    pixels = ([(width * t, 0) for t in steps] + [(width, height * t) for t in steps] +
+              [(width * (1 - t), height) for t in steps] + [(0, height * (1 - t)) for t in steps])
+    points = [(x0 + col * dx + row * rx, y0 + col * ry + row * dy) for col, row in pixels]
+    ring = [[round(lon, 7), round(lat, 7)] for lon, lat, _ in transform.TransformPoints(points)]
+    ring.append(ring[0])
+    return ring, int(code) if code else None
+
+
+def create_item(cog_path, href, item_id=None, datetime_value=None, collection_id=None, assets=None):
+    """
+    Create the STAC Item of a COG from its header
+    :param cog_path: local path of the COG, or a GDAL virtual path like /vsis3/bucket/key
+    :param href: url of the COG in the Item
+    :param item_id: id of the Item, the filename of href without extension by default
+    :param datetime_value: acquisition datetime, parsed from the filename of href by default
+    :param collection_id: optional id of the Collection of the Item
+    :param assets: optional dict name -> href of other assets, e.g. {'thumbnail': ..., 'archive': ...}
+    :return: Item dict
+    """
+    from osgeo import gdal
+    ds = gdal.Open(cog_path)
+    if ds is None:
+        raise RuntimeError(f'GDAL could not open {cog_path}')
+    ring, epsg = _footprint(ds)
+    x0, dx, rx, y0, ry, dy = ds.GetGeoTransform()
+    width, height = ds.RasterXSize, ds.RasterYSize
+    band = ds.GetRasterBand(1)
+    band_info = {'data_type': gdal.GetDataTypeName(band.DataType).lower(), 'nodata': band.GetNoDataValue()}
+    bands = ds.RasterCount
+    ds = None
+
+    filename = href.split('/')[-1]
+    item_id = item_id or os.path.splitext(filename)[0]
+    datetime_value = datetime_value or get_link_datetime(filename)
+    lons = [lon for lon, _ in ring]
+    lats = [lat for _, lat in ring]
+    xs = [x0, x0 + width * dx + height * rx]
+    ys = [y0, y0 + width * ry + height * dy]
+    item = {
+        'type': 'Feature',
+        'stac_version': STAC_VERSION,
+        'stac_extensions': [PROJECTION_EXTENSION, RASTER_EXTENSION],
+        'id': item_id,
+        'geometry': {'type': 'Polygon', 'coordinates': [ring]},
+        'bbox': [min(lons), min(lats), max(lons), max(lats)],
+        'properties': {
+            'datetime': datetime_value.strftime('%Y-%m-%dT%H:%M:%SZ'),
+            'proj:epsg': epsg,
+            'proj:shape': [height, width],
+            'proj:transform': [dx, rx, x0, ry, dy, y0],
+            'proj:bbox': [min(xs), min(ys), max(xs), max(ys)],
+        },
+        'assets': {
+            'cog': {'href': href, 'type': COG_MEDIA_TYPE, 'roles': ['data'], 'title': filename,
+                    'raster:bands': [band_info] * bands},
+        },
+        'links': [],
+    }
+    for name, asset_href in (assets or {}).items():
+        role = 'thumbnail' if name == 'thumbnail' else 'metadata' if asset_href.endswith('.json') else 'source'
+        item['assets'][name] = {'href': asset_href, 'type': MEDIA_TYPES.get(os.path.splitext(asset_href)[1]), 'roles': [role]}
+    if collection_id:
+        item['collection'] = collection_id
+        item['links'] = [{'rel': 'collection', 'href': '../collection.json', 'type': 'application/json'},
+                         {'rel': 'parent', 'href': '../collection.json', 'type': 'application/json'},
+                         {'rel': 'root', 'href': '../collection.json', 'type': 'application/json'}]
+    return item
+
+
+def new_collection(collection_id, description=None):
+    return {
+        'type': 'Collection',
+        'stac_version': STAC_VERSION,
+        'stac_extensions': [PROJECTION_EXTENSION],
+        'id': collection_id,
+        'description': description or f'{collection_id} products of the Emergency Geomatics Service (EGS)',
+        'license': 'proprietary',
+        'extent': {'spatial': {'bbox': [None]}, 'temporal': {'interval': [[None, None]]}},
+        'links': [{'rel': 'root', 'href': './collection.json', 'type': 'application/json'},
+                  {'rel': 'self', 'href': './collection.json', 'type': 'application/json'}],
+    }
+
+
+def update_extent(collection, item):
+    """
+    Grow the spatial and temporal extent of the collection to include the item
+    :return: True if the extent changed
+    """
+    bbox = collection['extent']['spatial']['bbox'][0]
+    interval = collection['extent']['temporal']['interval'][0]
+    new_bbox = list(item['bbox']) if bbox is None else [min(bbox[0], item['bbox'][0]), min(bbox[1], item['bbox'][1]),
+                                                        max(bbox[2], item['bbox'][2]), max(bbox[3], item['bbox'][3])]
+    item_datetime = item['properties']['datetime']
+    # ISO datetimes in UTC compare as strings
+    new_interval = [min(interval[0] or item_datetime, item_datetime), max(interval[1] or item_datetime, item_datetime)]
+    collection['extent']['spatial']['bbox'][0] = new_bbox
+    collection['extent']['temporal']['interval'][0] = new_interval
+    return new_bbox != bbox or new_interval != interval
+
+
+def merge_collection(collection, other):
+    """
+    Add the Item links and the extent of another copy of the collection, e.g. the one saved by another worker
+    """
+    hrefs = {link['href'] for link in collection['links'] if link['rel'] == 'item'}
+    for link in other['links']:
+        if link['rel'] == 'item' and link['href'] not in hrefs:
+            collection['links'].append(link)
+            hrefs.add(link['href'])
+    bbox = other['extent']['spatial']['bbox'][0]
+    if bbox is not None:
+        for item_datetime in other['extent']['temporal']['interval'][0]:
+            if item_datetime:
+                update_extent(collection, {'bbox': bbox, 'properties': {'datetime': item_datetime}})
+
+
+def _read_collection(bucket_name, folder_path):
+    """
+    Return the collection.json of {folder_path}stac/ in S3, None if it does not exist, False if it cannot be read
+    """
+    from s3_operations import file_exists_in_s3, open_file_from_s3
+    if not file_exists_in_s3(bucket_name, stac_prefix(folder_path) + 'collection.json'):
+        return None
+    content = open_file_from_s3(bucket_name, stac_prefix(folder_path), file_name='collection.json')
+    if content is False:
+        return False
+    try:
+        return json.loads(content)
+    except ValueError:
+        return False
+
+
+class StacCollection:
+    def __init__(self, bucket_name, folder_path, collection_id, description=None):
+        """
+        Collection of the Items under {folder_path}stac/, loaded from S3 if it exists
+        :param bucket_name: name of the bucket
+        :param folder_path: S3 folder prefix of the product, e.g. 'Datacube/RiverIce/'
+        :param collection_id: id of a new Collection, e.g. 'RiverIce'
+        :raise RuntimeError if collection.json exists but cannot be read, so it is never replaced by a new Collection
+        """
+        self.bucket_name = bucket_name
+        self.folder_path = folder_path
+        self.changed = False
+        self._lock = threading.Lock()
+        collection = _read_collection(bucket_name, folder_path)
+        if collection is False:
+            raise RuntimeError(f'{stac_prefix(folder_path)}collection.json exists in {bucket_name} but could not be read')
+        if collection is not None:
+            self.collection = collection
+            self._item_links = {link['href'] for link in self.collection['links'] if link['rel'] == 'item'}
+            print(f'collection.json loaded with {len(self._item_links)} items')
+        else:
+            self.collection = new_collection(collection_id, description)
+            self._item_links = set()
+
+    def add(self, item):
+        """
+        Update the extent of the Collection with an Item uploaded to {folder_path}stac/items/, and link the Item
+        """
+        href = f'./items/{item["id"]}.json'
+        with self._lock:
+            self.changed = update_extent(self.collection, item) or self.changed
+            if href not in self._item_links:
+                self._item_links.add(href)
+                self.collection['links'].append({'rel': 'item', 'href': href, 'type': 'application/geo+json'})
+                self.changed = True
+
+    def save(self):
+        """
+        Upload collection.json if an Item was added since it was loaded, merged with the copy in S3, which other
+        workers sharing the folder may have saved in the meantime
+        """
+        from s3_operations import upload_fileContent_to_s3
+        key = stac_prefix(self.folder_path) + 'collection.json'
+        with self._lock:
+            if not self.changed:
+                return True
+            other = _read_collection(self.bucket_name, self.folder_path)
+            if other is False:
+                # Never replace a collection that could not be read by the Items of this run only
+                print(f'{key} could not be read, it is not updated')
+                return False
+            if other is not None:
+                merge_collection(self.collection, other)
+                self._item_links = {link['href'] for link in self.collection['links'] if link['rel'] == 'item'}
+            content = json.dumps(self.collection, indent=2)
+            self.changed = False
+        uploaded = upload_fileContent_to_s3(self.bucket_name, file_key=key, file_content=content)
+        if uploaded:
+            print(f'collection.json uploaded to {self.bucket_name}/{stac_prefix(self.folder_path)}')
+        return uploaded
+
+
+def s3_item(cog_key, bucket_name, folder_path, collection_id, assets=None):
+    """
+    Create the Item of a COG in S3 from its header, read through /vsis3/, and upload it
+    :return: Item dict
+    """
+    from geotiff_to_cog import use_s3_endpoint
+    from s3_operations import upload_fileContent_to_s3
+    use_s3_endpoint()
+    item = create_item(f'/vsis3/{bucket_name}/{cog_key}', s3_url(bucket_name, cog_key), collection_id=collection_id,
+                       assets={name: s3_url(bucket_name, key) for name, key in (assets or {}).items()})
+    if not upload_fileContent_to_s3(bucket_name, file_key=item_key(folder_path, item['id']), file_content=json.dumps(item, indent=2)):
+        raise RuntimeError(f'Failed to upload the STAC item {item["id"]} to {bucket_name}')
+    return item
+
+
+def prefix_items(bucket_name, folder_path, collection_id, workers=4, overwrite=False):
+    """
+    Create the Items of every COG in {folder_path}cog/ that has none yet on a pool of workers processes,
+    and update the Collection as they finish
+    """
+    from s3_inventory import S3Inventory
+    inventory = S3Inventory(bucket_name)
+    cog_keys = inventory.keys(folder_path + 'cog/')
+    item_keys = inventory.keys(stac_prefix(folder_path) + 'items/')
+    zip_keys = inventory.keys(folder_path + 'zip/')
+    collection = StacCollection(bucket_name, folder_path, collection_id)
+    jobs = {}
+    for key in sorted(cog_keys):
+        if not key.endswith('.tif'):
+            continue
+        name = os.path.splitext(key.split('/')[-1])[0]
+        if not overwrite and item_key(folder_path, name) in item_keys:
+            continue
+        assets = {}
+        for extension in ('.png', '.webp'):
+            if key[:-4] + extension in cog_keys:
+                assets['thumbnail'] = key[:-4] + extension
+        if f'{folder_path}zip/{name}.zip' in zip_keys:
+            assets['archive'] = f'{folder_path}zip/{name}.zip'
+        jobs[key] = assets
+    print(f'{len(jobs)} COGs without a STAC item in {bucket_name}/{folder_path}cog/')
+    failed = 0
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(s3_item, key, bucket_name, folder_path, collection_id, assets): key for key, assets in jobs.items()}
+        for future in as_completed(futures):
+            try:
+                collection.add(future.result())
+            except Exception as e:
+                failed += 1
+                print(f'Failed to create the STAC item of {futures[future]}: {e!r}')
+    collection.save()
+    print(f'{len(jobs) - failed} STAC items created, {failed} failed')
+    return collection
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Create the STAC items and collection of the COGs of an S3 prefix.')
+    parser.add_argument('bucket_name', type=str, help='Bucket name')
+    parser.add_argument('folder_path', type=str, help="S3 folder prefix of the product, e.g. 'Datacube/RiverIce/'")
+    parser.add_argument('--collection-id', type=str, default=None, help='Id of the collection, the last folder of folder_path by default')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help='Number of processes reading the COG headers')
+    parser.add_argument('--overwrite', action='store_true', help='Create the items that already exist again')
+    args = parser.parse_args()
+    prefix_items(args.bucket_name, args.folder_path, args.collection_id or args.folder_path.strip('/').split('/')[-1],
+                 workers=args.workers, overwrite=args.overwrite)
+"""
+# Test
+script_dir = os.path.dirname(os.path.abspath(__file__))
+cog_path = os.path.join(script_dir, 'Test', 'tiff', 'RiverIce_CAN_ON_Moose_20160503_232950_cog.tif')
+item = create_item(cog_path, s3_url('nrcan-egs-product-archive', 'Datacube/RiverIce/cog/RiverIce_CAN_ON_Moose_20160503_232950.tif'),
+                   collection_id='RiverIce')
+print(json.dumps(item, indent=2))
+
+# Run the scripts from the termial
+python stac_metadata.py nrcan-egs-product-archive Datacube/RiverIce/ --workers 8
+"""
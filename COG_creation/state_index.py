@@ -0,0 +1,260 @@
+import json
+import os
+import socket
+import threading
+import time
+from datetime import datetime, timezone
+"""
+Index of the processed zip links, replacing the substring search in log.txt.
+The state is a JSON Lines manifest, one record per link:
+    {"url": ..., "sha256": ..., "cog_key": ..., "validation": ..., "fingerprint": ..., "timestamp": ...}
+The fingerprint of the source and of the processing parameters tells which links are out of date, see fingerprint.py.
+Records are appended to the local manifest as the links finish. Every batch_size records, only the new records are
+uploaded to S3, as a delta object under manifest.d/, so a sync costs the size of the batch and not of the manifest.
+The index in S3 is manifest.jsonl merged with the deltas. publish, at the end of a run, reloads it, so the records
+of the other workers sharing the folder are kept, writes the merged manifest.jsonl, and deletes the deltas it merged.
+When a url appears several times, the record with the latest timestamp wins, except that a stub record, with the
+'source' it was imported from (log.txt, create_log.py) instead of the results of a run, never replaces a full one.
+boto3 is only imported to sync with S3, so a local index is cheap to load, e.g. for main.py plan.
+"""
+
+MANIFEST_NAME = 'manifest.jsonl'
+# Folder of the deltas, one object of the new records per sync, named {time}_{worker}.jsonl to be read in order
+DELTA_FOLDER = 'manifest.d/'
+# Deltas younger than this are merged but not deleted by publish, in case another worker publishes at the same time
+# from a listing without them
+DELTA_GRACE_SECONDS = 3600
+
+
+def _now():
+    return datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+
+
+def _delta_time(key):
+    """
+    Return the time a delta was synced, in seconds since the epoch, from its name
+    """
+    stamp = key.split('/')[-1].split('_')[0]
+    return datetime.strptime(stamp, '%Y%m%dT%H%M%S%f').replace(tzinfo=timezone.utc).timestamp()
+
+
+def _wins(record, current):
+    """
+    True if record replaces current, the record of the same url in the index, None if there is none
+    """
+    if current is None:
+        return True
+    if bool(record.get('source')) != bool(current.get('source')):
+        # A stub never replaces the record of a processed link, whatever their timestamps
+        return not record.get('source')
+    return record['timestamp'] >= current['timestamp']
+
+
+class StateIndex:
+    def __init__(self, manifest_path, bucket_name=None, folder_path=None, batch_size=50):
+        """
+        :param manifest_path: local JSON Lines manifest, created if it does not exist
+        :param bucket_name: optional bucket the manifest is synced to
+        :param folder_path: S3 folder prefix of the manifest, e.g. 'Datacube/RiverIce/'
+        :param batch_size: number of new records before the manifest is uploaded to S3
+        """
+        self.manifest_path = manifest_path
+        self.bucket_name = bucket_name
+        self.folder_path = folder_path
+        self.batch_size = batch_size
+        self.records = {}
+        # Records not uploaded to S3 yet
+        self.unsynced = []
+        self.worker_id = f'{socket.gethostname()}-{os.getpid()}'
+        self._lock = threading.Lock()
+        if os.path.exists(manifest_path):
+            with open(manifest_path, 'r') as file:
+                self._load_lines(file)
+
+    def _load_lines(self, lines):
+        for line in lines:
+            if line.strip():
+                record = json.loads(line)
+                self.records[record['url']] = record
+
+    def _merge_lines(self, lines):
+        """
+        Merge the records of a manifest or a delta, keeping the latest one of every url
+        """
+        for line in lines:
+            if line.strip():
+                record = json.loads(line)
+                if _wins(record, self.records.get(record['url'])):
+                    self.records[record['url']] = record
+
+    def __contains__(self, url):
+        return url in self.records
+
+    def __len__(self):
+        return len(self.records)
+
+    def get(self, url):
+        return self.records.get(url)
+
+    def add(self, url, sync=True, **fields):
+        """
+        Record a processed link and append it to the local manifest, the manifest is synced to S3 every batch_size records
+        :param url: zip link
+        :param sync: False to never upload from this call, e.g. while migrating a log
+        :param fields: sha256, cog_key, validation or any other value to keep for the link
+        :return the record
+        """
+        record = dict(fields, url=url, timestamp=fields.get('timestamp') or _now())
+        with self._lock:
+            self.records[url] = record
+            with open(self.manifest_path, 'a') as file:
+                file.write(json.dumps(record) + '\n')
+            self.unsynced.append(record)
+            due = sync and len(self.unsynced) >= self.batch_size
+        if due:
+            self.sync()
+        return record
+
+    def update(self, url, sync=True, **fields):
+        """
+        Change fields of the record of a link, e.g. its fingerprint, keeping the others, with a new timestamp
+        """
+        record = {key: value for key, value in (self.get(url) or {}).items() if key not in ('url', 'timestamp')}
+        record.update(fields)
+        return self.add(url, sync=sync, **record)
+
+    def sync(self):
+        """
+        Upload the records added since the last sync to S3, as a new delta object under manifest.d/
+        """
+        if not self.bucket_name or not self.unsynced:
+            return True
+        from s3_operations import upload_fileContent_to_s3
+        with self._lock:
+            records, self.unsynced = self.unsynced, []
+        name = f'{datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%S%f")}_{self.worker_id}.jsonl'
+        uploaded = upload_fileContent_to_s3(self.bucket_name, file_key=self.folder_path + DELTA_FOLDER + name,
+                                            file_content=''.join(json.dumps(record) + '\n' for record in records))
+        if uploaded:
+            print(f'{len(records)} records of {MANIFEST_NAME} synced to {self.bucket_name}/{self.folder_path}{DELTA_FOLDER}')
+        else:
+            with self._lock:
+                self.unsynced = records + self.unsynced
+        return uploaded
+
+    def load_s3(self):
+        """
+        Merge the manifest and the deltas in S3 into the index
+        :return (True if there is a manifest or a delta in S3, keys of the deltas read)
+        :raise RuntimeError if an object exists but cannot be read, so an unreadable index is never overwritten
+        """
+        from s3_operations import file_exists_in_s3, iter_s3_objects, open_file_from_s3
+        manifest_exists = file_exists_in_s3(self.bucket_name, self.folder_path + MANIFEST_NAME)
+        if manifest_exists:
+            content = open_file_from_s3(self.bucket_name, self.folder_path, file_name=MANIFEST_NAME)
+            if content is False:
+                raise RuntimeError(f'{self.folder_path}{MANIFEST_NAME} exists in {self.bucket_name} but could not be read')
+            self._merge_lines(content.splitlines())
+        delta_keys = sorted(obj['key'] for obj in iter_s3_objects(self.bucket_name, self.folder_path + DELTA_FOLDER))
+        for key in delta_keys:
+            content = open_file_from_s3(self.bucket_name, '', file_name=key)
+            if content is False:
+                raise RuntimeError(f'{key} exists in {self.bucket_name} but could not be read')
+            self._merge_lines(content.splitlines())
+        return manifest_exists or bool(delta_keys), delta_keys
+
+    def publish(self, grace_seconds=DELTA_GRACE_SECONDS):
+        """
+        Merge the index with the one in S3, upload it as manifest.jsonl and delete the deltas merged into it.
+        Costs a full upload of the manifest, so it is done once at the end of a run, the syncs only upload deltas.
+        :param grace_seconds: the deltas younger than this are merged but kept, see DELTA_GRACE_SECONDS
+        :return True if the manifest was uploaded
+        """
+        if not self.bucket_name:
+            return True
+        from s3_operations import delete_files_s3, upload_fileContent_to_s3
+        if not self.sync():
+            return False
+        _, delta_keys = self.load_s3()
+        self.compact()
+        with open(self.manifest_path, 'r') as file:
+            content = file.read()
+        if not upload_fileContent_to_s3(self.bucket_name, file_key=self.folder_path + MANIFEST_NAME, file_content=content):
+            return False
+        now = time.time()
+        merged = [key for key in delta_keys if now - _delta_time(key) > grace_seconds]
+        if merged:
+            delete_files_s3(self.bucket_name, merged)
+        print(f'{len(self.records)} records of {MANIFEST_NAME} published to {self.bucket_name}/{self.folder_path}, '
+              f'{len(merged)} of {len(delta_keys)} deltas merged and deleted')
+        return True
+
+    def compact(self):
+        """
+        Rewrite the local manifest with one record per url
+        """
+        tmp_path = self.manifest_path + '.tmp'
+        with open(tmp_path, 'w') as file:
+            for record in self.records.values():
+                file.write(json.dumps(record) + '\n')
+        os.replace(tmp_path, self.manifest_path)
+
+    def migrate_log(self, log_content):
+        """
+        Import the links of a log.txt content, one link per line, that are not in the index yet
+        :return the number of links imported
+        """
+        count = 0
+        for link in log_content.split():
+            if link.startswith(('http://', 'https://')) and link not in self.records:
+                self.add(link, sync=False, source='log.txt')
+                count += 1
+        return count
+
+    def log_text(self):
+        """
+        Return the links as the content of log.txt, kept up to date for the tools reading it
+        """
+        return ' ' + ''.join('\n' + url for url in self.records)
+
+
+def load_state_index(bucket_name, folder_path, manifest_path, batch_size=50):
+    """
+    Load the index from the manifest and the deltas in S3 merged with the local manifest, whose records are kept if
+    they are newer. Without a manifest in S3, the links of log.txt are migrated into a new manifest.
+    :param bucket_name: name of the bucket
+    :param folder_path: S3 folder prefix of manifest.jsonl and log.txt, e.g. 'Datacube/RiverIce/'
+    :param manifest_path: local copy of the manifest
+    :param batch_size: number of new records before the manifest is uploaded to S3
+    :raise RuntimeError if the manifest, a delta or log.txt exists but cannot be read
+    """
+    from s3_operations import file_exists_in_s3, open_file_from_s3
+    index = StateIndex(manifest_path, bucket_name, folder_path, batch_size=batch_size)
+    local_records = index.records
+    index.records = {}
+    manifest_exists, delta_keys = index.load_s3()
+    if manifest_exists:
+        print(f'{MANIFEST_NAME} exists, loaded it from S3 bucket with {len(delta_keys)} deltas')
+    # Records of the local manifest not synced to S3 yet, e.g. after a crash
+    for url, record in local_records.items():
+        current = index.records.get(url)
+        if _wins(record, current) and record != current:
+            index.records[url] = record
+            index.unsynced.append(record)
+    index.compact()
+    if not manifest_exists and file_exists_in_s3(bucket_name, folder_path + 'log.txt'):
+        print(f'{MANIFEST_NAME} does not exist, migrating the links of log.txt')
+        log_content = open_file_from_s3(bucket_name, folder_path, file_name='log.txt')
+        if log_content is False:
+            raise RuntimeError(f'{folder_path}log.txt exists in {bucket_name} but could not be read')
+        print(f'{index.migrate_log(log_content)} links migrated from log.txt')
+    print(f'{len(index)} links are already processed')
+    return index
+
+
+"""
+# Test
+index = load_state_index('nrcan-egs-product-archive', 'Datacube/RiverIce/', manifest_path='manifest.jsonl')
+link = 'https://data.eodms-sgdot.nrcan-rncan.gc.ca/public/EGS/2016/RiverIce/CAN/ON/RiverIce_CAN_ON_Moose_20160503_232950.zip'
+print(link in index, index.get(link))
+"""
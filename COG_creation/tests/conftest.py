@@ -0,0 +1,69 @@
+import itertools
+import os
+import sys
+
+import pytest
+"""
+Fixtures of the tests: the fake EGS server of local_http_server.py and moto's S3 server, so the tests run without
+the network. Run them from COG_creation with: python -m pytest -q tests
+"""
+# The modules of COG_creation import each other by name
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+_bucket_ids = itertools.count()
+
+
+@pytest.fixture
+def egs_tree(tmp_path):
+    """
+    Return (root_dir, relative zip paths) of a fake EGS tree of 2 years of RiverIce and Flood, 2 provinces, 2 links each
+    """
+    from local_http_server import build_fake_egs_tree
+    root_dir = str(tmp_path / 'egs')
+    zip_paths = build_fake_egs_tree(root_dir, years=[2016, 2017], keywords=['RiverIce', 'Flood'], links_per_dir=2,
+                                    padding_bytes=64 * 1024)
+    return root_dir, zip_paths
+
+
+@pytest.fixture
+def serve():
+    """
+    Return a function serving a folder like local_http_server.serve_directory, the servers are shut down after the test
+    """
+    from local_http_server import serve_directory
+    servers = []
+
+    def start(root_dir, **options):
+        server, root_url = serve_directory(root_dir, **options)
+        servers.append(server)
+        return root_url
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+@pytest.fixture(scope='session')
+def s3_server():
+    """
+    Start moto's S3 server once and point the shared client of s3_operations to it, as benchmark.start_s3
+    """
+    pytest.importorskip('moto')
+    from benchmark import start_s3
+    from s3_operations import configure_s3
+    previous_endpoint = os.environ.get('S3_ENDPOINT_URL')
+    endpoint_url, server = start_s3()
+    yield endpoint_url
+    server.stop()
+    configure_s3(endpoint_url=previous_endpoint)
+
+
+@pytest.fixture
+def bucket(s3_server):
+    """
+    Return the name of a new empty bucket of moto's server
+    """
+    from s3_operations import get_s3_client
+    name = f'egs-test-{next(_bucket_ids)}'
+    get_s3_client().create_bucket(Bucket=name)
+    return name
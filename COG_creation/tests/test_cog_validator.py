@@ -0,0 +1,77 @@
+import os
+import struct
+
+import pytest
+
+from cog_validator import audit, cog_validate, validate_cog
+from s3_operations import get_s3_client
+
+SAMPLE_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'Test', 'tiff')
+COG_PATH = os.path.join(SAMPLE_DIR, 'RiverIce_CAN_ON_Moose_20160503_232950_cog.tif')
+TIFF_PATH = os.path.join(SAMPLE_DIR, 'RiverIce_CAN_ON_Moose_20160503_232950.tif')
+
+
+def _read(path):
+    with open(path, 'rb') as file:
+        return file.read()
+
+
+def test_sample_cog_is_valid():
+    report = validate_cog(COG_PATH)
+    assert report['valid'], report['errors']
+    assert report['errors'] == [] and report['warnings'] == []
+    assert (report['width'], report['height']) == (8899, 6597)
+    assert report['blocksize'] == [512, 512]
+    assert report['overviews'][0] == [4450, 3299] and len(report['overviews']) == 5
+    # The header and every IFD are in the first ranged read
+    assert report['requests'] == 1
+    assert cog_validate(COG_PATH) == (True, [], [])
+
+
+def test_sample_geotiff_is_not_a_cog():
+    report = validate_cog(TIFF_PATH)
+    assert not report['valid']
+    assert any('offset of the main IFD' in error for error in report['errors'])
+    assert any('internal overviews' in warning for warning in report['warnings'])
+    # Only the header and the IFD at the end of the file are read, not the image data
+    assert report['requests'] <= 3
+    assert report['bytes_read'] < os.path.getsize(TIFF_PATH) / 4
+
+
+@pytest.mark.parametrize('size', [4, 12, 200, 600])
+def test_truncated_tiff_is_reported(tmp_path, size):
+    path = tmp_path / 'truncated.tif'
+    path.write_bytes(_read(COG_PATH)[:size])
+    report = validate_cog(str(path))
+    assert not report['valid']
+    assert report['errors'][0].startswith('Cannot read the TIFF structure')
+
+
+def test_tiff_without_image_ifd_is_reported(tmp_path):
+    path = tmp_path / 'empty.tif'
+    # Little endian classic TIFF header whose first IFD offset is 0
+    path.write_bytes(b'II' + struct.pack('<HI', 42, 0))
+    report = validate_cog(str(path))
+    assert not report['valid']
+    assert report['errors'] == ['The file has no image IFD']
+
+
+def test_not_a_tiff_is_reported(tmp_path):
+    path = tmp_path / 'not_a_tiff.tif'
+    path.write_bytes(b'PK\x03\x04' + b'\x00' * 100)
+    report = validate_cog(str(path))
+    assert not report['valid'] and report['errors']
+
+
+def test_s3_objects_are_validated_with_ranged_reads(bucket, tmp_path):
+    s3_client = get_s3_client()
+    s3_client.upload_file(COG_PATH, bucket, 'cog/valid.tif')
+    s3_client.upload_file(TIFF_PATH, bucket, 'cog/not_a_cog.tif')
+    report = validate_cog(f's3://{bucket}/cog/valid.tif', s3_client=s3_client)
+    assert report['valid'] and report['requests'] == 1
+
+    audit_report = audit(bucket, 'cog/', workers=2, report_path=str(tmp_path / 'audit_report.json'))
+    assert audit_report['summary']['files'] == 2
+    assert audit_report['summary']['valid'] == 1 and audit_report['summary']['invalid'] == 1
+    assert audit_report['summary']['bytes_read'] < os.path.getsize(COG_PATH) + os.path.getsize(TIFF_PATH)
+    assert os.path.exists(str(tmp_path / 'audit_report.json'))
@@ -0,0 +1,116 @@
+import os
+
+import pytest
+import requests
+
+pytest.importorskip('bs4')
+
+from crawl_cache import CrawlCache
+from get_zip_links import CrawlError, crawl_zip_links, make_session
+
+
+def _counting_session(requests_sent):
+    """
+    Return a pooled session recording the url of every GET it sends
+    """
+    session = make_session(pool_size=4)
+    get = session.get
+
+    def counting_get(url, **kwargs):
+        requests_sent.append(url)
+        return get(url, **kwargs)
+    session.get = counting_get
+    return session
+
+
+def _riverice_links(root_url, zip_paths):
+    return sorted(f'{root_url}/{path}' for path in zip_paths if '/RiverIce/' in path)
+
+
+def test_crawl_finds_the_links_of_the_keyword(egs_tree, serve):
+    root_dir, zip_paths = egs_tree
+    root_url = serve(root_dir)
+    links = sorted(crawl_zip_links(root_url, [2016, 2017], ['RiverIce'], max_workers=4))
+    assert links == _riverice_links(root_url, zip_paths)
+
+
+def test_unchanged_listings_are_revalidated(egs_tree, serve, tmp_path):
+    root_dir, zip_paths = egs_tree
+    root_url = serve(root_dir)
+    cache_path = str(tmp_path / 'crawl_cache.json')
+    first = sorted(crawl_zip_links(root_url, [2016, 2017], ['RiverIce'], cache=CrawlCache(cache_path), trust_before_year=2000))
+    assert os.path.exists(cache_path)
+
+    cache = CrawlCache(cache_path)
+    second = sorted(crawl_zip_links(root_url, [2016, 2017], ['RiverIce'], cache=cache, trust_before_year=2000))
+    assert second == first == _riverice_links(root_url, zip_paths)
+    # Every page answered 304 Not Modified
+    assert cache.misses == 0
+    assert cache.hits == len(cache.entries)
+
+
+def test_changed_listing_is_downloaded_again(egs_tree, serve, tmp_path):
+    root_dir, zip_paths = egs_tree
+    root_url = serve(root_dir)
+    cache_path = str(tmp_path / 'crawl_cache.json')
+    list(crawl_zip_links(root_url, [2016, 2017], ['RiverIce'], cache=CrawlCache(cache_path), trust_before_year=2000))
+
+    folder = os.path.join(root_dir, 'public', 'EGS', '2016', 'RiverIce', 'CAN', 'ON')
+    new_zip = os.path.join(folder, 'RiverIce_CAN_ON_New_20160601_120000.zip')
+    with open(new_zip, 'wb') as file:
+        file.write(b'PK\x05\x06' + b'\x00' * 18)
+    stat = os.stat(folder)
+    # A new ETag for the listing even on a file system with a coarse mtime
+    os.utime(folder, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+
+    cache = CrawlCache(cache_path)
+    links = list(crawl_zip_links(root_url, [2016, 2017], ['RiverIce'], cache=cache, trust_before_year=2000))
+    assert f'{root_url}/public/EGS/2016/RiverIce/CAN/ON/RiverIce_CAN_ON_New_20160601_120000.zip' in links
+    assert cache.misses == 1
+
+
+def test_trusted_years_are_read_from_the_cache(egs_tree, serve, tmp_path):
+    root_dir, zip_paths = egs_tree
+    root_url = serve(root_dir)
+    cache_path = str(tmp_path / 'crawl_cache.json')
+    list(crawl_zip_links(root_url, [2016, 2017], ['RiverIce'], cache=CrawlCache(cache_path)))
+
+    requests_sent = []
+    links = sorted(crawl_zip_links(root_url, [2016, 2017], ['RiverIce'], session=_counting_session(requests_sent),
+                                   cache=CrawlCache(cache_path), trust_before_year=2017))
+    assert links == _riverice_links(root_url, zip_paths)
+    # 2016 is trusted: only its year page is revalidated, 2017 is revalidated page by page
+    assert not any('/2016/' in url and not url.endswith('/EGS/2016/') for url in requests_sent)
+    assert any('/2017/RiverIce/CAN/' in url for url in requests_sent)
+
+
+def test_refresh_downloads_every_listing(egs_tree, serve, tmp_path):
+    root_dir, _ = egs_tree
+    root_url = serve(root_dir)
+    cache_path = str(tmp_path / 'crawl_cache.json')
+    list(crawl_zip_links(root_url, [2016], ['RiverIce'], cache=CrawlCache(cache_path)))
+    cache = CrawlCache(cache_path, refresh=True)
+    list(crawl_zip_links(root_url, [2016], ['RiverIce'], cache=cache))
+    assert cache.hits == 0
+    assert cache.misses == len(cache.entries)
+
+
+def test_listing_errors_are_raised_after_the_crawl(egs_tree, serve):
+    root_dir, zip_paths = egs_tree
+    root_url = serve(root_dir)
+    session = make_session(pool_size=4)
+    get = session.get
+
+    def failing_get(url, **kwargs):
+        if url.endswith('/2016/RiverIce/CAN/ON/'):
+            raise requests.ConnectionError('connection reset')
+        return get(url, **kwargs)
+    session.get = failing_get
+    links = []
+    with pytest.raises(CrawlError) as error:
+        links.extend(crawl_zip_links(root_url, [2016, 2017], ['RiverIce'], session=session, raise_errors=True))
+    assert [url for url, _ in error.value.failures] == [f'{root_url}/public/EGS/2016/RiverIce/CAN/ON/']
+    # The other pages are crawled before the error
+    assert sorted(links) == [link for link in _riverice_links(root_url, zip_paths) if '/2016/RiverIce/CAN/ON/' not in link]
+    # Without raise_errors the failures are only printed
+    assert len(list(crawl_zip_links(root_url, [2016], ['RiverIce'], session=session))) == len(links) - 4
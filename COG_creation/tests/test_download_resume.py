@@ -0,0 +1,119 @@
+import os
+
+import pytest
+import requests
+
+from download_and_unzip import IncompleteDownload, RetryableResponse, download_zip, verify_zip
+from local_http_server import FlakyHandler
+
+
+def _read(path):
+    with open(path, 'rb') as file:
+        return file.read()
+
+
+def test_download_resumes_after_dropped_connections(egs_tree, serve, tmp_path):
+    root_dir, zip_paths = egs_tree
+    root_url = serve(root_dir, handler=FlakyHandler, drops=2, drop_after_bytes=16 * 1024, busy=1)
+    stats = {}
+    zip_path = download_zip(f'{root_url}/{zip_paths[0]}', str(tmp_path / 'zips'), chunk_size=1024, backoff=0, stats=stats)
+    source = _read(os.path.join(root_dir, zip_paths[0]))
+    assert _read(zip_path) == source
+    assert not os.path.exists(zip_path + '.part')
+    assert stats['retries'] == 3
+    # The dropped bytes are not downloaded again, the next attempts ask for the rest with a Range
+    assert stats['bytes'] == len(source)
+    assert stats['size'] == len(source)
+
+
+def test_download_resumes_from_a_part_file(egs_tree, serve, tmp_path):
+    root_dir, zip_paths = egs_tree
+    root_url = serve(root_dir)
+    source = _read(os.path.join(root_dir, zip_paths[0]))
+    zip_dir = tmp_path / 'zips'
+    zip_dir.mkdir()
+    part_path = zip_dir / (zip_paths[0].split('/')[-1] + '.part')
+    part_path.write_bytes(source[:len(source) // 2])
+    stats = {}
+    zip_path = download_zip(f'{root_url}/{zip_paths[0]}', str(zip_dir), backoff=0, stats=stats)
+    assert _read(zip_path) == source
+    assert stats['bytes'] == len(source) - len(source) // 2
+    assert stats['retries'] == 0
+
+
+def test_complete_part_file_is_verified(egs_tree, serve, tmp_path):
+    root_dir, zip_paths = egs_tree
+    root_url = serve(root_dir)
+    source = _read(os.path.join(root_dir, zip_paths[0]))
+    zip_dir = tmp_path / 'zips'
+    zip_dir.mkdir()
+    (zip_dir / (zip_paths[0].split('/')[-1] + '.part')).write_bytes(source)
+    stats = {}
+    zip_path = download_zip(f'{root_url}/{zip_paths[0]}', str(zip_dir), backoff=0, stats=stats)
+    # The server answers 416 to a Range after the end, the .part file is kept as it is a valid zip
+    assert _read(zip_path) == source
+    assert stats['bytes'] == 0
+
+
+def test_corrupted_part_file_is_downloaded_again(egs_tree, serve, tmp_path):
+    root_dir, zip_paths = egs_tree
+    root_url = serve(root_dir)
+    source = _read(os.path.join(root_dir, zip_paths[0]))
+    zip_dir = tmp_path / 'zips'
+    zip_dir.mkdir()
+    (zip_dir / (zip_paths[0].split('/')[-1] + '.part')).write_bytes(b'\x00' * len(source))
+    stats = {}
+    zip_path = download_zip(f'{root_url}/{zip_paths[0]}', str(zip_dir), backoff=0, stats=stats)
+    assert _read(zip_path) == source
+    assert stats['retries'] == 1
+
+
+def test_download_gives_up_after_the_retries(egs_tree, serve, tmp_path):
+    root_dir, zip_paths = egs_tree
+    root_url = serve(root_dir, handler=FlakyHandler, drops=0, busy=10)
+    with pytest.raises(RetryableResponse):
+        download_zip(f'{root_url}/{zip_paths[0]}', str(tmp_path / 'zips'), retries=2, backoff=0)
+
+
+def test_truncated_zip_is_not_accepted(tmp_path):
+    zip_path = tmp_path / 'truncated.zip'
+    zip_path.write_bytes(b'PK\x03\x04' + b'\x00' * 100)
+    with pytest.raises(IncompleteDownload):
+        verify_zip(str(zip_path))
+
+
+def test_changed_zip_is_not_appended_to_the_part_file(egs_tree, serve, tmp_path):
+    root_dir, zip_paths = egs_tree
+    root_url = serve(root_dir, handler=FlakyHandler, drops=1, drop_after_bytes=16 * 1024)
+    zip_dir = str(tmp_path / 'zips')
+    with pytest.raises(requests.RequestException):
+        download_zip(f'{root_url}/{zip_paths[0]}', zip_dir, chunk_size=1024, retries=0)
+    part_path = os.path.join(zip_dir, zip_paths[0].split('/')[-1] + '.part')
+    assert os.path.getsize(part_path) == 16 * 1024
+    assert os.path.exists(part_path + '.validator')
+
+    # The archive is replaced on the server before the next run
+    source_path = os.path.join(root_dir, zip_paths[0])
+    os.replace(os.path.join(root_dir, zip_paths[1]), source_path)
+    stat = os.stat(source_path)
+    os.utime(source_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    stats = {}
+    zip_path = download_zip(f'{root_url}/{zip_paths[0]}', zip_dir, backoff=0, stats=stats)
+    assert _read(zip_path) == _read(source_path)
+    # If-Range did not match, the server sent the whole new zip at once
+    assert stats['bytes'] == os.path.getsize(source_path)
+    assert stats['retries'] == 0
+    assert not os.path.exists(part_path + '.validator')
+
+
+def test_unchanged_zip_resumes_with_if_range(egs_tree, serve, tmp_path):
+    root_dir, zip_paths = egs_tree
+    root_url = serve(root_dir, handler=FlakyHandler, drops=1, drop_after_bytes=16 * 1024)
+    zip_dir = str(tmp_path / 'zips')
+    with pytest.raises(requests.RequestException):
+        download_zip(f'{root_url}/{zip_paths[0]}', zip_dir, chunk_size=1024, retries=0)
+    stats = {}
+    zip_path = download_zip(f'{root_url}/{zip_paths[0]}', zip_dir, backoff=0, stats=stats)
+    source = _read(os.path.join(root_dir, zip_paths[0]))
+    assert _read(zip_path) == source
+    assert stats['bytes'] == len(source) - 16 * 1024
@@ -0,0 +1,64 @@
+from fingerprint import LEGACY, config_hash, legacy_fingerprint, processing_params, source_changed, source_fingerprint, stale_reason
+
+JOB = {'proj_epsg': 'EPSG:3978', 'xRes': 10, 'yRes': 10, 'profile': {'compress': 'ZSTD', 'level': 9, 'blocksize': 512, 'threads': 4}}
+
+
+def test_config_hash_follows_the_parameters_that_change_the_cog():
+    config = config_hash(JOB)
+    assert len(config) == 16 and config == config_hash(dict(JOB))
+    assert config != config_hash(dict(JOB, xRes=5))
+    assert config != config_hash(dict(JOB, proj_epsg='EPSG:4326'))
+    assert config != config_hash(dict(JOB, profile=dict(JOB['profile'], compress='LZW')))
+    # The same resolution given as an int or a float
+    assert config == config_hash(dict(JOB, xRes=10.0, yRes='10'))
+
+
+def test_config_hash_ignores_the_options_that_do_not_change_the_cog():
+    config = config_hash(JOB)
+    # --two-step writes the same COG through an intermediate file
+    assert config == config_hash(dict(JOB, two_step=True))
+    assert config == config_hash(dict(JOB, profile=dict(JOB['profile'], threads=16, cache_mb=1024)))
+    assert config == config_hash(dict(JOB, thumbnail='png', stac_collection='RiverIce', check_source=True, link='other.zip'))
+    assert 'two_step' not in processing_params(dict(JOB, two_step=True))
+
+
+def test_stale_reason():
+    config = config_hash(JOB)
+    assert stale_reason(None, config) == 'new'
+    assert stale_reason({'url': 'a'}, config) is None
+    assert stale_reason({'fingerprint': {'config': config, 'etag': 'e'}}, config) is None
+    assert stale_reason({'fingerprint': {'config': config_hash(dict(JOB, xRes=5))}}, config) == 'parameters changed'
+
+
+def test_legacy_records_are_rebuilt_by_the_next_change_of_parameters():
+    config = config_hash(JOB)
+    record = {'url': 'a', 'fingerprint': legacy_fingerprint(config)}
+    assert record['fingerprint'] == {'config': LEGACY, 'assumed': config}
+    # Up to date for the run that found it, not mistaken for a link processed with these parameters
+    assert stale_reason(record, config) is None
+    assert record['fingerprint']['config'] != config
+    assert stale_reason(record, config_hash(dict(JOB, xRes=5))) == 'parameters changed'
+
+
+def test_source_changed():
+    fingerprint = {'config': 'c', 'etag': '"a"', 'size': 10}
+    assert not source_changed(fingerprint, {'etag': '"a"', 'size': 10})
+    assert source_changed(fingerprint, {'etag': '"b"', 'size': 10})
+    # The ETag wins over the size
+    assert not source_changed(fingerprint, {'etag': '"a"', 'size': 11})
+    # Without ETags the sizes are compared
+    assert source_changed({'size': 10}, {'etag': '"a"', 'size': 11})
+    assert not source_changed({'size': 10}, {'etag': None, 'size': 10})
+    # A legacy record, or a server that did not answer, is not a change
+    assert not source_changed(legacy_fingerprint('c'), {'etag': '"a"', 'size': 10})
+    assert not source_changed(fingerprint, None)
+    assert not source_changed(None, {'etag': '"a"'})
+
+
+def test_source_fingerprint_from_a_head_request(egs_tree, serve):
+    root_dir, zip_paths = egs_tree
+    root_url = serve(root_dir)
+    source = source_fingerprint(f'{root_url}/{zip_paths[0]}')
+    assert source['etag'] and source['size'] > 64 * 1024
+    assert not source_changed(dict(source, config='c'), source_fingerprint(f'{root_url}/{zip_paths[0]}'))
+    assert source_fingerprint(f'{root_url}/public/EGS/missing.zip') is None
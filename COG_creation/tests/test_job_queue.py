@@ -0,0 +1,134 @@
+import os
+import threading
+
+import pytest
+
+from job_queue import DONE, FAILED, PENDING, RUNNING, JobQueue
+
+LINKS = [f'https://egs/2016/RiverIce/RiverIce_{i}.zip' for i in range(20)]
+
+
+@pytest.fixture
+def workers(tmp_path):
+    """
+    Return two workers with their own connection to the same queue file
+    """
+    db_path = str(tmp_path / 'queue.sqlite')
+    first = JobQueue(db_path, worker_id='node-a', lease_seconds=60, max_attempts=2, retry_delay=60)
+    second = JobQueue(db_path, worker_id='node-b', lease_seconds=60, max_attempts=2, retry_delay=60)
+    first.plan('RiverIce', [2016])
+    first.expand('RiverIce', lambda year: LINKS)
+    yield first, second
+    first.close()
+    second.close()
+
+
+def _state(job_queue, job_id):
+    return job_queue.conn.execute('SELECT state, worker, attempts FROM jobs WHERE id = ?', (job_id,)).fetchone()
+
+
+def _expire(job_queue, job_id):
+    job_queue.conn.execute('UPDATE jobs SET claimed_at = claimed_at - 3600 WHERE id = ?', (job_id,))
+
+
+def test_default_worker_ids_differ_per_process(tmp_path):
+    job_queue = JobQueue(str(tmp_path / 'queue.sqlite'))
+    assert job_queue.worker_id.endswith(f'-{os.getpid()}')
+    job_queue.close()
+
+
+def test_two_workers_never_claim_the_same_job(workers):
+    claimed = {worker.worker_id: [] for worker in workers}
+
+    def claim_all(worker):
+        while True:
+            row = worker.claim('RiverIce')
+            if row is None:
+                return
+            claimed[worker.worker_id].append(row[1])
+            worker.done(row[0])
+    threads = [threading.Thread(target=claim_all, args=(worker,)) for worker in workers for _ in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(timeout=30)
+    links = claimed['node-a'] + claimed['node-b']
+    assert sorted(links) == sorted(LINKS)
+    assert workers[0].counts('RiverIce') == {'RiverIce': {DONE: len(LINKS)}}
+
+
+def test_expired_lease_is_claimed_by_the_other_worker(workers):
+    first, second = workers
+    job_id, link = first.claim('RiverIce')
+    # The lease of the first worker is not over, the second worker takes the next job
+    assert second.claim('RiverIce')[1] != link
+    _expire(first, job_id)
+    assert second.claim('RiverIce') == (job_id, link)
+    assert _state(first, job_id) == (RUNNING, 'node-b', 2)
+    # Claimed max_attempts times and abandoned again, the job is failed instead of claimed a third time
+    _expire(first, job_id)
+    assert first.claim('RiverIce')[0] != job_id
+    assert _state(first, job_id)[0] == FAILED
+
+
+def test_failed_job_is_claimed_after_its_retry_delay(workers):
+    first, second = workers
+    job_id, link = first.claim('RiverIce')
+    assert first.failed(job_id, 'timeout')
+    assert _state(first, job_id)[0] == PENDING
+    # The other jobs are pending without delay
+    assert second.next_retry('RiverIce') == 0
+    while True:
+        row = second.claim('RiverIce')
+        if row is None:
+            break
+        assert row[0] != job_id
+        second.done(row[0])
+    # Only the job waiting for its retry delay is left
+    assert 59 < second.next_retry('RiverIce') <= 60
+    first.conn.execute('UPDATE jobs SET retry_at = 0 WHERE id = ?', (job_id,))
+    assert second.next_retry('RiverIce') == 0
+    assert second.claim('RiverIce') == (job_id, link)
+    # Second and last attempt
+    assert not second.failed(job_id, 'timeout')
+    assert _state(first, job_id) == (FAILED, 'node-b', 2)
+    assert second.next_retry('RiverIce') is None
+    assert second.requeue_failed('RiverIce') == 1
+    assert _state(first, job_id) == (PENDING, 'node-b', 0)
+
+
+def test_reset_only_puts_back_the_jobs_of_its_worker(workers):
+    first, second = workers
+    first_job = first.claim('RiverIce')[0]
+    second_job = second.claim('RiverIce')[0]
+    # node-a restarts, the job of node-b is still running
+    assert first.reset_worker() == 1
+    assert _state(first, first_job)[0] == PENDING
+    assert _state(first, second_job) == (RUNNING, 'node-b', 1)
+
+
+def test_failed_crawl_is_expanded_again(tmp_path):
+    job_queue = JobQueue(str(tmp_path / 'queue.sqlite'), worker_id='node-a')
+    job_queue.plan('RiverIce', [2016, 2017])
+
+    def crawl(year):
+        yield LINKS[0]
+        if year == 2016:
+            raise IOError('Failed to list 1 directory pages')
+        yield LINKS[1]
+    assert job_queue.expand('RiverIce', crawl) == [2016]
+    states = dict(job_queue.conn.execute('SELECT year, state FROM units'))
+    assert states == {2016: FAILED, 2017: DONE}
+    # The links found before the error are queued
+    assert job_queue.counts('RiverIce') == {'RiverIce': {PENDING: 2}}
+    # The next run crawls the failed year again
+    job_queue.plan('RiverIce', [2016, 2017])
+    assert job_queue.expand('RiverIce', lambda year: LINKS[:3]) == []
+    assert dict(job_queue.conn.execute('SELECT year, links FROM units')) == {2016: 3, 2017: 2}
+    assert job_queue.counts('RiverIce') == {'RiverIce': {PENDING: 3}}
+    # Any other error of the crawl is raised, the unit is failed instead of left running
+    job_queue.plan('RiverIce', [2018])
+    with pytest.raises(ValueError):
+        job_queue.expand('RiverIce', lambda year: [int('x')])
+    assert job_queue.conn.execute('SELECT state FROM units WHERE year = 2018').fetchone()[0] == FAILED
+    job_queue.close()
@@ -0,0 +1,96 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from pipeline import run_pipeline
+
+
+def _stage(name, delay=0):
+    def stage(job):
+        time.sleep(delay(job) if callable(delay) else delay)
+        job.setdefault('stages', []).append(name)
+        return job
+    stage.__name__ = name
+    return stage
+
+
+def test_jobs_go_through_the_stages_in_order():
+    with ThreadPoolExecutor(max_workers=1) as first, ThreadPoolExecutor(max_workers=1) as second:
+        jobs = [{'i': i} for i in range(10)]
+        finished = list(run_pipeline(iter(jobs), [(_stage('a'), first, 1), (_stage('b'), second, 1)], queue_size=2))
+    # One job at a time per stage keeps the input order
+    assert [job['i'] for job in finished] == list(range(10))
+    assert all(job['stages'] == ['a', 'b'] for job in finished)
+
+
+def test_jobs_are_yielded_in_completion_order():
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        jobs = [{'i': i} for i in range(4)]
+        # The first job is the slowest
+        stage = _stage('a', delay=lambda job: 0.3 if job['i'] == 0 else 0)
+        finished = list(run_pipeline(iter(jobs), [(stage, executor, 4)], queue_size=4))
+    assert sorted(job['i'] for job in finished) == list(range(4))
+    assert finished[-1]['i'] == 0
+
+
+def test_bounded_queues_hold_back_the_feed():
+    fed = []
+
+    def jobs():
+        for i in range(50):
+            fed.append(i)
+            yield {'i': i}
+
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        pipeline = run_pipeline(jobs(), [(_stage('a'), executor, 1)], queue_size=2)
+        first = next(pipeline)
+        time.sleep(0.3)
+        # Jobs in the input queue, in the stage and in the output queue, not the whole iterable
+        assert first['i'] == 0
+        assert len(fed) <= 2 + 1 + 2 + 2
+        finished = [first] + list(pipeline)
+    assert len(finished) == 50 and len(fed) == 50
+
+
+def test_a_failed_job_does_not_stop_the_others():
+    def fail_odd(job):
+        if job['i'] % 2:
+            raise ValueError(f'job {job["i"]}')
+        return job
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        finished = list(run_pipeline(iter({'i': i} for i in range(6)), [(fail_odd, executor, 2), (_stage('b'), executor, 2)]))
+    failed = sorted(job['i'] for job in finished if job.get('error'))
+    assert failed == [1, 3, 5]
+    # The failed jobs skip the next stages
+    assert all('stages' not in job for job in finished if job.get('error'))
+    assert all(job['stages'] == ['b'] for job in finished if not job.get('error'))
+
+
+def test_a_feed_error_is_raised_after_the_started_jobs():
+    def jobs():
+        for i in range(3):
+            yield {'i': i}
+        raise RuntimeError('crawl failed')
+
+    finished = []
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        with pytest.raises(RuntimeError, match='crawl failed'):
+            for job in run_pipeline(jobs(), [(_stage('a', 0.05), executor, 2)]):
+                finished.append(job)
+    assert sorted(job['i'] for job in finished) == [0, 1, 2]
+
+
+def test_a_stage_error_is_raised_after_the_queues_drain():
+    # A job that is not a dict stops the first stage itself, not only the job
+    jobs = [{'i': 0}, {'i': 1}, 'not a job'] + [{'i': i} for i in range(2, 20)]
+    finished = []
+    with ThreadPoolExecutor(max_workers=1) as first, ThreadPoolExecutor(max_workers=1) as second:
+        with pytest.raises(AttributeError):
+            for job in run_pipeline(iter(jobs), [(_stage('a'), first, 1), (_stage('b'), second, 1)], queue_size=1):
+                finished.append(job)
+    # The jobs started before the error are finished, and no thread is left blocked on a full queue
+    assert [job['i'] for job in finished] == [0, 1]
+    assert not [thread for thread in threading.enumerate() if thread.name.startswith('stage-')]
@@ -0,0 +1,109 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+import s3_inventory
+from s3_inventory import S3Inventory
+from s3_operations import get_s3_client, iter_s3_objects, list_files_in_s3
+
+COG_COUNT = 2100
+
+
+@pytest.fixture(scope='module')
+def listed_bucket(s3_server):
+    """
+    Return a bucket with COG_COUNT COGs, more than two pages of the listing, and a few other objects
+    """
+    s3_client = get_s3_client()
+    name = 'egs-test-inventory'
+    s3_client.create_bucket(Bucket=name)
+    keys = [f'Datacube/RiverIce/cog/RiverIce_{i:04d}.tif' for i in range(COG_COUNT)]
+    keys += [f'Datacube/RiverIce/json/RiverIce_{i:04d}.json' for i in range(5)]
+    keys += ['Datacube/RiverIce/log.txt', 'Datacube/RiverIce0/cog/other.tif', 'Datacube/Flood/cog/Flood_0000.tif']
+    with ThreadPoolExecutor(max_workers=16) as pool:
+        list(pool.map(lambda key: s3_client.put_object(Bucket=name, Key=key, Body=b'x'), keys))
+    return name
+
+
+def test_listing_goes_past_the_first_page(listed_bucket):
+    objects = list(iter_s3_objects(listed_bucket, 'Datacube/RiverIce/cog/'))
+    assert len(objects) == COG_COUNT
+    assert len({obj['key'] for obj in objects}) == COG_COUNT
+    assert objects[0]['size'] == 1 and '"' not in objects[0]['etag']
+    assert len(list_files_in_s3(listed_bucket, 'Datacube/RiverIce/cog/')) == COG_COUNT
+
+
+def test_prefix_queries_from_the_index(listed_bucket):
+    inventory = S3Inventory(listed_bucket)
+    assert inventory.load('Datacube/') == COG_COUNT + 5 + 3
+    assert len(inventory.keys('Datacube/RiverIce/cog/')) == COG_COUNT
+    assert list(inventory.keys('Datacube/RiverIce/json/')) == [f'Datacube/RiverIce/json/RiverIce_{i:04d}.json' for i in range(5)]
+    # 'Datacube/RiverIce/' is not a prefix of 'Datacube/RiverIce0/'
+    assert 'Datacube/RiverIce0/cog/other.tif' not in inventory.keys('Datacube/RiverIce/')
+    assert len(inventory.keys('Datacube/RiverIce')) == COG_COUNT + 5 + 1 + 1
+    assert list(inventory.keys('Datacube/RiverIce/cog/RiverIce_00')) == [f'Datacube/RiverIce/cog/RiverIce_{i:04d}.tif' for i in range(100)]
+    assert inventory.keys('Datacube/Missing/') == {}
+    assert 'RiverIce_2099.tif' in inventory.names('Datacube/RiverIce/cog/')
+    assert inventory.find_name('Flood_0000.tif') == 'Datacube/Flood/cog/Flood_0000.tif'
+    assert 'Datacube/RiverIce/log.txt' in inventory
+    assert inventory.get('Datacube/RiverIce/cog/missing.tif') is None
+
+
+def test_added_and_removed_keys_keep_the_index_sorted(listed_bucket):
+    inventory = S3Inventory(listed_bucket)
+    inventory.load('Datacube/RiverIce/json/')
+    inventory.add('Datacube/RiverIce/json/A.json', 1, 'e')
+    inventory.add('Datacube/RiverIce/json/z.json', 1, 'e')
+    assert list(inventory.keys('Datacube/RiverIce/json/'))[0] == 'Datacube/RiverIce/json/A.json'
+    assert list(inventory.keys('Datacube/RiverIce/json/'))[-1] == 'Datacube/RiverIce/json/z.json'
+    # The added keys are not in S3, a refresh removes them
+    assert inventory.load('Datacube/RiverIce/json/', refresh=True) == 5
+    assert inventory._sorted == sorted(inventory.objects)
+
+
+def test_lookups_are_answered_while_a_prefix_is_listed(listed_bucket, monkeypatch):
+    inventory = S3Inventory(listed_bucket)
+    inventory.load('Datacube/RiverIce/json/')
+    listing, release = threading.Event(), threading.Event()
+    listed = []
+
+    def slow_listing(*args, **kwargs):
+        listed.append(args[1])
+        listing.set()
+        release.wait(timeout=10)
+        return iter_s3_objects(*args, **kwargs)
+    monkeypatch.setattr(s3_inventory, 'iter_s3_objects', slow_listing)
+
+    refresh = threading.Thread(target=inventory.load, args=('Datacube/RiverIce/',), kwargs={'refresh': True})
+    refresh.start()
+    assert listing.wait(timeout=10)
+    # The listing runs without the lock, the lookups of the prefixes already listed are not blocked
+    lookup = threading.Thread(target=lambda: listed.append(len(inventory.keys('Datacube/RiverIce/json/'))))
+    lookup.start()
+    lookup.join(timeout=5)
+    assert not lookup.is_alive() and listed[-1] == 5
+    # A lookup under the prefix being listed waits for that listing instead of listing again
+    waiting = threading.Thread(target=lambda: listed.append(len(inventory.keys('Datacube/RiverIce/cog/'))))
+    waiting.start()
+    waiting.join(timeout=0.3)
+    assert waiting.is_alive()
+    inventory.add('Datacube/RiverIce/json/uploaded.json', 1, 'e')
+
+    release.set()
+    refresh.join(timeout=30)
+    waiting.join(timeout=30)
+    assert listed == ['Datacube/RiverIce/', 5, COG_COUNT]
+    # The key added while the listing ran is kept
+    assert 'Datacube/RiverIce/json/uploaded.json' in inventory.keys('Datacube/RiverIce/json/')
+    assert inventory._sorted == sorted(inventory.objects)
+
+
+def test_listings_are_kept_in_the_cache_file(listed_bucket, tmp_path):
+    cache_path = str(tmp_path / 's3_inventory.json')
+    inventory = S3Inventory(listed_bucket, cache_path=cache_path, max_age=3600)
+    inventory.load('Datacube/RiverIce/cog/')
+    inventory.save()
+    cached = S3Inventory(listed_bucket, cache_path=cache_path, max_age=3600)
+    assert len(cached.keys('Datacube/RiverIce/cog/')) == COG_COUNT
+    assert cached._sorted == sorted(cached.objects)
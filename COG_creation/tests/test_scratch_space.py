@@ -0,0 +1,92 @@
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from pipeline import run_pipeline
+from scratch_space import MB, ScratchSpace
+
+
+def test_reservations_wait_for_the_quota(tmp_path):
+    scratch = ScratchSpace(str(tmp_path / 'scratch'), quota_bytes=100 * MB, poll=0.05)
+    first, waited = scratch.reserve('first', 60 * MB)
+    assert os.path.isdir(first) and waited < 1
+    reserved = []
+    thread = threading.Thread(target=lambda: reserved.append(scratch.reserve('second', 60 * MB)))
+    thread.start()
+    time.sleep(0.3)
+    # 120 MB do not fit in the quota of 100 MB
+    assert reserved == []
+    scratch.release(first)
+    thread.join(timeout=5)
+    assert reserved and reserved[0][1] >= 0.3
+    assert not os.path.exists(first)
+    assert scratch.peak_reserved == 60 * MB
+    scratch.release(reserved[0][0])
+    assert scratch.reserved == 0
+
+
+def test_a_link_alone_always_gets_its_space(tmp_path):
+    scratch = ScratchSpace(str(tmp_path / 'scratch'), quota_bytes=10 * MB)
+    work_dir, waited = scratch.reserve('large', 50 * MB)
+    assert waited < 1 and scratch.reserved == 50 * MB
+    scratch.release(work_dir)
+
+
+def test_keep_and_cleanup(tmp_path):
+    root_dir = tmp_path / 'scratch'
+    scratch = ScratchSpace(str(root_dir), keep=True)
+    kept, _ = scratch.reserve('kept', MB)
+    scratch.release(kept)
+    assert os.path.isdir(kept)
+    (root_dir / 'not_a_work_dir').mkdir()
+
+    scratch = ScratchSpace(str(root_dir))
+    scratch.cleanup()
+    assert sorted(os.listdir(str(root_dir))) == ['not_a_work_dir']
+
+
+def test_estimate_from_the_size_of_the_zip(egs_tree, serve, tmp_path):
+    root_dir, zip_paths = egs_tree
+    root_url = serve(root_dir)
+    scratch = ScratchSpace(str(tmp_path / 'scratch'), expansion=4, default_size=MB)
+    size = os.path.getsize(os.path.join(root_dir, zip_paths[0]))
+    assert scratch.estimate(f'{root_url}/{zip_paths[0]}') == 4 * size
+    assert scratch.estimate(f'{root_url}/public/EGS/missing.zip') == 4 * MB
+
+
+def test_uploads_free_the_space_of_blocked_downloads(tmp_path):
+    """
+    The downloads wait for their scratch space on the io executor, and the space is only given back once the uploads
+    are done: with the uploads on the same executor, every io thread ends up waiting and the run stalls
+    """
+    scratch = ScratchSpace(str(tmp_path / 'scratch'), quota_bytes=100 * MB, poll=0.05)
+
+    def download(job):
+        job['work_dir'], _ = scratch.reserve(job['name'], 60 * MB)
+        return job
+
+    def upload(job):
+        time.sleep(0.05)
+        job['uploaded'] = True
+        return job
+
+    finished = []
+
+    def run():
+        with ThreadPoolExecutor(max_workers=2) as io_pool, ThreadPoolExecutor(max_workers=2) as upload_pool:
+            jobs = ({'name': f'link{i}'} for i in range(8))
+            for job in run_pipeline(jobs, [(download, io_pool, 2), (upload, upload_pool, 2)], queue_size=2):
+                scratch.release(job['work_dir'])
+                finished.append(job)
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    thread.join(timeout=30)
+    deadlocked = thread.is_alive()
+    if deadlocked:
+        # Lift the quota so the waiting threads end and the test can report the failure
+        scratch.quota_bytes = None
+        thread.join()
+    assert not deadlocked, 'the pipeline is deadlocked on the scratch quota'
+    assert len(finished) == 8 and all(job.get('uploaded') for job in finished)
+    assert scratch.peak_reserved <= 100 * MB and scratch.reserved == 0
@@ -0,0 +1,59 @@
+import json
+
+import pytest
+
+import s3_operations
+from s3_operations import get_s3_client
+from stac_metadata import StacCollection, stac_prefix
+
+FOLDER = 'Datacube/RiverIce/'
+KEY = stac_prefix(FOLDER) + 'collection.json'
+
+
+def _item(item_id, bbox, datetime_value):
+    return {'id': item_id, 'bbox': bbox, 'properties': {'datetime': datetime_value}}
+
+
+def _collection(bucket):
+    return json.loads(get_s3_client().get_object(Bucket=bucket, Key=KEY)['Body'].read())
+
+
+def test_new_collection_is_saved_and_loaded(bucket):
+    collection = StacCollection(bucket, FOLDER, 'RiverIce')
+    collection.add(_item('a', [-80, 45, -79, 46], '2016-05-03T23:29:50Z'))
+    assert collection.save()
+    loaded = StacCollection(bucket, FOLDER, 'other id')
+    assert loaded.collection['id'] == 'RiverIce'
+    assert loaded.collection['extent']['spatial']['bbox'][0] == [-80, 45, -79, 46]
+    # Nothing changed since it was loaded, nothing is uploaded
+    assert loaded.save()
+
+
+def test_save_merges_the_items_of_other_workers(bucket):
+    first = StacCollection(bucket, FOLDER, 'RiverIce')
+    second = StacCollection(bucket, FOLDER, 'RiverIce')
+    first.add(_item('a', [-80, 45, -79, 46], '2016-05-03T23:29:50Z'))
+    second.add(_item('b', [-75, 44, -74, 47], '2017-04-01T12:00:00Z'))
+    assert first.save() and second.save()
+    collection = _collection(bucket)
+    assert sorted(link['href'] for link in collection['links'] if link['rel'] == 'item') == ['./items/a.json', './items/b.json']
+    assert collection['extent']['spatial']['bbox'][0] == [-80, 44, -74, 47]
+    assert collection['extent']['temporal']['interval'][0] == ['2016-05-03T23:29:50Z', '2017-04-01T12:00:00Z']
+
+
+def test_unreadable_collection_stops_the_load(bucket, monkeypatch):
+    get_s3_client().put_object(Bucket=bucket, Key=KEY, Body=b'{"id": "RiverIce"')
+    with pytest.raises(RuntimeError):
+        StacCollection(bucket, FOLDER, 'RiverIce')
+    get_s3_client().put_object(Bucket=bucket, Key=KEY, Body=b'{}')
+    monkeypatch.setattr(s3_operations, 'open_file_from_s3', lambda *args, **kwargs: False)
+    with pytest.raises(RuntimeError):
+        StacCollection(bucket, FOLDER, 'RiverIce')
+
+
+def test_unreadable_collection_is_not_replaced(bucket):
+    collection = StacCollection(bucket, FOLDER, 'RiverIce')
+    collection.add(_item('a', [-80, 45, -79, 46], '2016-05-03T23:29:50Z'))
+    get_s3_client().put_object(Bucket=bucket, Key=KEY, Body=b'not json')
+    assert not collection.save()
+    assert get_s3_client().get_object(Bucket=bucket, Key=KEY)['Body'].read() == b'not json'
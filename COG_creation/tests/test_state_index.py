@@ -0,0 +1,138 @@
+import json
+
+import pytest
+
+import s3_operations
+from s3_operations import get_s3_client
+from state_index import DELTA_FOLDER, MANIFEST_NAME, StateIndex, load_state_index
+
+FOLDER = 'Datacube/RiverIce/'
+LINK = 'https://data.eodms-sgdot.nrcan-rncan.gc.ca/public/EGS/2016/RiverIce/CAN/ON/RiverIce_CAN_ON_Site{}_20160503_232950.zip'
+
+
+def _keys(bucket, prefix):
+    return sorted(obj['Key'] for obj in get_s3_client().list_objects_v2(Bucket=bucket, Prefix=prefix).get('Contents', []))
+
+
+def _manifest(bucket):
+    body = get_s3_client().get_object(Bucket=bucket, Key=FOLDER + MANIFEST_NAME)['Body'].read().decode('utf-8')
+    return {record['url']: record for record in map(json.loads, body.splitlines())}
+
+
+def test_local_manifest_round_trip(tmp_path):
+    manifest_path = str(tmp_path / MANIFEST_NAME)
+    index = StateIndex(manifest_path)
+    index.add(LINK.format(0), sha256='a', cog_key='cog/0.tif', validation=True, fingerprint={'config': 'c'})
+    index.update(LINK.format(0), fingerprint={'config': 'd'}, timestamp='2030-01-01T00:00:00Z')
+    index.add(LINK.format(1), sha256='b')
+
+    loaded = StateIndex(manifest_path)
+    assert len(loaded) == 2
+    assert loaded.get(LINK.format(0))['fingerprint'] == {'config': 'd'}
+    assert loaded.get(LINK.format(0))['cog_key'] == 'cog/0.tif'
+    loaded.compact()
+    with open(manifest_path) as file:
+        assert len(file.readlines()) == 2
+    assert loaded.log_text().split() == [LINK.format(0), LINK.format(1)]
+
+
+def test_syncs_upload_only_the_new_records(tmp_path, bucket):
+    index = StateIndex(str(tmp_path / MANIFEST_NAME), bucket, FOLDER, batch_size=2)
+    for i in range(5):
+        index.add(LINK.format(i))
+    deltas = _keys(bucket, FOLDER + DELTA_FOLDER)
+    assert len(deltas) == 2
+    assert index.unsynced == [index.get(LINK.format(4))]
+    for key in deltas:
+        body = get_s3_client().get_object(Bucket=bucket, Key=key)['Body'].read().decode('utf-8')
+        assert len(body.splitlines()) == 2
+
+
+def test_publish_merges_the_workers(tmp_path, bucket):
+    first = StateIndex(str(tmp_path / 'first.jsonl'), bucket, FOLDER, batch_size=100)
+    second = StateIndex(str(tmp_path / 'second.jsonl'), bucket, FOLDER, batch_size=100)
+    second.worker_id = 'other-host-1'
+    first.add(LINK.format(0), cog_key='old', timestamp='2024-01-01T00:00:00Z')
+    first.add(LINK.format(1), timestamp='2024-01-01T00:00:00Z')
+    second.add(LINK.format(0), cog_key='new', timestamp='2024-06-01T00:00:00Z')
+    second.add(LINK.format(2), timestamp='2024-06-01T00:00:00Z')
+    assert second.sync()
+
+    assert first.publish(grace_seconds=0)
+    manifest = _manifest(bucket)
+    assert sorted(manifest) == [LINK.format(i) for i in range(3)]
+    # The latest record of a url wins
+    assert manifest[LINK.format(0)]['cog_key'] == 'new'
+    # The deltas are merged into manifest.jsonl and deleted
+    assert _keys(bucket, FOLDER + DELTA_FOLDER) == []
+
+    loaded = load_state_index(bucket, FOLDER, str(tmp_path / 'third.jsonl'))
+    assert sorted(loaded.records) == sorted(manifest)
+    assert loaded.unsynced == []
+
+
+def test_recent_deltas_are_kept_by_publish(tmp_path, bucket):
+    index = StateIndex(str(tmp_path / MANIFEST_NAME), bucket, FOLDER, batch_size=100)
+    index.add(LINK.format(0))
+    assert index.publish()
+    assert LINK.format(0) in _manifest(bucket)
+    # Another worker may publish from a listing without this delta, it is only deleted after the grace period
+    assert len(_keys(bucket, FOLDER + DELTA_FOLDER)) == 1
+
+
+def test_local_records_not_synced_are_kept(tmp_path, bucket):
+    manifest_path = str(tmp_path / MANIFEST_NAME)
+    index = StateIndex(manifest_path, bucket, FOLDER, batch_size=100)
+    index.add(LINK.format(0))
+    assert index.publish(grace_seconds=0)
+    # A crash before the next sync
+    index.add(LINK.format(1))
+
+    loaded = load_state_index(bucket, FOLDER, manifest_path)
+    assert sorted(loaded.records) == [LINK.format(0), LINK.format(1)]
+    assert [record['url'] for record in loaded.unsynced] == [LINK.format(1)]
+
+
+def test_log_is_migrated_without_manifest(tmp_path, bucket):
+    get_s3_client().put_object(Bucket=bucket, Key=FOLDER + 'log.txt', Body=(' \n' + LINK.format(0) + '\n' + LINK.format(1)).encode())
+    loaded = load_state_index(bucket, FOLDER, str(tmp_path / MANIFEST_NAME))
+    assert sorted(loaded.records) == [LINK.format(0), LINK.format(1)]
+    assert all(record['source'] == 'log.txt' for record in loaded.records.values())
+
+
+def test_unreadable_delta_stops_the_load(tmp_path, bucket, monkeypatch):
+    index = StateIndex(str(tmp_path / MANIFEST_NAME), bucket, FOLDER, batch_size=1)
+    index.add(LINK.format(0))
+    monkeypatch.setattr(s3_operations, 'open_file_from_s3', lambda *args, **kwargs: False)
+    with pytest.raises(RuntimeError):
+        load_state_index(bucket, FOLDER, str(tmp_path / 'other.jsonl'))
+
+
+def test_a_stub_never_replaces_a_processed_record(tmp_path, bucket):
+    worker = StateIndex(str(tmp_path / 'worker.jsonl'), bucket, FOLDER, batch_size=100)
+    worker.add(LINK.format(0), sha256='a', cog_key='cog/0.tif', fingerprint={'config': 'c'}, timestamp='2024-01-01T00:00:00Z')
+    assert worker.publish(grace_seconds=0)
+
+    # A tool recording the existing COGs from a stale local manifest, with newer timestamps
+    tool = StateIndex(str(tmp_path / 'tool.jsonl'), bucket, FOLDER, batch_size=100)
+    tool.add(LINK.format(0), sync=False, cog_key='cog/0.tif', source='create_log.py')
+    tool.add(LINK.format(1), sync=False, cog_key='cog/1.tif', source='create_log.py')
+    assert tool.publish(grace_seconds=0)
+    manifest = _manifest(bucket)
+    assert manifest[LINK.format(0)]['fingerprint'] == {'config': 'c'}
+    assert manifest[LINK.format(1)]['source'] == 'create_log.py'
+
+    # A processed record replaces a stub
+    worker = load_state_index(bucket, FOLDER, str(tmp_path / 'worker.jsonl'))
+    worker.add(LINK.format(1), sha256='b', cog_key='cog/1.tif', timestamp='2020-01-01T00:00:00Z')
+    assert worker.publish(grace_seconds=0)
+    assert _manifest(bucket)[LINK.format(1)]['sha256'] == 'b'
+
+
+def test_records_already_in_s3_are_seen_by_a_new_index(tmp_path, bucket):
+    worker = StateIndex(str(tmp_path / 'worker.jsonl'), bucket, FOLDER, batch_size=1)
+    worker.add(LINK.format(0), sha256='a')
+    # Only a delta in S3, no manifest.jsonl yet
+    loaded = load_state_index(bucket, FOLDER, str(tmp_path / 'tool.jsonl'))
+    assert LINK.format(0) in loaded
+    assert loaded.get(LINK.format(0))['sha256'] == 'a'
@@ -0,0 +1,33 @@
+import os
+
+import pytest
+
+pytest.importorskip('osgeo')
+
+from geotiff_to_cog import warp_to_cog
+from tiled_reproject import compare_rasters, output_grid, tiled_warp_to_cog
+
+SAMPLE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'Test', 'tiff',
+                      'RiverIce_CAN_ON_Moose_20160503_232950.tif')
+DATETIME = '2016:05:03 23:29:50'
+
+
+def test_tiled_cog_matches_the_exact_single_piece_warp(tmp_path):
+    tiled_path = str(tmp_path / 'tiled_cog.tif')
+    reference_path = str(tmp_path / 'reference_cog.tif')
+    _, width, height = output_grid(SAMPLE, 'EPSG:3978', 10, 10)
+    # Several tiles in both directions, with partial tiles on the right and bottom edges
+    assert width > 512 and height > 512
+    tiled_warp_to_cog(SAMPLE, tiled_path, 'EPSG:3978', 10, 10, DATETIME, tile_size=512, tile_workers=2)
+    warp_to_cog(SAMPLE, reference_path, 'EPSG:3978', 10, 10, DATETIME, exact=True)
+    assert compare_rasters(tiled_path, reference_path) == []
+    assert not os.path.exists(str(tmp_path / 'tiled_cog_tiles'))
+
+
+def test_compare_rasters_reports_the_differences(tmp_path):
+    first_path = str(tmp_path / 'first_cog.tif')
+    second_path = str(tmp_path / 'second_cog.tif')
+    warp_to_cog(SAMPLE, first_path, 'EPSG:3978', 40, 40, DATETIME)
+    warp_to_cog(SAMPLE, second_path, 'EPSG:3978', 20, 20, DATETIME)
+    assert compare_rasters(first_path, first_path) == []
+    assert compare_rasters(first_path, second_path)[0].startswith('size')
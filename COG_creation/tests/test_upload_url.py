@@ -0,0 +1,88 @@
+import hashlib
+import os
+
+import pytest
+
+from local_http_server import FlakyHandler, build_fake_egs_tree
+from s3_operations import MB, configure_s3, get_s3_client, s3_settings, upload_url_to_s3
+
+
+def _read(path):
+    with open(path, 'rb') as file:
+        return file.read()
+
+
+def _object_keys(bucket):
+    return [obj['Key'] for obj in get_s3_client().list_objects_v2(Bucket=bucket).get('Contents', [])]
+
+
+@pytest.fixture
+def multipart():
+    """
+    Upload the files larger than 5 MB, the smallest part S3 accepts, in multipart uploads during the test
+    """
+    previous = {key: s3_settings[key] for key in ('multipart_threshold', 'multipart_chunksize')}
+    configure_s3(multipart_threshold=5 * MB, multipart_chunksize=5 * MB)
+    yield
+    configure_s3(**previous)
+
+
+def test_zip_is_streamed_to_s3(egs_tree, serve, bucket):
+    root_dir, zip_paths = egs_tree
+    root_url = serve(root_dir)
+    source = _read(os.path.join(root_dir, zip_paths[0]))
+    stats = {}
+    assert upload_url_to_s3(f'{root_url}/{zip_paths[0]}', bucket, 'zip/a.zip', backoff=0, stats=stats)
+    assert get_s3_client().get_object(Bucket=bucket, Key='zip/a.zip')['Body'].read() == source
+    assert stats['size'] == stats['bytes'] == len(source)
+    assert stats['sha256'] == hashlib.sha256(source).hexdigest()
+    assert stats['retries'] == 0
+
+
+def test_upload_restarts_after_dropped_connections(egs_tree, serve, bucket):
+    root_dir, zip_paths = egs_tree
+    root_url = serve(root_dir, handler=FlakyHandler, drops=2, drop_after_bytes=16 * 1024, busy=1)
+    source = _read(os.path.join(root_dir, zip_paths[0]))
+    stats = {}
+    assert upload_url_to_s3(f'{root_url}/{zip_paths[0]}', bucket, 'zip/a.zip', backoff=0, stats=stats)
+    assert get_s3_client().get_object(Bucket=bucket, Key='zip/a.zip')['Body'].read() == source
+    assert stats['retries'] == 3
+    assert stats['size'] == len(source)
+    assert stats['sha256'] == hashlib.sha256(source).hexdigest()
+
+
+def test_missing_url_is_not_uploaded(egs_tree, serve, bucket):
+    root_dir, _ = egs_tree
+    root_url = serve(root_dir)
+    assert not upload_url_to_s3(f'{root_url}/public/EGS/missing.zip', bucket, 'zip/missing.zip', retries=1, backoff=0)
+    assert _object_keys(bucket) == []
+
+
+def test_truncated_body_is_never_published(egs_tree, serve, bucket):
+    root_dir, zip_paths = egs_tree
+    root_url = serve(root_dir, handler=FlakyHandler, drops=5, drop_after_bytes=16 * 1024)
+    assert not upload_url_to_s3(f'{root_url}/{zip_paths[0]}', bucket, 'zip/a.zip', retries=1, backoff=0)
+    assert _object_keys(bucket) == []
+
+
+def test_truncated_multipart_upload_is_aborted(tmp_path, serve, bucket, multipart):
+    root_dir = str(tmp_path / 'egs')
+    zip_paths = build_fake_egs_tree(root_dir, years=[2016], keywords=['Flood'], provinces=['ON'], links_per_dir=1,
+                                    padding_bytes=12 * MB)
+    # The first part is complete before the connection drops
+    root_url = serve(root_dir, handler=FlakyHandler, drops=5, drop_after_bytes=7 * MB)
+    assert not upload_url_to_s3(f'{root_url}/{zip_paths[0]}', bucket, 'zip/large.zip', retries=1, backoff=0)
+    assert _object_keys(bucket) == []
+    assert get_s3_client().list_multipart_uploads(Bucket=bucket).get('Uploads', []) == []
+
+
+def test_multipart_upload_of_a_large_zip(tmp_path, serve, bucket, multipart):
+    root_dir = str(tmp_path / 'egs')
+    zip_paths = build_fake_egs_tree(root_dir, years=[2016], keywords=['Flood'], provinces=['ON'], links_per_dir=1,
+                                    padding_bytes=12 * MB)
+    root_url = serve(root_dir)
+    source = _read(os.path.join(root_dir, zip_paths[0]))
+    stats = {}
+    assert upload_url_to_s3(f'{root_url}/{zip_paths[0]}', bucket, 'zip/large.zip', backoff=0, stats=stats)
+    assert get_s3_client().get_object(Bucket=bucket, Key='zip/large.zip')['Body'].read() == source
+    assert stats['sha256'] == hashlib.sha256(source).hexdigest()
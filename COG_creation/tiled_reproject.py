@@ -0,0 +1,169 @@
+import argparse
+import os
+import shutil
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from osgeo import gdal
+
+from geotiff_to_cog import _apply_cache, _timed, _translate_options, _validate, _warp_options, warp_to_cog
+"""
+Tiled reprojection of the rasters too large to warp in one piece within the memory of a worker.
+The output grid is the one of reproject_raster and warp_to_cog (targetAlignedPixels at xRes/yRes in dstSRS). It is cut
+into tiles of tile_size pixels, a multiple of the COG block size, and every tile is warped on its own to a Geotiff,
+reading only the source window it covers, with the warp memory of the GDAL profile. The tiles are assembled by a VRT
+that the COG driver reads block by block, so the memory of a worker is bounded by the tile size and GDAL_CACHEMAX
+instead of the size of the raster. The tiles can be warped by several threads, GDAL releases the GIL while warping.
+Nearest neighbour picks the same source pixel whatever the tile, and the tiles are warped with exact=True so the
+transformer computes every pixel instead of interpolating over the extent of the tile: the COG matches the one of
+warp_to_cog(exact=True) pixel for pixel. The default warp_to_cog interpolates the transformer within 1/8 pixel, and can
+pick another source pixel at the edges of the source pixels. Check it on a product with compare_rasters, or with the
+--compare option of the command line.
+"""
+
+# Tile side in pixels, 8 x 8 COG blocks of 512
+TILE_SIZE = 4096
+
+
+def output_grid(input_path, dstSRS, xRes, yRes):
+    """
+    Return the grid of the reprojected raster (geotransform, width, height), from a warp VRT without computing pixels
+    """
+    vrt_ds = gdal.Warp(destNameOrDestDS='', srcDSOrSrcDSTab=input_path, options=_warp_options(dstSRS, xRes, yRes, format='VRT'))
+    grid = (vrt_ds.GetGeoTransform(), vrt_ds.RasterXSize, vrt_ds.RasterYSize)
+    vrt_ds = None
+    return grid
+
+
+def tile_windows(width, height, tile_size=TILE_SIZE):
+    """
+    Yield the (xoff, yoff, xsize, ysize) pixel windows of the tiles covering a width x height grid
+    """
+    for yoff in range(0, height, tile_size):
+        for xoff in range(0, width, tile_size):
+            yield xoff, yoff, min(tile_size, width - xoff), min(tile_size, height - yoff)
+
+
+def window_bounds(geotransform, window):
+    """
+    Return the (minX, minY, maxX, maxY) bounds of a pixel window of a north-up grid
+    """
+    xoff, yoff, xsize, ysize = window
+    min_x = geotransform[0] + xoff * geotransform[1]
+    max_y = geotransform[3] + yoff * geotransform[5]
+    return min_x, max_y + ysize * geotransform[5], min_x + xsize * geotransform[1], max_y
+
+
+def _warp_tile(input_path, tile_path, dstSRS, bounds, size, profile=None):
+    """
+    Warp the part of the input covering bounds to a tiled Geotiff of size (width, height) pixels. The bounds and the
+    size are those of a window of the output grid, so the tile is not aligned again
+    """
+    width, height = size
+    ds = gdal.Warp(destNameOrDestDS=tile_path, srcDSOrSrcDSTab=input_path,
+                   options=_warp_options(dstSRS, None, None, profile=profile, exact=True, targetAlignedPixels=False, outputBounds=bounds,
+                                         width=width, height=height, creationOptions=['TILED=YES', 'COMPRESS=LZW']))
+    if ds is None:
+        raise RuntimeError(f'gdal.Warp failed on the tile {tile_path}: {gdal.GetLastErrorMsg()}')
+    ds = None
+    return tile_path
+
+
+def tiled_warp_to_cog(input_path, output_path, dstSRS, xRes, yRes, datetime_value, profile=None, timings=None,
+                      tile_size=TILE_SIZE, tile_workers=1, tile_dir=None):
+    """
+    Reproject the Geotiff tile by tile and assemble the tiles into a single COG, same output as warp_to_cog
+    :param input_path: file path, or a GDAL virtual path such as /vsizip/path/to/file.zip/file.tif
+    :param output_path: str, COG path include file name
+    :param dstSRS: desination projection in EPSG:xxxx
+    :param xRes and yRes: resolution
+    :param datetime_value: date in format '2021:05:03 01:29:09'
+    :param profile: optional GDAL profile from gdal_profile.get_profile, its warp_memory_mb bounds the warp of a tile
+    :param timings: optional dict the seconds of the steps are added to, under 'warp', 'translate' and 'validate'
+    :param tile_size: tile side in pixels, rounded to a multiple of the COG block size
+    :param tile_workers: number of threads warping tiles at the same time, each holds one tile in memory
+    :param tile_dir: folder of the tiles, next to output_path by default, deleted once the COG is written
+    :return the validation message, as warp_to_cog
+    """
+    _apply_cache(profile)
+    blocksize = (profile or {}).get('blocksize', 512)
+    tile_size = max(blocksize, tile_size // blocksize * blocksize)
+    tile_dir = tile_dir or output_path.replace('.tif', '_tiles')
+    os.makedirs(tile_dir, exist_ok=True)
+    start = time.perf_counter()
+    geotransform, width, height = output_grid(input_path, dstSRS, xRes, yRes)
+    windows = list(tile_windows(width, height, tile_size))
+    if len(windows) == 1:
+        # Small enough to be warped in one piece
+        shutil.rmtree(tile_dir, ignore_errors=True)
+        return warp_to_cog(input_path, output_path, dstSRS, xRes, yRes, datetime_value, profile=profile, timings=timings)
+    print(f'Warping {os.path.basename(output_path)} ({width} x {height} pixels) in {len(windows)} tiles of {tile_size} pixels')
+    try:
+        with ThreadPoolExecutor(max_workers=tile_workers) as executor:
+            futures = [executor.submit(_warp_tile, input_path, os.path.join(tile_dir, f'tile_{i:05d}.tif'), dstSRS,
+                                       window_bounds(geotransform, window), window[2:], profile)
+                       for i, window in enumerate(windows)]
+            tile_paths = [future.result() for future in futures]
+        start = _timed(timings, 'warp', start)
+        vrt_path = os.path.join(tile_dir, 'tiles.vrt')
+        vrt_ds = gdal.BuildVRT(vrt_path, tile_paths)
+        vrt_ds = None
+        ds = gdal.Translate(output_path, vrt_path, options=_translate_options(datetime_value, profile))
+        ds = None
+        _timed(timings, 'translate', start)
+    finally:
+        shutil.rmtree(tile_dir, ignore_errors=True)
+    return _validate(output_path, timings)
+
+
+def compare_rasters(path_a, path_b, block_size=TILE_SIZE):
+    """
+    Compare two rasters block by block
+    :return the list of differences, empty when the grids, the nodata values and every pixel are the same
+    """
+    ds_a, ds_b = gdal.Open(path_a), gdal.Open(path_b)
+    differences = []
+    if (ds_a.RasterXSize, ds_a.RasterYSize, ds_a.RasterCount) != (ds_b.RasterXSize, ds_b.RasterYSize, ds_b.RasterCount):
+        return [f'size {ds_a.RasterXSize} x {ds_a.RasterYSize} x {ds_a.RasterCount} != '
+                f'{ds_b.RasterXSize} x {ds_b.RasterYSize} x {ds_b.RasterCount}']
+    if ds_a.GetGeoTransform() != ds_b.GetGeoTransform():
+        differences.append(f'geotransform {ds_a.GetGeoTransform()} != {ds_b.GetGeoTransform()}')
+    for index in range(1, ds_a.RasterCount + 1):
+        band_a, band_b = ds_a.GetRasterBand(index), ds_b.GetRasterBand(index)
+        if band_a.GetNoDataValue() != band_b.GetNoDataValue():
+            differences.append(f'band {index} nodata {band_a.GetNoDataValue()} != {band_b.GetNoDataValue()}')
+        pixels = 0
+        for xoff, yoff, xsize, ysize in tile_windows(ds_a.RasterXSize, ds_a.RasterYSize, block_size):
+            pixels += int((band_a.ReadAsArray(xoff, yoff, xsize, ysize) != band_b.ReadAsArray(xoff, yoff, xsize, ysize)).sum())
+        if pixels:
+            differences.append(f'band {index}: {pixels} different pixels')
+    ds_a = ds_b = None
+    return differences
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Reproject a large Geotiff to COG tile by tile, and compare it with the single-piece warp.')
+    parser.add_argument('input_path', type=str, help='Geotiff to reproject')
+    parser.add_argument('output_path', type=str, help='COG to write')
+    parser.add_argument('--epsg', type=str, default='EPSG:3978', help='Projection EPSG code')
+    parser.add_argument('--res', type=float, default=5, help='Resolution in X and Y')
+    parser.add_argument('--tile-size', type=int, default=TILE_SIZE, help='Tile side in pixels')
+    parser.add_argument('--tile-workers', type=int, default=1, help='Number of tiles warped at the same time')
+    parser.add_argument('--compare', action='store_true', help='Also run the exact warp_to_cog and compare both COGs pixel for pixel')
+    args = parser.parse_args()
+    datetime_value = time.strftime('%Y:%m:%d %H:%M:%S')
+    timings = {}
+    tiled_warp_to_cog(args.input_path, args.output_path, args.epsg, args.res, args.res, datetime_value, timings=timings,
+                      tile_size=args.tile_size, tile_workers=args.tile_workers)
+    print(f'Tiled: {timings}')
+    if args.compare:
+        reference_path = args.output_path.replace('.tif', '_reference.tif')
+        timings = {}
+        warp_to_cog(args.input_path, reference_path, args.epsg, args.res, args.res, datetime_value, timings=timings, exact=True)
+        print(f'Single piece: {timings}')
+        differences = compare_rasters(args.output_path, reference_path)
+        print('\n'.join(differences) if differences else 'The COGs are the same pixel for pixel')
+"""
+# Run the scripts from the termial
+python tiled_reproject.py Test/tiff/RiverIce_CAN_NT_UpperMackenzieCamsellBend_20200513_013745.tif tiled_cog.tif --tile-size 1024 --tile-workers 4 --compare
+"""